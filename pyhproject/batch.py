@@ -0,0 +1,205 @@
+"""
+Headless batch processing for whole directories of medical images
+
+Runs the same grayscale / contrast enhancement / edge detection pipelines as
+the GUI over every image in a folder, fanning the work out over a process pool.
+
+Usage:
+    python batch.py in/ out/ --op edges --low 50 --high 150 --clahe
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+
+from disk_cache import DEFAULT_CACHE_MB, DiskCache, add_cache_arguments
+from pipeline import run_cached
+from processing import CLAHE_ENGINE, OPERATIONS, ProcessingParams, read_image, write_image
+from writer import TIFF_COMPRESSION, SaveOptions, encode_params
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"}
+
+
+@dataclass
+class BatchReport:
+    processed: int = 0
+    failed: int = 0
+    bytes_written: int = 0
+    elapsed: float = 0.0
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+
+    @property
+    def images_per_second(self) -> float:
+        return self.processed / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def iter_images(input_dir: Path, recursive: bool = False) -> Iterator[Path]:
+    pattern = "**/*" if recursive else "*"
+    for path in sorted(input_dir.glob(pattern)):
+        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS:
+            yield path
+
+
+_DISK_CACHE: Optional[DiskCache] = None
+
+
+def _init_worker(cache_dir: Optional[str] = None, cache_bytes: int = DEFAULT_CACHE_MB << 20):
+    # One OpenCV thread per process: the pool provides the parallelism and
+    # nested thread pools would only oversubscribe the cores.
+    global _DISK_CACHE
+    cv2.setNumThreads(1)
+    CLAHE_ENGINE.workers = 1
+    if cache_dir is not None:
+        # Synchronous writes: pool processes exit without joining threads.
+        _DISK_CACHE = DiskCache(cache_dir, cache_bytes, background=False)
+
+
+def _process_file(src: str, dst: str, operation: str, params: ProcessingParams,
+                  encode: Sequence[int] = ()) -> int:
+    image = read_image(src)
+    result = run_cached(image, operation, params, _DISK_CACHE)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    return write_image(dst, result, encode)
+
+
+def process_directory(input_dir, output_dir, operation: str, params: ProcessingParams,
+                      workers: Optional[int] = None, max_in_flight: Optional[int] = None,
+                      recursive: bool = False, output_extension: str = ".png",
+                      save_options: SaveOptions = SaveOptions(),
+                      cache_dir=None, cache_bytes: int = DEFAULT_CACHE_MB << 20,
+                      progress: Optional[Callable[[BatchReport], None]] = None) -> BatchReport:
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation '{operation}', expected one of {', '.join(OPERATIONS)}")
+
+    input_dir = Path(input_dir)
+    output_dir = Path(output_dir)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+
+    encode = encode_params(output_extension, save_options)
+    report = BatchReport()
+    pending = {}
+    start = time.perf_counter()
+
+    def collect(done):
+        for future in done:
+            src = pending.pop(future)
+            try:
+                report.bytes_written += future.result()
+                report.processed += 1
+            except Exception as e:
+                report.failed += 1
+                report.errors.append((str(src), str(e)))
+        report.elapsed = time.perf_counter() - start
+        if progress is not None:
+            progress(report)
+
+    cache_dir = str(cache_dir) if cache_dir is not None else None
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(cache_dir, cache_bytes)) as pool:
+        for src in iter_images(input_dir, recursive):
+            # Bound the number of queued images so memory stays flat no matter
+            # how large the input directory is.
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            dst = (output_dir / src.relative_to(input_dir)).with_suffix(output_extension)
+            future = pool.submit(_process_file, str(src), str(dst), operation, params, encode)
+            pending[future] = src
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(done)
+
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def add_processing_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--op", choices=OPERATIONS, default="grayscale", help="processing operation")
+    parser.add_argument("--brightness", type=int, default=50, help="brightness (0-100)")
+    parser.add_argument("--contrast", type=int, default=50, help="contrast (0-100)")
+    parser.add_argument("--low", type=int, default=50, help="Canny low threshold (0-255)")
+    parser.add_argument("--high", type=int, default=150, help="Canny high threshold (0-255)")
+    parser.add_argument("--clahe", action="store_true", help="enable CLAHE enhancement")
+    parser.add_argument("--clip-limit", type=float, default=None,
+                        help="CLAHE clip limit (default: 3.0 for enhance, 2.0 otherwise)")
+    parser.add_argument("--tile-grid", type=int, default=8, help="CLAHE tiles per side")
+    parser.add_argument("--focus", type=int, default=0, choices=range(-10, 11), metavar="[-10..10]",
+                        help="focus level (negative blurs, positive sharpens)")
+
+
+def params_from_args(args: argparse.Namespace) -> ProcessingParams:
+    return ProcessingParams(
+        brightness=args.brightness,
+        contrast=args.contrast,
+        low_threshold=args.low,
+        high_threshold=args.high,
+        use_clahe=args.clahe,
+        focus_level=args.focus,
+        clip_limit=args.clip_limit,
+        tile_grid=args.tile_grid,
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Batch-process a directory of medical images")
+    parser.add_argument("input_dir", type=Path)
+    parser.add_argument("output_dir", type=Path)
+    add_processing_arguments(parser)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument("--max-in-flight", type=int, default=None,
+                        help="maximum queued images (default: 2 x workers)")
+    parser.add_argument("--recursive", action="store_true", help="include sub-directories")
+    parser.add_argument("--format", default=".png", help="output file extension")
+    parser.add_argument("--quality", type=int, default=95, help="JPEG / WebP quality (1-100)")
+    parser.add_argument("--compression", type=int, default=3, choices=range(10), metavar="[0..9]",
+                        help="PNG compression level")
+    parser.add_argument("--tiff-compression", choices=sorted(TIFF_COMPRESSION), default="lzw")
+    add_cache_arguments(parser)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if not args.input_dir.is_dir():
+        print(f"[ERROR] Input directory not found: {args.input_dir}")
+        return 2
+
+    params = params_from_args(args)
+    extension = args.format if args.format.startswith('.') else f".{args.format}"
+    save_options = SaveOptions(quality=args.quality, png_compression=args.compression,
+                               tiff_compression=args.tiff_compression)
+
+    def progress(report: BatchReport):
+        done = report.processed + report.failed
+        if done % 100 == 0:
+            print(f"[Batch] {done} images - {report.images_per_second:.1f} images/sec")
+
+    report = process_directory(args.input_dir, args.output_dir, args.op, params,
+                               workers=args.workers, max_in_flight=args.max_in_flight,
+                               recursive=args.recursive, output_extension=extension,
+                               save_options=save_options, cache_dir=args.cache_dir,
+                               cache_bytes=args.cache_size << 20, progress=progress)
+
+    for src, error in report.errors:
+        print(f"[ERROR] {src}: {error}")
+    print(f"[OK] Processed {report.processed} images ({report.failed} failed) in {report.elapsed:.2f}s")
+    print(f"   Throughput: {report.images_per_second:.1f} images/sec")
+    print(f"   Written: {report.bytes_written / 1e6:.1f} MB")
+    return 1 if report.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,288 @@
+"""
+Benchmarks for the processing stages, the magnifier and the display path
+
+Times every stage (grayscale, CLAHE, brightness/contrast, every focus level),
+the full grayscale / enhance / edges chains, zoom region extraction and the
+numpy -> QImage -> QPixmap conversions of the main view and the zoom window on
+synthetic images, and reports latency percentiles, throughput and peak
+memory. Results are saved as JSON; passing an earlier run as ``--baseline``
+flags the cases whose median got slower.
+
+Usage:
+    python benchmark.py --sizes 512 2048 8192 --output bench.json
+    python benchmark.py --cases "focus_*" clahe --baseline bench.json
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from canny_sweep import CannySweep, threshold_grid, thumbnail_block
+from pipeline import canny, gaussian_blur_5x5, run_operation
+from processing import (ProcessingParams, adjust_brightness_contrast, apply_clahe,
+                        apply_focus_effect, to_grayscale)
+from zoom import ZOOM_VIEW_SIZE, crop_region, magnify
+
+DEFAULT_SIZES = (512, 2048, 4096)
+
+# The 10x10 Canny threshold grid shares the gradients and the hysteresis
+# between pairs, so its median may cost at most this many single Canny calls
+# on the same image. Only checked from SWEEP_BUDGET_MIN_SIZE up: on smaller
+# images filling the fixed-size thumbnail tiles of 100 pairs outweighs one
+# Canny call.
+SWEEP_CANNY_BUDGET = 8.0
+SWEEP_BUDGET_MIN_SIZE = 2048
+
+# (name, input kind, function of the input image)
+Case = Tuple[str, str, Callable[[np.ndarray], object]]
+
+
+@dataclass
+class CaseResult:
+    case: str
+    size: int
+    runs: int
+    min_ms: float
+    mean_ms: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    peak_mb: float
+
+    @property
+    def megapixels_per_second(self) -> float:
+        return self.size * self.size / 1e6 / (self.p50_ms / 1e3) if self.p50_ms > 0 else 0.0
+
+
+def synthetic_image(size: int, seed: int = 0) -> np.ndarray:
+    """Deterministic BGR image with smooth structures and fine noise."""
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 256, (size // 64 + 2, size // 64 + 2, 3), dtype=np.uint8)
+    image = cv2.resize(coarse, (size, size), interpolation=cv2.INTER_CUBIC)
+    noise = np.empty((min(size, 1024), size, 3), dtype=np.uint8)
+    # Added band by band so 16k images do not need a second full-size buffer.
+    for y0 in range(0, size, noise.shape[0]):
+        band = image[y0:y0 + noise.shape[0]]
+        cv2.randu(noise, 0, 24)
+        cv2.add(band, noise[:band.shape[0]], dst=band)
+    return image
+
+
+def processing_cases() -> List[Case]:
+    params = ProcessingParams(use_clahe=True)
+    lows, highs = threshold_grid()
+    cases: List[Case] = [
+        ("grayscale", "bgr", to_grayscale),
+        ("clahe", "gray", lambda img: apply_clahe(img, 2.0, (8, 8))),
+        ("brightness_contrast", "gray", lambda img: adjust_brightness_contrast(img, 60, 55)),
+        ("chain_grayscale", "bgr", lambda img: run_operation(img, "grayscale", params)),
+        ("chain_enhance", "bgr", lambda img: run_operation(img, "enhance", params)),
+        ("chain_edges", "bgr", lambda img: run_operation(img, "edges", params)),
+        ("canny", "blurred", lambda img: canny(img, 50, 150)),
+        ("canny_sweep_grid_10x10", "blurred",
+         lambda img: CannySweep(img).edge_density(lows, highs, thumbnail_block(img.shape))),
+        ("canny_sweep_10x10", "blurred", lambda img: CannySweep(img).contact_sheet(lows, highs)),
+    ]
+    for level in range(-10, 11):
+        cases.append((f"focus_{level}", "gray", lambda img, level=level: apply_focus_effect(img, level)))
+    return cases
+
+
+def display_cases() -> List[Case]:
+    """Cases that go through the real widgets; needs PySide6 (offscreen is fine)."""
+    from PySide6.QtWidgets import QApplication
+    from widget import ImageProcessor
+    from zoom import ZoomWindow
+
+    app = QApplication.instance() or QApplication([])
+    processor = ImageProcessor()
+    zoom_window = ZoomWindow(np.zeros((ZOOM_VIEW_SIZE, ZOOM_VIEW_SIZE, 3), dtype=np.uint8))
+    out_size = zoom_window.target_size()
+
+    def zoomed(img: np.ndarray) -> np.ndarray:
+        h, w = img.shape[:2]
+        return processor.get_zoomed_region(img, w // 2, h // 2, 100, out_size)
+
+    def show_zoomed(img: np.ndarray):
+        zoom_window.display_zoomed_image(zoomed(img))
+        app.processEvents()
+
+    def show_main(img: np.ndarray):
+        processor.show_on_main_label(img)
+        app.processEvents()
+
+    return [
+        ("zoom_region", "bgr", zoomed),
+        ("display_main_label", "bgr", show_main),
+        ("display_main_label_gray", "gray", show_main),
+        ("display_zoom_window", "bgr", show_zoomed),
+    ]
+
+
+def zoom_cases() -> List[Case]:
+    # Same work as ImageProcessor.get_zoomed_region, for runs without Qt.
+    def zoomed(img: np.ndarray) -> np.ndarray:
+        h, w = img.shape[:2]
+        return magnify(crop_region(img, w // 2, h // 2, 100), ZOOM_VIEW_SIZE, ZOOM_VIEW_SIZE)
+
+    return [("zoom_region", "bgr", zoomed)]
+
+
+def percentile(sorted_ms: List[float], q: float) -> float:
+    return float(np.percentile(sorted_ms, q)) if sorted_ms else 0.0
+
+
+def run_case(name: str, size: int, func: Callable[[np.ndarray], object], image: np.ndarray,
+             repeat: int, max_time: float) -> CaseResult:
+    func(image)  # warm-up: caches, lazily built tables, thread pools
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeat:
+        t0 = time.perf_counter()
+        func(image)
+        times.append((time.perf_counter() - t0) * 1e3)
+        if len(times) >= 3 and time.perf_counter() - start > max_time:
+            break
+
+    # Separate run: tracemalloc slows allocation-heavy code down.
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    func(image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times.sort()
+    return CaseResult(case=name, size=size, runs=len(times), min_ms=times[0],
+                      mean_ms=float(np.mean(times)), p50_ms=percentile(times, 50),
+                      p90_ms=percentile(times, 90), p99_ms=percentile(times, 99),
+                      peak_mb=(peak - base) / 1e6)
+
+
+def compare(results: List[CaseResult], baseline: Dict, tolerance: float) -> List[str]:
+    """Cases whose median is more than ``tolerance`` slower than in ``baseline``."""
+    previous = {(r["case"], r["size"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        old = previous.get((result.case, result.size))
+        if old is None or old["p50_ms"] <= 0:
+            continue
+        ratio = result.p50_ms / old["p50_ms"]
+        if ratio > 1.0 + tolerance:
+            regressions.append(f"{result.case} {result.size}x{result.size}: "
+                               f"{old['p50_ms']:.2f} -> {result.p50_ms:.2f} ms ({ratio:.2f}x)")
+    return regressions
+
+
+def over_sweep_budget(results: List[CaseResult]) -> List[str]:
+    """Sizes at which the threshold grid costs more than SWEEP_CANNY_BUDGET Canny calls."""
+    canny_ms = {r.size: r.p50_ms for r in results if r.case == "canny"}
+    over = []
+    for result in results:
+        single = canny_ms.get(result.size, 0.0)
+        if result.case != "canny_sweep_grid_10x10" or result.size < SWEEP_BUDGET_MIN_SIZE or single <= 0:
+            continue
+        calls = result.p50_ms / single
+        if calls > SWEEP_CANNY_BUDGET:
+            over.append(f"{result.case} {result.size}x{result.size}: {result.p50_ms:.2f} ms = "
+                        f"{calls:.1f} Canny calls (budget {SWEEP_CANNY_BUDGET:g})")
+    return over
+
+
+def environment() -> Dict:
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "opencv_threads": cv2.getNumThreads(),
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages and the display path")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES),
+                        help="square image sizes in pixels (e.g. 512 2048 16384)")
+    parser.add_argument("--cases", nargs="+", default=["*"], help="case name patterns (default: all)")
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs per case")
+    parser.add_argument("--max-time", type=float, default=2.0,
+                        help="stop repeating a case after this many seconds (at least 3 runs)")
+    parser.add_argument("--no-display", action="store_true", help="skip the Qt display cases")
+    parser.add_argument("--output", type=Path, default=None, help="write results as JSON")
+    parser.add_argument("--baseline", type=Path, default=None, help="JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="allowed median slowdown against the baseline (default: 0.10)")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    cases = processing_cases()
+    if args.no_display:
+        cases += zoom_cases()
+    else:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+        try:
+            cases += display_cases()
+        except ImportError as e:
+            print(f"[ERROR] Display cases unavailable ({e}); use --no-display")
+            return 2
+    cases = [case for case in cases if any(fnmatch.fnmatch(case[0], p) for p in args.cases)]
+    if not cases:
+        print(f"[ERROR] No benchmark matches {' '.join(args.cases)}")
+        return 2
+
+    results: List[CaseResult] = []
+    for size in args.sizes:
+        bgr = synthetic_image(size)
+        gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+        inputs = {"bgr": bgr, "gray": gray, "blurred": gaussian_blur_5x5(gray)}
+        for name, kind, func in cases:
+            result = run_case(name, size, func, inputs[kind], args.repeat, args.max_time)
+            results.append(result)
+            print(f"[Bench] {name:<24} {size:>5}x{size:<5} p50 {result.p50_ms:9.2f} ms  "
+                  f"p90 {result.p90_ms:9.2f} ms  p99 {result.p99_ms:9.2f} ms  "
+                  f"{result.megapixels_per_second:8.1f} MP/s  peak {result.peak_mb:8.1f} MB")
+        del bgr, inputs
+
+    if args.output is not None:
+        report = {"environment": environment(),
+                  "results": [dict(asdict(r), megapixels_per_second=r.megapixels_per_second)
+                              for r in results]}
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"[OK] Results written to {args.output}")
+
+    over_budget = over_sweep_budget(results)
+    for line in over_budget:
+        print(f"[Regression] {line}")
+
+    if args.baseline is not None:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for line in regressions:
+            print(f"[Regression] {line}")
+        if regressions:
+            return 1
+        print(f"[OK] No case slower than the baseline by more than {args.tolerance:.0%}")
+    return 1 if over_budget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
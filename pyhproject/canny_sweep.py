@@ -0,0 +1,384 @@
+"""
+Canny threshold sweep that computes the gradients once
+
+cv2.Canny recomputes the Sobel gradients and the non-maximum suppression for
+every threshold pair, although only the final hysteresis step depends on the
+thresholds. CannySweep computes the gradients once and runs cv2.Canny on them
+for the loosest pair only (lowest low, lowest high): the edges of every other
+pair are a subset of those, since a higher low only splits components and a
+higher high only drops them. The hysteresis of all low thresholds is then one
+union-find pass over those pixels: they join in decreasing order of
+magnitude, so the components of each low threshold are snapshots of the same
+forest, and each component's strongest pixel is its root. A high threshold
+only keeps the components whose root is above it. The results are laid out as
+a contact sheet, and thresholds can be suggested from the histogram of the
+suppressed gradient magnitudes.
+
+Usage:
+    python canny_sweep.py scan.dcm sheet.png --clahe --steps 10
+    python canny_sweep.py scan.png sheet.png --low-range 5 60 --high-range 40 200
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import math
+import sys
+import time
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from batch import add_processing_arguments, params_from_args
+from pipeline import canny, run_operation
+from loader import open_stack
+from processing import ProcessingParams, write_image
+from pyramid import fit_size
+
+CELL_SIZE = 200
+LABEL_HEIGHT = 18
+
+
+# cv2.Canny bins the gradient direction with tan(22.5 deg) in Q15 fixed point.
+TAN_22_5 = 13573 / 32768
+# The suppression runs in bands of rows of about this many pixels, so its
+# temporaries stay in cache.
+STRIPE_PIXELS = 1 << 17
+
+
+def gradients(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The 16-bit 3x3 Sobel derivatives cv2.Canny computes internally."""
+    return cv2.spatialGradient(image, borderType=cv2.BORDER_REPLICATE)
+
+
+def suppress_non_maxima(dx: np.ndarray, dy: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Flat indices (row-major) and L1 gradient magnitudes of the pixels cv2.Canny keeps as local maxima."""
+    h, w = dx.shape
+    abs_dx, abs_dy = cv2.absdiff(dx, 0), cv2.absdiff(dy, 0)
+    # Zero border: cv2.Canny compares the outermost pixels against 0.
+    magnitude = cv2.copyMakeBorder(cv2.add(abs_dx, abs_dy), 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+    compare, both = cv2.compare, cv2.bitwise_and
+    rows = max(1, STRIPE_PIXELS // w)
+    found = []
+    for y0 in range(0, h, rows):
+        y1 = min(h, y0 + rows)
+        ax, ay = abs_dx[y0:y1], abs_dy[y0:y1]
+        # |dy| < tan(22.5)|dx| and |dy| > tan(67.5)|dx|, in float32 where
+        # both products are exact, so the direction bins match cv2.Canny's.
+        horizontal = compare(cv2.addWeighted(ay, 1, ax, -TAN_22_5, 0, dtype=cv2.CV_32F), 0, cv2.CMP_LT)
+        vertical = compare(cv2.addWeighted(cv2.addWeighted(ay, 1, ax, -2, 0), 1, ax, -TAN_22_5, 0,
+                                           dtype=cv2.CV_32F), 0, cv2.CMP_GT)
+        falling = compare(cv2.bitwise_xor(dx[y0:y1], dy[y0:y1]), 0, cv2.CMP_LT)
+        above, row, below = magnitude[y0:y1], magnitude[y0 + 1:y1 + 1], magnitude[y0 + 2:y1 + 2]
+        m = row[:, 1:-1]
+        # Same strict / non-strict comparisons per direction as cv2.Canny.
+        keep = both(compare(m, above[:, :-2], cv2.CMP_GT), compare(m, below[:, 2:], cv2.CMP_GT))
+        cv2.copyTo(both(compare(m, above[:, 2:], cv2.CMP_GT), compare(m, below[:, :-2], cv2.CMP_GT)),
+                   falling, keep)
+        cv2.copyTo(both(compare(m, above[:, 1:-1], cv2.CMP_GT), compare(m, below[:, 1:-1], cv2.CMP_GE)),
+                   vertical, keep)
+        cv2.copyTo(both(compare(m, row[:, :-2], cv2.CMP_GT), compare(m, row[:, 2:], cv2.CMP_GE)),
+                   horizontal, keep)
+        found.append(np.flatnonzero(keep.view(bool)) + y0 * w)
+    index = np.concatenate(found)
+    return index, magnitude.ravel()[index + index // w * 2 + w + 3]
+
+
+def _flatten(parent: np.ndarray, nodes: np.ndarray) -> None:
+    # Pointer jumping until every node in ``nodes`` points straight at its root.
+    while nodes.size:
+        target = parent[parent[nodes]]
+        parent[nodes] = target
+        nodes = nodes[parent[target] != target]
+
+
+def threshold_grid(low_range: Tuple[int, int] = (10, 100), high_range: Tuple[int, int] = (30, 255),
+                   steps: int = 10) -> Tuple[List[int], List[int]]:
+    lows = sorted({int(round(v)) for v in np.linspace(*low_range, steps)})
+    highs = sorted({int(round(v)) for v in np.linspace(*high_range, steps)})
+    return lows, highs
+
+
+def thumbnail_block(shape: Tuple[int, int], cell: int = CELL_SIZE) -> int:
+    """Image pixels per thumbnail tile side, so the tiles of an image fit in one contact sheet cell."""
+    return max(1, math.ceil(max(shape[:2]) / (cell - 4)))
+
+
+@dataclass
+class SweepSheet:
+    """Contact sheet: one row per low threshold, one column per high threshold."""
+    image: np.ndarray
+    lows: List[int]
+    highs: List[int]
+    cell: int = CELL_SIZE
+
+    def pair_at(self, x: int, y: int) -> Optional[Tuple[int, int]]:
+        row, col = y // (self.cell + LABEL_HEIGHT), x // self.cell
+        if 0 <= row < len(self.lows) and 0 <= col < len(self.highs) and self.lows[row] < self.highs[col]:
+            return self.lows[row], self.highs[col]
+        return None
+
+
+@dataclass
+class _Hierarchy:
+    """Union-find snapshots of the edge pixels of the loosest pair, one per low threshold."""
+    thresholds: List[int]
+    loosest: Tuple[int, int]  # (low, high) whose edge pixels are the nodes
+    index: np.ndarray  # flat pixel index per node, strongest nodes first
+    level: np.ndarray  # number of thresholds below each node's magnitude
+    roots: Dict[int, np.ndarray]  # low -> root (strongest node) of the component of each node above it
+
+
+class CannySweep:
+    """Edge maps of one (blurred, 8-bit grayscale) image for many threshold pairs."""
+
+    def __init__(self, image: np.ndarray):
+        if image.dtype != np.uint8 or image.ndim != 2:
+            raise ValueError("Canny needs an 8-bit single-channel image")
+        self.shape = image.shape
+        self.dx, self.dy = gradients(image)
+        self._hierarchy: Optional[_Hierarchy] = None
+
+    def _label(self, lows: Sequence[int], highs: Sequence[int]) -> Optional[_Hierarchy]:
+        """Components of every low threshold, for the pairs of ``lows`` x ``highs`` with low < high."""
+        lows = sorted({low for low in lows if any(low < high for high in highs)})
+        if not lows:
+            return None
+        thresholds = sorted(set(lows) | set(highs))
+        loosest = lows[0], min(high for high in highs if high > lows[0])
+        cached = self._hierarchy
+        if (cached is not None and cached.thresholds == thresholds and set(lows) <= set(cached.roots)
+                and cached.loosest[1] <= loosest[1]):
+            return cached
+
+        h, w = self.shape
+        index = np.flatnonzero(cv2.Canny(self.dx, self.dy, *loosest).view(bool))
+        magnitude = np.abs(self.dx.ravel()[index]) + np.abs(self.dy.ravel()[index])
+        level = np.searchsorted(thresholds, magnitude, side="left").astype(np.int16)
+        # Nodes by decreasing level (row-major within a level): the pixels
+        # above any low threshold are a prefix, and the smallest node of a
+        # component is among its strongest.
+        order = np.argsort(-level, kind="stable")
+        node = np.empty(order.size, dtype=np.int32)
+        node[order] = np.arange(order.size, dtype=np.int32)
+
+        stride = w + 2
+        padded = index + index // w * 2 + stride + 1
+        lookup = np.full((h + 2) * stride, -1, dtype=np.int32)
+        lookup[padded] = node
+        first, second = [], []
+        for offset in (1, stride - 1, stride, stride + 1):
+            neighbour = lookup[padded + offset]
+            linked = neighbour >= 0
+            first.append(node[linked])
+            second.append(neighbour[linked])
+        first, second = np.concatenate(first), np.concatenate(second)
+        index, level = index[order], level[order]
+
+        # Nodes above each low, highest low first.
+        above = np.cumsum(np.bincount(level, minlength=len(thresholds) + 1)[::-1])[::-1]
+        counts = [int(above[thresholds.index(low) + 1]) for low in reversed(lows)]
+        # A link exists from the highest low both of its nodes are above, so
+        # the links are added in that order and the forest only ever merges.
+        step = np.searchsorted(counts, np.maximum(first, second), side="right").astype(np.int16)
+        order = np.argsort(step, kind="stable")
+        first, second = first[order], second[order]
+        bounds = np.searchsorted(step[order], np.arange(len(counts) + 1))
+
+        parent = np.arange(index.size, dtype=np.int32)
+        root = parent.copy()
+        roots = {}
+        for k, (low, count) in enumerate(zip(reversed(lows), counts)):
+            a, b = root[first[bounds[k]:bounds[k + 1]]], root[second[bounds[k]:bounds[k + 1]]]
+            hooked = []
+            while a.size:
+                joined = a != b
+                a, b = a[joined], b[joined]
+                if not a.size:
+                    break
+                # The weaker root joins the stronger one; several links of
+                # the same root are resolved over the following rounds.
+                strong, weak = np.minimum(a, b), np.maximum(a, b)
+                parent[weak] = strong
+                _flatten(parent, weak)
+                hooked.append(weak)
+                a, b = parent[strong], parent[weak]
+            if hooked:
+                _flatten(parent, np.concatenate(hooked))
+                root[:count] = parent[root[:count]]
+            roots[low] = root[:count].copy()
+        self._hierarchy = _Hierarchy(thresholds, loosest, index, level, roots)
+        return self._hierarchy
+
+    def edges(self, low: float, high: float) -> np.ndarray:
+        """Same result as cv2.Canny(image, low, high)."""
+        low, high = sorted((math.floor(low), math.floor(high)))
+        labelled = self._hierarchy
+        if (labelled is None or low not in labelled.roots or high not in labelled.thresholds
+                or high < max(low + 1, labelled.loosest[1])):
+            return cv2.Canny(self.dx, self.dy, low, high)
+        root = labelled.roots[low]
+        edges = np.zeros(self.shape, dtype=np.uint8)
+        strong = labelled.level[root] > labelled.thresholds.index(high)
+        edges.ravel()[labelled.index[:root.size][strong]] = 255
+        return edges
+
+    def sweep(self, lows: Sequence[int], highs: Sequence[int]) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """(low, high, edges) for every pair with low < high, grouped by low threshold."""
+        self._label(lows, highs)
+        for low in lows:
+            for high in highs:
+                if low < high:
+                    yield low, high, self.edges(low, high)
+        self._hierarchy = None
+
+    def edge_density(self, lows: Sequence[int], highs: Sequence[int],
+                     block: int) -> Dict[Tuple[int, int], np.ndarray]:
+        """Edge pixels per ``block`` x ``block`` tile for every pair with low < high.
+
+        The full-resolution edge maps are never built: per low threshold the
+        edge pixels of all high thresholds are counted per tile in one pass,
+        since a pixel is an edge for every high below its component's peak.
+        Scaled so a one-pixel line crossing a tile shows at full brightness.
+        """
+        labelled = self._label(lows, highs)
+        if labelled is None:
+            return {}
+        h, w = self.shape
+        blocks_h, blocks_w = -(-h // block), -(-w // block)
+        block_count = blocks_h * blocks_w
+        highs_sorted = sorted(set(highs))
+        y, x = np.divmod(labelled.index, w)
+        cells = (y // block) * blocks_w + x // block
+        # Only the tiles with any edge pixel are counted, numbered compactly.
+        occupied = np.zeros(block_count, dtype=bool)
+        occupied[cells] = True
+        tile = (np.cumsum(occupied, dtype=np.int32) - 1)[cells]
+        occupied = np.flatnonzero(occupied)
+        # Number of high thresholds below each node's magnitude.
+        passes = np.cumsum([0] + [t in highs_sorted for t in labelled.thresholds])[labelled.level]
+        passes = passes.astype(np.int32) * occupied.size
+        # Scaled so a one-pixel line crossing a tile shows at full brightness.
+        brightness = np.minimum(np.arange(block * block + 1) * (255.0 / block), 255).astype(np.uint8)
+        swept = list(labelled.roots)
+        levels = len(highs_sorted) + 1
+
+        # One count per (low, nodes' number of highs passed, tile).
+        keys = np.concatenate([passes[root] + tile[:root.size] + k * levels * occupied.size
+                               for k, root in enumerate(labelled.roots.values())])
+        counts = np.bincount(keys, minlength=len(swept) * levels * occupied.size)
+        counts = counts.reshape(len(swept), levels, occupied.size)
+        # Edge pixels per tile for the k-th smallest high: nodes above it.
+        above = np.empty((len(swept), levels, occupied.size), dtype=np.int64)
+        above[:, -1] = 0
+        for k in range(levels - 2, -1, -1):
+            np.add(above[:, k + 1], counts[:, k + 1], out=above[:, k])
+        tiles = np.zeros((len(swept), levels - 1, block_count), dtype=np.uint8)
+        tiles[:, :, occupied] = np.take(brightness, above[:, :-1])
+        tiles = tiles.reshape(len(swept), levels - 1, blocks_h, blocks_w)
+
+        density = {}
+        for low, per_high in zip(swept, tiles):
+            for high, row in zip(highs_sorted, per_high):
+                if low < high:
+                    density[low, high] = row
+        return density
+
+    def suggest_thresholds(self, ratio: float = 2.0) -> Tuple[int, int]:
+        """Otsu split of the edge-candidate magnitudes as the high threshold, high / ratio as the low."""
+        _, magnitude = suppress_non_maxima(self.dx, self.dy)
+        if magnitude.size == 0:
+            return 50, 150
+        values = np.minimum(magnitude, 255).astype(np.uint8).reshape(1, -1)
+        high, _ = cv2.threshold(values, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        high = int(high)
+        return int(round(high / ratio)), high
+
+    def contact_sheet(self, lows: Sequence[int], highs: Sequence[int], cell: int = CELL_SIZE,
+                      mark: Optional[Tuple[int, int]] = None) -> SweepSheet:
+        """Thumbnails of every pair with low < high, drawn from edge_density."""
+        h, w = self.shape
+        block = thumbnail_block(self.shape, cell)
+        thumb_w, thumb_h = fit_size(w, h, cell - 4, cell - 4)
+        row_h = cell + LABEL_HEIGHT
+        sheet = np.full((row_h * len(lows), cell * len(highs)), 40, dtype=np.uint8)
+        density = self.edge_density(lows, highs, block)
+        self._hierarchy = None
+        pairs = [(row, col, low, high) for row, low in enumerate(lows)
+                 for col, high in enumerate(highs) if low < high]
+        for row, col, low, high in pairs:
+            tx = col * cell + (cell - thumb_w) // 2
+            ty = row * row_h + LABEL_HEIGHT + (cell - thumb_h) // 2
+            sheet[ty:ty + thumb_h, tx:tx + thumb_w] = cv2.resize(density[low, high], (thumb_w, thumb_h),
+                                                                 interpolation=cv2.INTER_AREA)
+
+        sheet = cv2.cvtColor(sheet, cv2.COLOR_GRAY2BGR)
+        for row, col, low, high in pairs:
+            x0, y0 = col * cell, row * row_h
+            color = (0, 200, 255) if mark == (low, high) else (236, 240, 241)
+            cv2.putText(sheet, f"{low}/{high}", (x0 + 4, y0 + LABEL_HEIGHT - 5),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.45, color, 1, cv2.LINE_AA)
+            if mark == (low, high):
+                cv2.rectangle(sheet, (x0 + 1, y0 + 1), (x0 + cell - 2, y0 + row_h - 2), color, 2)
+        return SweepSheet(sheet, list(lows), list(highs), cell)
+
+
+def edge_input(image: np.ndarray, params: ProcessingParams) -> np.ndarray:
+    """The blurred 8-bit image the Canny stage of the "edges" operation sees."""
+    return run_operation(image, "edges", params, until="blur")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Contact sheet of Canny edges over a grid of thresholds")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path, help="contact sheet image")
+    add_processing_arguments(parser)
+    parser.add_argument("--low-range", type=int, nargs=2, default=(10, 100), metavar=("MIN", "MAX"))
+    parser.add_argument("--high-range", type=int, nargs=2, default=(30, 255), metavar=("MIN", "MAX"))
+    parser.add_argument("--steps", type=int, default=10, help="thresholds per axis")
+    parser.add_argument("--cell", type=int, default=CELL_SIZE, help="thumbnail size in pixels")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if not args.input.is_file():
+        print(f"[ERROR] Input file not found: {args.input}")
+        return 2
+
+    stack = open_stack(args.input)
+    try:
+        image = stack.frame(0).to_array()
+    finally:
+        stack.close()
+    params = params_from_args(args)
+    if image.dtype != np.uint8:
+        params = replace(params, data_range=(float(image.min()), float(image.max())))
+    blurred = edge_input(image, params)
+    lows, highs = threshold_grid(tuple(args.low_range), tuple(args.high_range), args.steps)
+
+    start = time.perf_counter()
+    sweep = CannySweep(blurred)
+    suggested = sweep.suggest_thresholds()
+    pairs = sum(1 for _ in sweep.sweep(lows, highs))
+    elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    canny(blurred, *suggested)
+    single = time.perf_counter() - start
+
+    sheet = sweep.contact_sheet(lows, highs, args.cell)
+    write_image(str(args.output), sheet.image)
+    print(f"[OK] {pairs} threshold pairs in {elapsed * 1e3:.1f} ms "
+          f"({elapsed / single if single > 0 else 0:.1f}x one cv2.Canny call)")
+    print(f"   Suggested thresholds: {suggested[0]}/{suggested[1]}")
+    print(f"   Contact sheet: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,473 @@
+"""
+Streaming cine playback for ultrasound and fluoroscopy loops
+
+Frames of a cine loop (AVI/MP4 export, multi-frame DICOM or TIFF) flow
+through three generator stages - decode, process, display. Decode and
+process each run on their own thread and hand frames on through a small
+bounded queue, so decoding the next frame, processing the current one and
+showing the previous one overlap, and a slow stage holds the ones before it
+back instead of letting frames pile up.
+
+In real-time playback a clock fixes when every frame is due, starting from
+the first frame shown. Decode and process skip the frames that are already
+due before work is spent on them, and the display shows the newest frame
+that is due, so playback keeps the loop's frame rate when processing cannot
+and the dropped frames are counted per stage. Without real time every frame
+is processed in order, as fast as possible (exports).
+
+Usage:
+    python cine.py loop.avi --op enhance --clahe
+    python cine.py loop.dcm processed.avi --op edges --no-realtime
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from batch import add_processing_arguments, params_from_args
+from instrumentation import METRICS
+from loader import VIDEO_EXTENSIONS, FrameStack, open_stack
+from pipeline import run_operation
+from processing import ProcessingParams, to_display_depth
+
+# Used when the file does not record a frame rate.
+DEFAULT_FRAME_RATE = 25.0
+QUEUE_SIZE = 3
+STAGES = ("decode", "process", "display")
+
+# A frame index and the function that decodes it; skipped frames are never decoded.
+PendingFrame = Tuple[int, Callable[[], np.ndarray]]
+
+
+@dataclass
+class CineFrame:
+    sequence: int       # position in playback order, counting on across loops
+    index: int          # frame within the loop
+    image: np.ndarray
+
+
+class StackCine:
+    """Frames of a FrameStack (multi-frame DICOM, TIFF, NumPy)."""
+
+    def __init__(self, stack: FrameStack):
+        self.stack = stack
+        self.frame_count = len(stack)
+        self.frame_rate = stack.frame_rate or DEFAULT_FRAME_RATE
+
+    def frames(self, start: int = 0) -> Iterator[PendingFrame]:
+        for index in range(start, self.frame_count):
+            yield index, lambda index=index: self.stack.read_frame(index)
+
+    def close(self):
+        pass
+
+
+class VideoCine:
+    """Frames of a video file, read sequentially by a capture of its own.
+
+    Every frame is demuxed (grab), but only the frames that are kept are
+    converted to BGR (retrieve).
+    """
+
+    def __init__(self, path, frame_rate: Optional[float] = None):
+        self.path = Path(path)
+        self._capture = cv2.VideoCapture(str(self.path))
+        if not self._capture.isOpened():
+            raise ValueError(f"Cannot open video: {self.path}")
+        self.frame_count = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.frame_rate = frame_rate or self._capture.get(cv2.CAP_PROP_FPS) or DEFAULT_FRAME_RATE
+
+    def _retrieve(self, index: int) -> np.ndarray:
+        ok, frame = self._capture.retrieve()
+        if not ok:
+            raise ValueError(f"Cannot decode frame {index} of {self.path}")
+        return frame
+
+    def frames(self, start: int = 0) -> Iterator[PendingFrame]:
+        self._capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while self._capture.grab():
+            yield index, lambda index=index: self._retrieve(index)
+            index += 1
+
+    def close(self):
+        self._capture.release()
+
+
+def open_cine(source):
+    """A cine source for a path or an already opened FrameStack."""
+    if isinstance(source, FrameStack):
+        if source.path.suffix.lower() in VIDEO_EXTENSIONS:
+            return VideoCine(source.path, source.frame_rate)
+        return StackCine(source)
+    path = Path(source)
+    if path.suffix.lower() in VIDEO_EXTENSIONS:
+        return VideoCine(path)
+    return StackCine(open_stack(path))
+
+
+class RateMeter:
+    """Events per second over the last ``window`` seconds."""
+
+    def __init__(self, window: float = 1.0):
+        self.window = window
+        self._times: deque = deque()
+
+    def tick(self, now: float):
+        self._times.append(now)
+        while self._times and self._times[0] < now - self.window:
+            self._times.popleft()
+
+    def rate(self, now: float) -> float:
+        while self._times and self._times[0] < now - self.window:
+            self._times.popleft()
+        return len(self._times) / self.window
+
+
+class CineStats:
+    """Frames passed and dropped per stage, and the current rate of each stage."""
+
+    def __init__(self):
+        self.frames = {stage: 0 for stage in STAGES}
+        self.dropped = {stage: 0 for stage in STAGES}
+        self._meters = {stage: RateMeter() for stage in STAGES}
+        self._lock = threading.Lock()
+
+    def passed(self, stage: str):
+        with self._lock:
+            self.frames[stage] += 1
+            self._meters[stage].tick(time.perf_counter())
+
+    def drop(self, stage: str):
+        with self._lock:
+            self.dropped[stage] += 1
+
+    def fps(self, stage: str) -> float:
+        with self._lock:
+            return self._meters[stage].rate(time.perf_counter())
+
+    @property
+    def total_dropped(self) -> int:
+        with self._lock:
+            return sum(self.dropped.values())
+
+    def as_dict(self) -> Dict:
+        return {stage: {"fps": self.fps(stage), "frames": self.frames[stage], "dropped": self.dropped[stage]}
+                for stage in STAGES}
+
+    def summary(self) -> str:
+        rates = " | ".join(f"{stage} {self.fps(stage):.1f} fps" for stage in STAGES)
+        drops = ", ".join(f"{stage} {self.dropped[stage]}" for stage in STAGES)
+        return f"{rates} | dropped {self.total_dropped} ({drops})"
+
+
+class PlaybackClock:
+    """When each frame is due; starts with the first frame shown."""
+
+    def __init__(self, frame_rate: float):
+        self.interval = 1.0 / frame_rate
+        self._origin: Optional[Tuple[int, float]] = None
+
+    @property
+    def started(self) -> bool:
+        return self._origin is not None
+
+    def begin(self, sequence: int, now: float):
+        self._origin = (sequence, now)
+
+    def due(self, sequence: int) -> float:
+        first, start = self._origin
+        return start + (sequence - first) * self.interval
+
+    def superseded(self, sequence: int, ready_in: float = 0.0) -> bool:
+        """True if the frame, ready ``ready_in`` seconds from now, would arrive
+        after the next frame is due. Never true before playback starts."""
+        origin = self._origin
+        if origin is None:
+            return False
+        return time.perf_counter() + ready_in > origin[1] + (sequence + 1 - origin[0]) * self.interval
+
+
+_END = object()
+
+
+class _Stage:
+    """Runs a frame generator on its own thread and buffers its output in a bounded queue."""
+
+    def __init__(self, name: str, frames: Iterator, stop: threading.Event, maxsize: int = QUEUE_SIZE):
+        self.name = name
+        self.finished = False
+        self._frames = frames
+        self._stop = stop
+        self._queue: "queue.Queue" = queue.Queue(maxsize)
+        self._thread = threading.Thread(target=self._run, name=f"cine-{name}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    def _put(self, item) -> bool:
+        # Blocks while the next stage is behind: that is the backpressure.
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self):
+        try:
+            for item in self._frames:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(e)
+        self._put(_END)
+
+    def get(self, timeout: Optional[float] = None):
+        """The next item, or None when there is none within ``timeout`` or the stream ended."""
+        if self.finished:
+            return None
+        try:
+            item = self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait()
+        except queue.Empty:
+            return None
+        if item is _END:
+            self.finished = True
+            return None
+        if isinstance(item, Exception):
+            self.finished = True
+            raise item
+        return item
+
+    def __iter__(self):
+        while not self._stop.is_set():
+            item = self.get(timeout=0.05)
+            if item is None:
+                if self.finished:
+                    return
+                continue
+            yield item
+
+    def join(self, timeout: float = 2.0):
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+
+class CinePlayer:
+    """Plays a cine source through the processing pipeline.
+
+    ``next_frame`` is the display stage: call it at least as often as the
+    frame rate (e.g. from a GUI timer) and show what it returns. The
+    operation and parameters can be changed during playback.
+    """
+
+    def __init__(self, source, operation: Optional[str] = None, params: ProcessingParams = ProcessingParams(),
+                 realtime: bool = True, loop: bool = True, start: int = 0, queue_size: int = QUEUE_SIZE):
+        self.source = source
+        self.frame_rate = source.frame_rate
+        self.realtime = realtime
+        self.loop = loop
+        self.stats = CineStats()
+        self.clock = PlaybackClock(self.frame_rate)
+        self._settings = (operation, params)
+        # Moving average of the time to process one frame, in seconds.
+        self._process_time = 0.0
+        self._held: Optional[CineFrame] = None
+        self._stop = threading.Event()
+        self._decoded = _Stage("decode", self._decode(start), self._stop, queue_size)
+        self._processed = _Stage("process", self._process(iter(self._decoded)), self._stop, queue_size)
+        self._decoded.start()
+        self._processed.start()
+
+    @property
+    def finished(self) -> bool:
+        return self._processed.finished and self._held is None
+
+    def configure(self, operation: Optional[str], params: ProcessingParams):
+        # One tuple, replaced atomically: the process thread reads both together.
+        self._settings = (operation, params)
+
+    def _late(self, sequence: int, ready_in: float) -> bool:
+        return self.realtime and self.clock.superseded(sequence, ready_in)
+
+    def _decode(self, start: int) -> Iterator[CineFrame]:
+        sequence = 0
+        while not self._stop.is_set():
+            for index, decode in self.source.frames(start):
+                if self._stop.is_set():
+                    return
+                # Ready once the frames queued before it have been processed.
+                if self._late(sequence, (self._decoded.backlog + 1) * self._process_time):
+                    self.stats.drop("decode")
+                else:
+                    with METRICS.measure("cine_decode", "cine") as measurement:
+                        image = decode()
+                        measurement.set_result(image)
+                    self.stats.passed("decode")
+                    yield CineFrame(sequence, index, image)
+                sequence += 1
+            if not self.loop or sequence == 0:
+                return
+            start = 0
+
+    def _process(self, frames: Iterator[CineFrame]) -> Iterator[CineFrame]:
+        for frame in frames:
+            if self._late(frame.sequence, self._process_time):
+                self.stats.drop("process")
+                continue
+            started = time.perf_counter()
+            operation, params = self._settings
+            if operation is None:
+                image = to_display_depth(frame.image, params.data_range)
+            else:
+                image = run_operation(frame.image, operation, params, category="cine")
+            elapsed = time.perf_counter() - started
+            self._process_time = elapsed if not self._process_time else 0.8 * self._process_time + 0.2 * elapsed
+            self.stats.passed("process")
+            yield replace(frame, image=image)
+
+    def next_frame(self) -> Optional[CineFrame]:
+        """The frame to show now, or None to keep showing the current one."""
+        if not self.realtime:
+            frame = self._processed.get()
+            if frame is not None:
+                self.stats.passed("display")
+            return frame
+
+        now = time.perf_counter()
+        shown = None
+        while True:
+            frame, self._held = self._held or self._processed.get(), None
+            if frame is None:
+                break
+            if not self.clock.started:
+                self.clock.begin(frame.sequence, now)
+            if self.clock.due(frame.sequence) > now:
+                self._held = frame  # early: shown on a later call
+                break
+            if shown is not None:
+                self.stats.drop("display")
+            shown = frame
+        if shown is not None:
+            self.stats.passed("display")
+        return shown
+
+    def wait_frame(self, timeout: float = 1.0) -> Optional[CineFrame]:
+        """Blocking next_frame for headless playback."""
+        deadline = time.perf_counter() + timeout
+        while not self.finished:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, self.clock.interval / 4))
+        return None
+
+    def close(self):
+        self._stop.set()
+        self._processed.join()
+        self._decoded.join()
+        self.source.close()
+
+    def __enter__(self) -> "CinePlayer":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _video_writer(path: Path, frame: np.ndarray, frame_rate: float) -> cv2.VideoWriter:
+    fourcc = "mp4v" if path.suffix.lower() in (".mp4", ".m4v", ".mov") else "MJPG"
+    height, width = frame.shape[:2]
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*fourcc), frame_rate, (width, height),
+                             isColor=frame.ndim == 3)
+    if not writer.isOpened():
+        raise ValueError(f"Cannot write video: {path}")
+    return writer
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Play or export a cine loop through the processing pipeline")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path, nargs="?", default=None, help="processed video (.avi or .mp4)")
+    add_processing_arguments(parser)
+    parser.add_argument("--raw", action="store_true", help="no processing, only decode and display")
+    parser.add_argument("--no-realtime", action="store_true",
+                        help="process every frame as fast as possible instead of at the frame rate")
+    parser.add_argument("--fps", type=float, default=None, help="override the file's frame rate")
+    parser.add_argument("--loop", action="store_true", help="repeat the loop until --duration")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of looped playback")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if not args.input.exists():
+        print(f"[ERROR] Input file not found: {args.input}")
+        return 2
+
+    source = open_cine(args.input)
+    if args.fps:
+        source.frame_rate = args.fps
+    params = params_from_args(args)
+    if isinstance(source, StackCine):
+        first = source.stack.read_frame(0)
+        if first.dtype != np.uint8:
+            # One window for the whole loop, so frames do not flicker.
+            params = replace(params, data_range=(float(first.min()), float(first.max())))
+    operation = None if args.raw else args.op
+
+    writer = None
+    start = time.perf_counter()
+    last_report = start
+    with CinePlayer(source, operation, params, realtime=not args.no_realtime, loop=args.loop) as player:
+        print(f"[Cine] {source.frame_count} frames at {player.frame_rate:.1f} fps "
+              f"({operation or 'raw'}, {'real time' if player.realtime else 'every frame'})")
+        while not player.finished and time.perf_counter() - start < (args.duration if args.loop else float("inf")):
+            frame = player.wait_frame()
+            if frame is None:
+                continue
+            if args.output is not None:
+                if writer is None:
+                    writer = _video_writer(args.output, frame.image, player.frame_rate)
+                writer.write(frame.image)
+            now = time.perf_counter()
+            if now - last_report >= 1.0:
+                print(f"[Cine] {player.stats.summary()}")
+                last_report = now
+        elapsed = time.perf_counter() - start
+        stats = player.stats
+    if writer is not None:
+        writer.release()
+
+    shown = stats.frames["display"]
+    print(f"[OK] {shown} frames shown in {elapsed:.2f}s ({shown / elapsed if elapsed > 0 else 0:.1f} fps), "
+          f"{stats.total_dropped} dropped")
+    for stage in STAGES:
+        print(f"   {stage}: {stats.frames[stage]} frames, {stats.dropped[stage]} dropped")
+    if args.output is not None:
+        print(f"   Output: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+"""
+CLAHE split into its histogram, LUT and interpolation steps
+
+OpenCV's CLAHE works on the whole image at once. Splitting it into
+per-grid-tile histograms, clipped lookup tables and a bilinear interpolation
+step that can be applied to any region lets large images be processed piece
+by piece with the same output as a single cv2.createCLAHE(...).apply call.
+
+ClaheEngine is the entry point used by the pipeline: it keeps configured
+OpenCV instances per thread and, for very large 8-bit images, runs the split
+steps stripe by stripe on a thread pool, keeping the tile histograms so a
+change of clip limit alone only rebuilds the lookup tables.
+"""
+
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple
+
+import cv2
+import numpy as np
+
+HIST_SIZE = 256
+
+
+class ClaheGrid:
+    """Geometry of the CLAHE tile grid for an image of a given size.
+
+    Like OpenCV, the image is extended with a reflected border on the bottom
+    and right when its size is not a multiple of the grid.
+    """
+
+    def __init__(self, height: int, width: int, tile_grid_size=(8, 8)):
+        self.height = height
+        self.width = width
+        self.tiles_x, self.tiles_y = tile_grid_size
+        pad_y = pad_x = 0
+        if height % self.tiles_y or width % self.tiles_x:
+            # OpenCV pads both axes as soon as either is not a multiple of
+            # the grid, adding a full grid count on an axis that already is.
+            pad_y = self.tiles_y - height % self.tiles_y
+            pad_x = self.tiles_x - width % self.tiles_x
+        self.padded_height = height + pad_y
+        self.padded_width = width + pad_x
+        self.tile_height = self.padded_height // self.tiles_y
+        self.tile_width = self.padded_width // self.tiles_x
+
+    @property
+    def tile_area(self) -> int:
+        return self.tile_height * self.tile_width
+
+    def padded_indices(self, start: int, stop: int, size: int) -> np.ndarray:
+        # Map padded coordinates back to source coordinates (BORDER_REFLECT_101).
+        # The border can be wider than the image when it is smaller than the
+        # grid, so reflect repeatedly like cv2.borderInterpolate does.
+        idx = np.arange(start, stop)
+        if size == 1:
+            return np.zeros_like(idx)
+        period = 2 * (size - 1)
+        idx %= period
+        over = idx >= size
+        idx[over] = period - idx[over]
+        return idx
+
+
+def empty_histograms(grid: ClaheGrid) -> np.ndarray:
+    return np.zeros((grid.tiles_y, grid.tiles_x, HIST_SIZE), dtype=np.int64)
+
+
+def accumulate_histograms(hist: np.ndarray, grid: ClaheGrid, block: np.ndarray, y0: int, x0: int):
+    """Add an 8-bit block located at (y0, x0) in padded coordinates to ``hist``."""
+    h, w = block.shape[:2]
+    ty_first, ty_last = y0 // grid.tile_height, (y0 + h - 1) // grid.tile_height
+    tx_first, tx_last = x0 // grid.tile_width, (x0 + w - 1) // grid.tile_width
+    for ty in range(ty_first, ty_last + 1):
+        ya = max(ty * grid.tile_height, y0) - y0
+        yb = min((ty + 1) * grid.tile_height, y0 + h) - y0
+        for tx in range(tx_first, tx_last + 1):
+            xa = max(tx * grid.tile_width, x0) - x0
+            xb = min((tx + 1) * grid.tile_width, x0 + w) - x0
+            hist[ty, tx] += np.bincount(block[ya:yb, xa:xb].ravel(), minlength=HIST_SIZE)
+
+
+def compute_histograms(gray: np.ndarray, grid: ClaheGrid) -> np.ndarray:
+    rows = grid.padded_indices(0, grid.padded_height, grid.height)
+    cols = grid.padded_indices(0, grid.padded_width, grid.width)
+    padded = gray
+    if grid.padded_height != grid.height or grid.padded_width != grid.width:
+        padded = cv2.copyMakeBorder(gray, 0, len(rows) - grid.height, 0, len(cols) - grid.width,
+                                    cv2.BORDER_REFLECT_101)
+    hist = empty_histograms(grid)
+    accumulate_histograms(hist, grid, padded, 0, 0)
+    return hist
+
+
+def compute_luts(hist: np.ndarray, grid: ClaheGrid, clip_limit: float) -> np.ndarray:
+    """Clip and redistribute the tile histograms and integrate them to LUTs."""
+    hist = hist.copy()
+    if clip_limit > 0.0:
+        limit = max(int(clip_limit * grid.tile_area / HIST_SIZE), 1)
+        clipped = np.maximum(hist - limit, 0).sum(axis=2)
+        np.minimum(hist, limit, out=hist)
+
+        redist_batch = clipped // HIST_SIZE
+        residual = clipped - redist_batch * HIST_SIZE
+        hist += redist_batch[..., None]
+
+        # The residual is spread one count at a time with a fixed stride.
+        bins = np.arange(HIST_SIZE)
+        step = np.maximum(HIST_SIZE // np.maximum(residual, 1), 1)
+        extra = (bins % step[..., None] == 0) & (bins // step[..., None] < residual[..., None])
+        hist += extra
+
+    lut_scale = np.float32(HIST_SIZE - 1) / np.float32(grid.tile_area)
+    cumulative = np.cumsum(hist, axis=2).astype(np.float32)
+    return np.clip(np.rint(cumulative * lut_scale), 0, 255).astype(np.uint8)
+
+
+def _interpolation_runs(start: int, stop: int, tile_size: int, tiles: int):
+    # Coordinates sharing the same pair of neighbouring tiles, together with
+    # their interpolation weights.
+    inv = np.float32(1.0) / np.float32(tile_size)
+    pos = np.arange(start, stop, dtype=np.float32) * inv - np.float32(0.5)
+    first = np.floor(pos).astype(np.int64)
+    weight = (pos - first.astype(np.float32)).astype(np.float32)
+    low = np.maximum(first, 0)
+    high = np.minimum(first + 1, tiles - 1)
+    breaks = np.flatnonzero(np.diff(first)) + 1
+    bounds = np.concatenate(([0], breaks, [len(pos)]))
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        if a < b:
+            yield a, b, int(low[a]), int(high[a]), weight[a:b]
+
+
+def apply_luts(block: np.ndarray, luts: np.ndarray, grid: ClaheGrid, y0: int = 0, x0: int = 0,
+               out: np.ndarray = None) -> np.ndarray:
+    """Apply CLAHE to an 8-bit block located at (y0, x0) in the source image."""
+    h, w = block.shape[:2]
+    if out is None:
+        out = np.empty_like(block)
+    one = np.float32(1.0)
+    for ya, yb, ty1, ty2, wy in _interpolation_runs(y0, y0 + h, grid.tile_height, grid.tiles_y):
+        wy = wy[:, None]
+        for xa, xb, tx1, tx2, wx in _interpolation_runs(x0, x0 + w, grid.tile_width, grid.tiles_x):
+            src = block[ya:yb, xa:xb]
+            top = (cv2.LUT(src, luts[ty1, tx1]).astype(np.float32) * (one - wx)
+                   + cv2.LUT(src, luts[ty1, tx2]).astype(np.float32) * wx)
+            bottom = (cv2.LUT(src, luts[ty2, tx1]).astype(np.float32) * (one - wx)
+                      + cv2.LUT(src, luts[ty2, tx2]).astype(np.float32) * wx)
+            res = top * (one - wy) + bottom * wy
+            out[ya:yb, xa:xb] = np.clip(np.rint(res), 0, 255)
+    return out
+
+
+def streamed_luts(read_gray: Callable[[int, int, int, int], np.ndarray], grid: ClaheGrid,
+                  clip_limit: float, band_rows: int) -> np.ndarray:
+    """Build the CLAHE LUTs from a source read in horizontal bands.
+
+    ``read_gray(y0, y1, x0, x1)`` must return the 8-bit grayscale source
+    region; padded border rows and columns are synthesised from it.
+    """
+    hist = empty_histograms(grid)
+    cols = grid.padded_indices(0, grid.padded_width, grid.width)
+    for y0 in range(0, grid.padded_height, band_rows):
+        y1 = min(y0 + band_rows, grid.padded_height)
+        rows = grid.padded_indices(y0, y1, grid.height)
+        lo, hi = int(rows.min()), int(rows.max()) + 1
+        band = read_gray(lo, hi, 0, grid.width)
+        if y1 > grid.height or len(cols) > grid.width:
+            band = band[np.ix_(rows - lo, cols)]
+        accumulate_histograms(hist, grid, band, y0, 0)
+    return compute_luts(hist, grid, clip_limit)
+
+
+def clahe_reference(gray: np.ndarray, clip_limit: float = 2.0,
+                    tile_grid_size: Tuple[int, int] = (8, 8)) -> np.ndarray:
+    grid = ClaheGrid(gray.shape[0], gray.shape[1], tile_grid_size)
+    luts = compute_luts(compute_histograms(gray, grid), grid, clip_limit)
+    return apply_luts(gray, luts, grid)
+
+
+def _stripes(count: int, parts: int):
+    bounds = np.linspace(0, count, min(parts, count) + 1).astype(int)
+    return [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if a < b]
+
+
+class ClaheEngine:
+    """Cached CLAHE configurations with stripe-parallel execution for large images.
+
+    Small images (and 16-bit data) go through an OpenCV CLAHE instance cached
+    per thread and (clip limit, grid), since instances are not thread-safe.
+    8-bit images of at least ``split_pixels`` pixels are split into
+    horizontal stripes: tile histograms by stripes of tile rows, then the
+    interpolation by stripes of pixel rows, with output identical to OpenCV.
+    The histograms of recent read-only images are kept, so re-running with
+    only a different clip limit skips the histogram pass.
+    """
+
+    def __init__(self, workers: Optional[int] = None, split_pixels: int = 16_000_000,
+                 max_instances: int = 8, max_histograms: int = 4):
+        self.workers = workers or os.cpu_count() or 1
+        self.split_pixels = split_pixels
+        self.max_instances = max_instances
+        self.max_histograms = max_histograms
+        self.histogram_hits = 0
+        self.histogram_misses = 0
+        self._local = threading.local()
+        self._histograms: "OrderedDict[tuple, Tuple[weakref.ref, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def instance(self, clip_limit: float, tile_grid_size: Tuple[int, int]):
+        instances = getattr(self._local, "instances", None)
+        if instances is None:
+            instances = self._local.instances = OrderedDict()
+        key = (float(clip_limit), tuple(tile_grid_size))
+        clahe = instances.get(key)
+        if clahe is None:
+            clahe = cv2.createCLAHE(clipLimit=key[0], tileGridSize=key[1])
+            instances[key] = clahe
+            while len(instances) > self.max_instances:
+                instances.popitem(last=False)
+        else:
+            instances.move_to_end(key)
+        return clahe
+
+    def apply(self, gray: np.ndarray, clip_limit: float = 2.0,
+              tile_grid_size: Tuple[int, int] = (8, 8)) -> np.ndarray:
+        if gray.dtype != np.uint8 or self.workers <= 1 or gray.size < self.split_pixels:
+            return self.instance(clip_limit, tile_grid_size).apply(gray)
+
+        grid = ClaheGrid(gray.shape[0], gray.shape[1], tile_grid_size)
+        luts = compute_luts(self.histograms(gray, grid), grid, clip_limit)
+        out = np.empty_like(gray)
+
+        def interpolate(y0: int, y1: int):
+            apply_luts(gray[y0:y1], luts, grid, y0, 0, out=out[y0:y1])
+
+        self._run(interpolate, _stripes(grid.height, self.workers * 2))
+        return out
+
+    def histograms(self, gray: np.ndarray, grid: ClaheGrid) -> np.ndarray:
+        """Tile histograms of ``gray``, reused while the same read-only array is passed."""
+        key = (id(gray), grid.tiles_y, grid.tiles_x)
+        with self._lock:
+            cached = self._histograms.get(key)
+            if cached is not None and cached[0]() is gray:
+                self._histograms.move_to_end(key)
+                self.histogram_hits += 1
+                return cached[1]
+            self.histogram_misses += 1
+
+        hist = empty_histograms(grid)
+        cols = grid.padded_indices(0, grid.padded_width, grid.width)
+        padded = grid.padded_height != grid.height or grid.padded_width != grid.width
+
+        def accumulate(row0: int, row1: int):
+            # Each stripe owns whole tile rows, so no two stripes share a histogram.
+            y0, y1 = row0 * grid.tile_height, row1 * grid.tile_height
+            if padded:
+                block = gray[np.ix_(grid.padded_indices(y0, y1, grid.height), cols)]
+            else:
+                block = gray[y0:y1]
+            accumulate_histograms(hist, grid, block, y0, 0)
+
+        self._run(accumulate, _stripes(grid.tiles_y, self.workers))
+
+        if not gray.flags.writeable:
+            # Writable arrays may change in place, so only read-only ones
+            # (such as cached pipeline stages) are remembered.
+            with self._lock:
+                self._histograms[key] = (weakref.ref(gray), hist)
+                while len(self._histograms) > self.max_histograms:
+                    self._histograms.popitem(last=False)
+        return hist
+
+    def _run(self, func: Callable[[int, int], None], stripes):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="clahe")
+            executor = self._executor
+        for future in [executor.submit(func, a, b) for a, b in stripes]:
+            future.result()
+
+    def clear(self):
+        with self._lock:
+            self._histograms.clear()
+        self._local = threading.local()
@@ -0,0 +1,593 @@
+"""
+Local processing service shared by the GUI and scripts
+
+A long-lived server keeps a pool of warm worker processes (OpenCV loaded,
+CLAHE tables and kernels exercised once) and runs the same grayscale /
+enhance / edges operations as the GUI and batch.py for any local client.
+Requests travel over a Unix socket in a private per-user directory (a
+per-user named pipe on Windows), authenticated with a key only this user can
+read, and only carry
+the operation, its ProcessingParams and the name of a shared-memory block:
+the client copies the pixels into the block once, the worker processes them
+in place and writes the result back into the same block, so no image is
+ever pickled.
+
+Requests that arrive while every worker is busy are queued in the server
+and dispatched together as one task per worker as soon as workers free up
+(micro-batching); an idle server dispatches a request immediately. The
+pool never holds more than one task per worker, so requests are served in
+arrival order and the tail latency grows with the load instead of with the
+depth of a hidden backlog.
+
+Usage:
+    python daemon.py serve --workers 4 --cache-dir ~/.cache/medical-image-processor
+    python daemon.py process scan.png out.png --op edges --clahe
+    python daemon.py bench --clients 32 --requests 20 --size 512
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import getpass
+import os
+import re
+import secrets
+import stat
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from multiprocessing import AuthenticationError, shared_memory
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch import _init_worker, add_processing_arguments, params_from_args
+from disk_cache import DEFAULT_CACHE_MB, DiskCache, add_cache_arguments
+from pipeline import run_cached
+from processing import OPERATIONS, ProcessingParams, read_image, write_image
+
+# Socket and key live in a directory only this user can enter, so the socket
+# is never reachable by others, not even between bind() and a chmod().
+if sys.platform == "win32":
+    RUNTIME_DIR = Path(os.environ.get("LOCALAPPDATA", Path.home())) / "medical-image-processor"
+    DEFAULT_ADDRESS = r"\\.\pipe\medical-image-processor-" + re.sub(r"[^\w.-]", "_", getpass.getuser())
+elif "XDG_RUNTIME_DIR" in os.environ:
+    RUNTIME_DIR = Path(os.environ["XDG_RUNTIME_DIR"]) / "medical-image-processor"
+    DEFAULT_ADDRESS = str(RUNTIME_DIR / "daemon.sock")
+else:
+    RUNTIME_DIR = Path(tempfile.gettempdir()) / f"medical-image-processor-{os.getuid()}"
+    DEFAULT_ADDRESS = str(RUNTIME_DIR / "daemon.sock")
+AUTHKEY_FILE = RUNTIME_DIR / "authkey"
+
+# Requests handed to one worker at once while the others are busy, and the
+# input pixels after which a batch is closed so large images do not queue
+# behind each other inside one worker.
+DEFAULT_MAX_BATCH = 8
+DEFAULT_BATCH_PIXELS = 1 << 20
+
+# (shared memory name, shape, dtype, block size, operation, params)
+Job = Tuple[str, Tuple[int, ...], str, int, str, ProcessingParams]
+
+
+def private_directory(path) -> Path:
+    """``path`` as a directory only this user can access, created with mode 0700 if missing."""
+    path = Path(path)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if sys.platform != "win32":
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise PermissionError(f"{path} must be a directory owned by this user with mode 0700")
+    return path
+
+
+def load_authkey(path=AUTHKEY_FILE) -> bytes:
+    """The per-user key server and clients authenticate with, created (mode 0600) on first use."""
+    path = Path(path)
+    private_directory(path.parent)
+    if not path.exists():
+        fd, temporary = tempfile.mkstemp(dir=path.parent)  # mode 0600
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_bytes(32))
+            try:
+                os.link(temporary, path)  # atomic, so nobody reads a half-written key
+            except FileExistsError:
+                pass  # created by another process meanwhile
+        finally:
+            os.unlink(temporary)
+    with open(path, "rb") as f:
+        if sys.platform != "win32":
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.getuid() or info.st_mode & 0o077:
+                raise PermissionError(f"{path} must be owned by this user with mode 0600")
+        return f.read()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    block = shared_memory.SharedMemory(name)
+    if os.name == "posix":
+        # Before 3.13 attaching registers the block with the resource tracker,
+        # which would unlink the client's block when the server exits.
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+_WORKER_CACHE: Optional[DiskCache] = None
+
+
+def _init_daemon_worker(cache_dir: Optional[str], cache_bytes: int):
+    global _WORKER_CACHE
+    _init_worker(cache_dir, cache_bytes)
+    from batch import _DISK_CACHE
+    _WORKER_CACHE = _DISK_CACHE
+    # First calls build OpenCV's kernels and the CLAHE tables; pay for them now.
+    sample = np.zeros((64, 64, 3), dtype=np.uint8)
+    for operation in OPERATIONS:
+        run_cached(sample, operation, ProcessingParams(use_clahe=True), None)
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _process_job(job: Job) -> Tuple[Tuple[int, ...], str, float]:
+    name, shape, dtype, size, operation, params = job
+    block = _attach(name)
+    try:
+        start = time.perf_counter()
+        image = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        result = run_cached(image, operation, params, _WORKER_CACHE)
+        del image
+        if result.nbytes > size:
+            raise ValueError(f"Result ({result.nbytes} bytes) does not fit the {size} byte block")
+        # The result overwrites the input in the client's block.
+        np.ndarray(result.shape, dtype=result.dtype, buffer=block.buf)[...] = result
+        return tuple(result.shape), result.dtype.str, (time.perf_counter() - start) * 1e3
+    finally:
+        block.close()
+
+
+def _process_batch(jobs: List[Job]) -> List[Tuple[bool, object]]:
+    results = []
+    for job in jobs:
+        try:
+            results.append((True, _process_job(job)))
+        except Exception as e:
+            results.append((False, f"{type(e).__name__}: {e}"))
+    return results
+
+
+class _Request:
+    __slots__ = ("job", "reply", "received", "pixels")
+
+    def __init__(self, job: Job, reply: Callable[[dict], None]):
+        self.job = job
+        self.reply = reply
+        self.received = time.perf_counter()
+        self.pixels = job[1][0] * job[1][1]
+
+
+class ProcessingServer:
+    """Accepts clients on ``address`` and runs their requests on a warm process pool."""
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, workers: Optional[int] = None,
+                 max_batch: int = DEFAULT_MAX_BATCH, batch_pixels: int = DEFAULT_BATCH_PIXELS,
+                 cache_dir=None, cache_bytes: int = DEFAULT_CACHE_MB << 20, authkey: Optional[bytes] = None):
+        self.address = address
+        self._authkey = authkey if authkey is not None else load_authkey()
+        self.workers = workers or os.cpu_count() or 1
+        self.max_batch = max_batch
+        self.batch_pixels = batch_pixels
+        self.served = 0
+        self.failed = 0
+        self.batches = 0
+        self.latencies: Deque[float] = deque(maxlen=10000)
+        self._pending: Deque[_Request] = deque()
+        self._busy = 0
+        self._closing = False
+        self._closed = threading.Event()
+        self._ready = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+        if sys.platform != "win32":
+            private_directory(os.path.dirname(os.path.abspath(address)))
+        if sys.platform != "win32" and os.path.exists(address):
+            try:
+                Client(address, authkey=self._authkey).close()
+            except OSError:
+                os.unlink(address)  # left behind by a server that did not shut down
+            except AuthenticationError:
+                raise RuntimeError(f"A processing daemon is already listening on {address}") from None
+            else:
+                raise RuntimeError(f"A processing daemon is already listening on {address}")
+
+        cache_dir = str(cache_dir) if cache_dir is not None else None
+        # The pool is started and warmed before any thread exists, so the
+        # worker processes are forked from a single-threaded server.
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_daemon_worker,
+                                         initargs=(cache_dir, cache_bytes))
+        wait([self._pool.submit(_ready) for _ in range(self.workers)])
+
+        self._listener = Listener(address, authkey=self._authkey)
+
+    def start(self) -> "ProcessingServer":
+        """Serve on background threads; see serve_forever() for the blocking variant."""
+        for target in (self._dispatch_loop, self._accept_loop):
+            thread = threading.Thread(target=target, name=f"daemon-{target.__name__.strip('_')}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self._closing:
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        with self._ready:
+            closing_elsewhere = self._closing
+            self._closing = True
+            self._ready.notify_all()
+        if closing_elsewhere:
+            self._closed.wait()
+            return
+        try:
+            # Wakes the accept loop, which is blocked in accept(). Without the
+            # key, so this never waits for a handshake nobody answers.
+            Client(self.address).close()
+        except OSError:
+            pass
+        for thread in self._threads:
+            thread.join(5)
+        self._listener.close()
+        self._pool.shutdown(wait=True)
+        self._closed.set()
+
+    # -- connections ---------------------------------------------------
+
+    def _accept_loop(self):
+        while not self._closing:
+            try:
+                connection = self._listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError):
+                continue  # a client without the key, or one that hung up during the handshake
+            except OSError:
+                break
+            if self._closing:
+                connection.close()
+                break
+            threading.Thread(target=self._serve_connection, args=(connection,),
+                             name="daemon-connection", daemon=True).start()
+
+    def _serve_connection(self, connection: Connection):
+        send_lock = threading.Lock()
+
+        def reply(message: dict):
+            with send_lock:
+                try:
+                    connection.send(message)
+                except OSError:
+                    pass  # the client went away
+
+        try:
+            while True:
+                message = connection.recv()
+                kind = message.get("type")
+                if kind == "process":
+                    error = self._validate(message)
+                    if error:
+                        reply({"ok": False, "id": message.get("id"), "error": error})
+                        continue
+                    job = (message["shm"], tuple(message["shape"]), message["dtype"], message["size"],
+                           message["operation"], message["params"])
+                    self._submit(_Request(job, lambda response, id=message.get("id"): reply({**response, "id": id})))
+                elif kind == "stats":
+                    reply({"ok": True, "id": message.get("id"), **self.stats()})
+                elif kind == "shutdown":
+                    reply({"ok": True, "id": message.get("id")})
+                    threading.Thread(target=self.close, daemon=True).start()
+                    break
+                else:
+                    reply({"ok": False, "id": message.get("id"), "error": f"Unknown request '{kind}'"})
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _validate(message: dict) -> Optional[str]:
+        if message.get("operation") not in OPERATIONS:
+            return f"Unknown operation '{message.get('operation')}', expected one of {', '.join(OPERATIONS)}"
+        if not isinstance(message.get("params"), ProcessingParams):
+            return "'params' must be a ProcessingParams"
+        return None
+
+    # -- scheduling ----------------------------------------------------
+
+    def _submit(self, request: _Request):
+        with self._ready:
+            self._pending.append(request)
+            self._ready.notify()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._ready:
+                while not self._closing and (not self._pending or self._busy >= self.workers):
+                    self._ready.wait()
+                if self._closing:
+                    break
+                idle = self.workers - self._busy
+                # Oldest requests first, spread evenly over the idle workers.
+                share = min(self.max_batch, -(-len(self._pending) // idle))
+                chunks = []
+                while self._pending and len(chunks) < idle:
+                    chunk, pixels = [], 0
+                    while self._pending and len(chunk) < share and pixels < self.batch_pixels:
+                        request = self._pending.popleft()
+                        chunk.append(request)
+                        pixels += request.pixels
+                    chunks.append(chunk)
+                self._busy += len(chunks)
+                self.batches += len(chunks)
+            for chunk in chunks:
+                future = self._pool.submit(_process_batch, [request.job for request in chunk])
+                future.add_done_callback(lambda f, chunk=chunk: self._finish(chunk, f))
+
+        for request in self._pending:
+            request.reply({"ok": False, "error": "Server is shutting down"})
+        self._pending.clear()
+
+    def _finish(self, chunk: List[_Request], future):
+        with self._ready:
+            self._busy -= 1
+            self._ready.notify()
+        try:
+            results = future.result()
+        except Exception as e:  # a worker died
+            results = [(False, f"{type(e).__name__}: {e}")] * len(chunk)
+        done = time.perf_counter()
+        for request, (ok, value) in zip(chunk, results):
+            latency = (done - request.received) * 1e3
+            if ok:
+                shape, dtype, process_ms = value
+                request.reply({"ok": True, "shape": shape, "dtype": dtype, "process_ms": process_ms,
+                               "server_ms": latency, "batch": len(chunk)})
+            else:
+                request.reply({"ok": False, "error": value})
+            with self._ready:
+                self.latencies.append(latency)
+                if ok:
+                    self.served += 1
+                else:
+                    self.failed += 1
+
+    def stats(self) -> Dict:
+        with self._ready:
+            latencies = sorted(self.latencies)
+            queued, busy = len(self._pending), self._busy
+            served, failed, batches = self.served, self.failed, self.batches
+        return {
+            "workers": self.workers,
+            "served": served,
+            "failed": failed,
+            "queued": queued,
+            "busy": busy,
+            "mean_batch": (served + failed) / batches if batches else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if latencies else 0.0,
+            "p99_ms": float(np.percentile(latencies, 99)) if latencies else 0.0,
+        }
+
+
+class DaemonClient:
+    """Connection to a ProcessingServer with a reusable shared-memory block.
+
+    One request is in flight at a time; calls from several threads are
+    serialized. Raises ConnectionError when no server is listening or it
+    does not accept this user's key.
+    """
+
+    def __init__(self, address: str = DEFAULT_ADDRESS, authkey: Optional[bytes] = None):
+        self.address = address
+        try:
+            self._connection = Client(address, authkey=authkey if authkey is not None else load_authkey())
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            raise ConnectionError(f"No processing daemon at {address}") from e
+        except AuthenticationError as e:
+            raise ConnectionError(f"The processing daemon at {address} rejected this user's key") from e
+        self._block: Optional[shared_memory.SharedMemory] = None
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.last_response: Dict = {}
+
+    def _request(self, message: dict) -> dict:
+        self._next_id += 1
+        message["id"] = self._next_id
+        self._connection.send(message)
+        response = self._connection.recv()
+        if not response.get("ok"):
+            raise RuntimeError(f"Processing daemon: {response.get('error')}")
+        return response
+
+    def _ensure_block(self, size: int) -> shared_memory.SharedMemory:
+        if self._block is None or self._block.size < size:
+            self._release_block()
+            # Some headroom so slightly larger images do not reallocate.
+            self._block = shared_memory.SharedMemory(create=True, size=size + size // 4)
+        return self._block
+
+    def _release_block(self):
+        if self._block is not None:
+            self._block.close()
+            self._block.unlink()
+            self._block = None
+
+    def process(self, image: np.ndarray, operation: str, params: ProcessingParams = ProcessingParams()) -> np.ndarray:
+        """Same result as run_operation(image, operation, params)."""
+        with self._lock:
+            # Results are single-channel and at most 16 bits deep.
+            size = max(image.nbytes, image.shape[0] * image.shape[1] * 2, 1)
+            block = self._ensure_block(size)
+            np.ndarray(image.shape, dtype=image.dtype, buffer=block.buf)[...] = image
+            response = self._request({"type": "process", "operation": operation, "params": params,
+                                      "shm": block.name, "shape": tuple(image.shape),
+                                      "dtype": image.dtype.str, "size": block.size})
+            self.last_response = response
+            return np.ndarray(response["shape"], dtype=response["dtype"], buffer=block.buf).copy()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            response = self._request({"type": "stats"})
+        return {key: value for key, value in response.items() if key not in ("ok", "id")}
+
+    def shutdown(self):
+        with self._lock:
+            self._request({"type": "shutdown"})
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+            self._release_block()
+
+    def __enter__(self) -> "DaemonClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_load(address: str, image: np.ndarray, operation: str, params: ProcessingParams,
+             clients: int, requests: int) -> Tuple[List[float], float]:
+    """Latencies (ms) of ``clients`` concurrent clients sending ``requests`` each, and the wall time."""
+    latencies: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(clients + 1)
+
+    def client():
+        with DaemonClient(address) as daemon:
+            daemon.process(image, operation, params)  # allocates the block
+            barrier.wait()
+            for _ in range(requests):
+                start = time.perf_counter()
+                try:
+                    daemon.process(image, operation, params)
+                except RuntimeError as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                with lock:
+                    latencies.append((time.perf_counter() - start) * 1e3)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    for error in errors[:5]:
+        print(f"[ERROR] {error}")
+    return latencies, time.perf_counter() - start
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Local processing daemon for the GUI and scripts")
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="socket path (named pipe on Windows)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="run the daemon until interrupted")
+    serve.add_argument("--workers", type=int, default=None, help="worker processes (default: all cores)")
+    serve.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH,
+                       help="requests dispatched to one worker at once under load")
+    serve.add_argument("--batch-pixels", type=int, default=DEFAULT_BATCH_PIXELS,
+                       help="input pixels after which a batch is closed")
+    add_cache_arguments(serve)
+
+    process = commands.add_parser("process", help="process one image through a running daemon")
+    process.add_argument("input", type=Path)
+    process.add_argument("output", type=Path)
+    add_processing_arguments(process)
+
+    bench = commands.add_parser("bench", help="measure latency under concurrent clients")
+    add_processing_arguments(bench)
+    bench.add_argument("--clients", type=int, default=32, help="concurrent clients")
+    bench.add_argument("--requests", type=int, default=20, help="requests per client")
+    bench.add_argument("--size", type=int, default=512, help="synthetic image size")
+    bench.add_argument("--workers", type=int, default=None,
+                       help="start a daemon with this many workers (default: use the one at --address, "
+                            "or start one on all cores)")
+    bench.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH)
+    bench.add_argument("--batch-pixels", type=int, default=DEFAULT_BATCH_PIXELS)
+
+    commands.add_parser("stop", help="shut a running daemon down")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if args.command == "serve":
+        server = ProcessingServer(args.address, args.workers, args.max_batch, args.batch_pixels,
+                                  args.cache_dir, args.cache_size << 20)
+        print(f"[Daemon] {server.workers} workers listening on {args.address}")
+        server.serve_forever()
+        return 0
+
+    if args.command == "stop":
+        with DaemonClient(args.address) as daemon:
+            daemon.shutdown()
+        print(f"[Daemon] Stopped {args.address}")
+        return 0
+
+    if args.command == "process":
+        if not args.input.is_file():
+            print(f"[ERROR] Input file not found: {args.input}")
+            return 2
+        with DaemonClient(args.address) as daemon:
+            result = daemon.process(read_image(str(args.input)), args.op, params_from_args(args))
+            response = daemon.last_response
+        write_image(str(args.output), result)
+        print(f"[OK] {args.output} ({response['server_ms']:.1f} ms in the daemon, "
+              f"{response['process_ms']:.1f} ms processing)")
+        return 0
+
+    from benchmark import percentile, synthetic_image
+    server = None
+    if args.workers is not None or not os.path.exists(args.address):
+        address = os.path.join(tempfile.mkdtemp(), "bench.sock") if sys.platform != "win32" else args.address + "-bench"
+        server = ProcessingServer(address, args.workers, args.max_batch, args.batch_pixels).start()
+    else:
+        address = args.address
+    try:
+        latencies, elapsed = run_load(address, synthetic_image(args.size), args.op, params_from_args(args),
+                                      args.clients, args.requests)
+        with DaemonClient(address) as daemon:
+            stats = daemon.stats()
+    finally:
+        if server is not None:
+            server.close()
+
+    latencies.sort()
+    print(f"[Bench] {len(latencies)} requests from {args.clients} clients on {stats['workers']} workers "
+          f"in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} requests/sec)")
+    print(f"   Latency: p50 {percentile(latencies, 50):.1f} ms, p95 {percentile(latencies, 95):.1f} ms, "
+          f"p99 {percentile(latencies, 99):.1f} ms, max {latencies[-1]:.1f} ms")
+    print(f"   Mean batch: {stats['mean_batch']:.1f} requests")
+    return 0 if stats["failed"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""
+Persistent, content-addressed cache of processed images
+
+Entries are keyed by a hash of the decoded pixels plus everything that
+affects the output (operation and the full ProcessingParams: CLAHE clip and
+grid, brightness, contrast, Canny thresholds, focus level, data range), so a
+study opened again - in the GUI or by a headless run pointed at the same
+directory - is served from disk instead of being reprocessed. Images are
+stored as fast-compressed PNG (8 or 16 bit), written atomically, and the
+least recently used entries are evicted once the directory exceeds its size
+cap. Several processes may share one cache directory.
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple
+from pathlib import Path
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from instrumentation import METRICS
+from processing import ProcessingParams
+
+CACHE_VERSION = b"1"
+DEFAULT_CACHE_DIR = Path(os.environ.get("MEDICAL_IMAGE_CACHE",
+                                        Path.home() / ".cache" / "medical-image-processor"))
+DEFAULT_CACHE_MB = 2048
+# Fast zlib level with run-length matching: quick to encode and decode, and
+# the uniform background of most studies still compresses well.
+PNG_PARAMS = [cv2.IMWRITE_PNG_COMPRESSION, 1, cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+
+
+def image_digest(image: np.ndarray) -> str:
+    # SHA-256 is hardware accelerated on current CPUs, about twice as fast as
+    # BLAKE2 on large images.
+    digest = hashlib.sha256()
+    digest.update(f"{image.dtype.str}{image.shape}".encode())
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+
+def result_key(digest: str, operation: str, params: ProcessingParams, full_depth: bool = False) -> str:
+    key = hashlib.blake2b(CACHE_VERSION, digest_size=16)
+    key.update(repr((digest, operation, astuple(params), full_depth)).encode())
+    return key.hexdigest()
+
+
+def pyramid_key(digest: str, level: int) -> str:
+    key = hashlib.blake2b(CACHE_VERSION, digest_size=16)
+    key.update(repr((digest, "pyramid", level)).encode())
+    return key.hexdigest()
+
+
+def cacheable(image: np.ndarray) -> bool:
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    return image.dtype in (np.uint8, np.uint16) and channels in (1, 3, 4)
+
+
+class DiskCache:
+    """Directory of PNG entries with LRU eviction by file modification time.
+
+    With ``background`` writes are encoded on a helper thread so callers
+    never wait for compression; short-lived worker processes should pass
+    ``background=False`` so nothing is lost when they exit.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_MB << 20,
+                 background: bool = True):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        self._executor = (ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-cache")
+                          if background else None)
+
+    def path_for(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.png"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self.path_for(key)
+        with METRICS.measure("disk_cache_read", "load", detail=key[:8]) as measurement:
+            try:
+                data = np.fromfile(str(path), dtype=np.uint8)
+            except OSError:
+                data = None
+            image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED) if data is not None and data.size else None
+            measurement.cache_hit = image is not None
+            measurement.set_result(image)
+        with self._lock:
+            if image is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        try:
+            # Marks the entry as recently used for eviction.
+            os.utime(path)
+        except OSError:
+            pass
+        return image
+
+    def put(self, key: str, image: np.ndarray):
+        if not cacheable(image):
+            return
+        if self._executor is not None:
+            self._executor.submit(self._write, key, image)
+        else:
+            self._write(key, image)
+
+    def _write(self, key: str, image: np.ndarray):
+        path = self.path_for(key)
+        if path.exists():
+            return
+        with METRICS.measure("disk_cache_write", "save", detail=key[:8]) as measurement:
+            ok, buffer = cv2.imencode(".png", image, PNG_PARAMS)
+            if not ok:
+                return
+            path.parent.mkdir(exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            buffer.tofile(str(tmp))
+            os.replace(tmp, path)
+            measurement.output_bytes = buffer.size
+            measurement.shape = tuple(image.shape)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += buffer.size
+            over = self._size is None or self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def size(self) -> int:
+        return sum(entry.stat().st_size for entry in self.directory.glob("*/*.png"))
+
+    def evict(self):
+        """Delete the least recently used entries until the cache is below 90% of its cap."""
+        entries = []
+        for entry in self.directory.glob("*/*.png"):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # removed by another process
+            entries.append((stat.st_mtime, stat.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * 0.9
+            for _, size, entry in sorted(entries, key=lambda e: e[0]):
+                if total <= target:
+                    break
+                try:
+                    entry.unlink()
+                    total -= size
+                except OSError:
+                    pass
+        with self._lock:
+            self._size = total
+
+    def flush(self):
+        """Wait for the queued writes."""
+        if self._executor is not None:
+            self._executor.submit(lambda: None).result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+
+def add_cache_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--cache-dir", type=Path, default=None,
+                        help="reuse results from / store results in this cache directory")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_MB, help="cache size cap in MB")
+
+
+def cache_from_args(args: argparse.Namespace, background: bool = True) -> Optional[DiskCache]:
+    if args.cache_dir is None:
+        return None
+    return DiskCache(args.cache_dir, args.cache_size << 20, background=background)
@@ -0,0 +1,90 @@
+"""
+numpy -> QImage display adapter with reusable buffers
+
+Images are scaled to the display size before anything else touches them,
+resized straight into a buffer that is only reallocated when the display
+size or channel count changes, and wrapped as a QImage without copying:
+BGR data uses Format_BGR888, so no colour swap is needed. The QImage keeps a
+reference to the array it wraps, so the memory stays valid for as long as
+the QImage does.
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtGui import QImage
+
+from pyramid import fit_size
+
+_FORMATS = {1: QImage.Format_Grayscale8, 3: QImage.Format_BGR888, 4: QImage.Format_ARGB32}
+
+
+def to_qimage(img: np.ndarray) -> QImage:
+    """Wrap a uint8 grayscale, BGR or BGRA array as a QImage without copying.
+
+    Non-contiguous arrays (e.g. crops) are copied once first. The QImage holds
+    a reference to the array, so it can outlive the caller's variable.
+    """
+    if img.dtype != np.uint8:
+        raise ValueError(f"Display needs 8-bit data, got {img.dtype}")
+    channels = 1 if img.ndim == 2 else img.shape[2]
+    if channels not in _FORMATS:
+        raise ValueError(f"Cannot display an image with {channels} channels")
+    if not img.flags.c_contiguous:
+        img = np.ascontiguousarray(img)
+    h, w = img.shape[:2]
+    qimage = QImage(img.data, w, h, img.strides[0], _FORMATS[channels])
+    qimage._array = img
+    return qimage
+
+
+class DisplayBuffer:
+    """Preallocated destination for one display surface (main view, zoom window, ...)."""
+
+    def __init__(self):
+        self.array: Optional[np.ndarray] = None
+        self.qimage: Optional[QImage] = None
+        self.allocations = 0
+
+    def ensure(self, shape: Tuple[int, ...], device_pixel_ratio: float = 1.0) -> np.ndarray:
+        """The buffer with the given (height, width[, channels]), reallocated only on change."""
+        if self.array is None or self.array.shape != tuple(shape):
+            self.array = np.empty(shape, dtype=np.uint8)
+            self.qimage = to_qimage(self.array)
+            self.allocations += 1
+        self.qimage.setDevicePixelRatio(device_pixel_ratio)
+        return self.array
+
+    def resize_from(self, image: np.ndarray, width: int, height: int,
+                    interpolation: int = cv2.INTER_LINEAR, device_pixel_ratio: float = 1.0) -> QImage:
+        buffer = self.ensure((height, width) + image.shape[2:], device_pixel_ratio)
+        cv2.resize(image, (width, height), dst=buffer, interpolation=interpolation)
+        return self.qimage
+
+    def fit(self, image: np.ndarray, max_width: int, max_height: int,
+            interpolation: Optional[int] = None, device_pixel_ratio: float = 1.0) -> QImage:
+        """``image`` scaled to fit the box, keeping its aspect ratio.
+
+        An image that already has the fitted size is wrapped as it is.
+        """
+        h, w = image.shape[:2]
+        new_w, new_h = fit_size(w, h, max_width, max_height)
+        if (new_w, new_h) == (w, h):
+            qimage = to_qimage(image)
+            qimage.setDevicePixelRatio(device_pixel_ratio)
+            return qimage
+        if interpolation is None:
+            if h < 10 or w < 10:
+                interpolation = cv2.INTER_NEAREST
+            elif new_w < w:
+                interpolation = cv2.INTER_AREA
+            else:
+                interpolation = cv2.INTER_CUBIC
+        return self.resize_from(image, new_w, new_h, interpolation, device_pixel_ratio)
+
+    def release(self):
+        self.array = None
+        self.qimage = None
@@ -0,0 +1,175 @@
+"""
+Per-stage timing, output size, allocations and cache statistics
+
+Pipeline stages, image loads, display conversions and saves report a
+Measurement (wall time, bytes and dimensions of the produced image, cache
+hit or miss and, when tracking is enabled, the memory allocated on the way)
+to the shared METRICS collector. It keeps running totals per
+stage and a short history for the on-screen overlay, and can append every
+measurement to a JSON-lines log for later analysis.
+"""
+
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+
+@dataclass
+class Measurement:
+    name: str
+    category: str = "stage"
+    ms: float = 0.0
+    output_bytes: int = 0  # size of the produced image
+    # Peak memory allocated inside the measured block (Python objects and
+    # numpy / OpenCV arrays), None unless allocation tracking is enabled.
+    allocated_bytes: Optional[int] = None
+    shape: Optional[Tuple[int, ...]] = None
+    cache_hit: Optional[bool] = None
+    detail: str = ""
+    timestamp: float = field(default_factory=time.time)
+
+    def set_result(self, image: Optional[np.ndarray]):
+        if image is not None:
+            self.output_bytes = image.nbytes
+            self.shape = tuple(image.shape)
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    total_ms: float = 0.0
+    last_ms: float = 0.0
+    max_ms: float = 0.0
+    last_allocated: Optional[int] = None  # allocated_bytes of the last run that was not a cache hit
+    hits: int = 0
+    misses: int = 0
+    last: Optional[Measurement] = None
+
+    @property
+    def avg_ms(self) -> float:
+        # Cache hits take no time and would hide the cost of real runs.
+        runs = self.calls - self.hits
+        return self.total_ms / runs if runs > 0 else 0.0
+
+
+class Instrumentation:
+    """Thread-safe collector of Measurements."""
+
+    def __init__(self, history: int = 200):
+        self.history: Deque[Measurement] = deque(maxlen=history)
+        self.log_path: Optional[Path] = None
+        self._stats: Dict[Tuple[str, str], StageStats] = {}
+        self._log = None
+        self._lock = threading.Lock()
+        self.tracking_allocations = False
+        self._started_tracemalloc = False
+        # Per thread: [traced bytes at entry, highest peak seen] of the open
+        # measure() blocks, so nested blocks do not lose each other's peaks.
+        self._open_blocks = threading.local()
+
+    def track_allocations(self, enabled: bool = True):
+        """Record allocated_bytes for every following measure() block.
+
+        Uses tracemalloc, which slows allocation-heavy stages down. The peak
+        is process-wide, so blocks running on several threads at once
+        overlap in their counts.
+        """
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        elif not enabled and self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+        self.tracking_allocations = enabled
+
+    @contextmanager
+    def measure(self, name: str, category: str = "stage", detail: str = "") -> Iterator[Measurement]:
+        """Time the block; attach the produced image with ``set_result``."""
+        measurement = Measurement(name, category, detail=detail)
+        tracking = self.tracking_allocations and tracemalloc.is_tracing()
+        if tracking:
+            blocks = self._open_blocks.__dict__.setdefault("stack", [])
+            current, peak = tracemalloc.get_traced_memory()
+            if blocks:
+                blocks[-1][1] = max(blocks[-1][1], peak)
+            blocks.append([current, 0])
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            measurement.ms = (time.perf_counter() - start) * 1e3
+            if tracking:
+                entry, nested_peak = blocks.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], nested_peak)
+                measurement.allocated_bytes = max(0, peak - entry)
+                if blocks:
+                    blocks[-1][1] = max(blocks[-1][1], peak)
+            self.add(measurement)
+
+    def add(self, measurement: Measurement):
+        with self._lock:
+            stats = self._stats.setdefault((measurement.category, measurement.name), StageStats())
+            stats.calls += 1
+            stats.last = measurement
+            if measurement.cache_hit:
+                stats.hits += 1
+            else:
+                if measurement.cache_hit is False:
+                    stats.misses += 1
+                stats.total_ms += measurement.ms
+                stats.last_ms = measurement.ms
+                stats.max_ms = max(stats.max_ms, measurement.ms)
+                if measurement.allocated_bytes is not None:
+                    stats.last_allocated = measurement.allocated_bytes
+            self.history.append(measurement)
+            if self._log is not None:
+                self._log.write(json.dumps(asdict(measurement)) + "\n")
+                self._log.flush()
+
+    def stats(self, category: Optional[str] = None) -> List[Tuple[str, StageStats]]:
+        """(name, stats) pairs, slowest total first."""
+        with self._lock:
+            items = [(name, StageStats(**vars(stats)))
+                     for (cat, name), stats in self._stats.items()
+                     if category is None or cat == category]
+        return sorted(items, key=lambda item: item[1].total_ms, reverse=True)
+
+    def latest(self, category: str) -> Optional[Measurement]:
+        with self._lock:
+            for measurement in reversed(self.history):
+                if measurement.category == category:
+                    return measurement
+        return None
+
+    def open_log(self, path):
+        """Append every following measurement to ``path`` as one JSON object per line."""
+        self.close_log()
+        with self._lock:
+            self.log_path = Path(path)
+            self._log = open(self.log_path, "a", encoding="utf-8")
+
+    def close_log(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+            self._log = None
+            self.log_path = None
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.history.clear()
+
+
+METRICS = Instrumentation()
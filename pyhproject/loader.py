@@ -0,0 +1,566 @@
+"""
+Lazy, memory-mapped image loading with a cached multi-resolution pyramid
+
+Sources that support random access (NumPy files, raw dumps, TIFF, DICOM) are
+memory-mapped or read segment by segment instead of being decoded up front.
+Pyramid levels are built on first access, directly from the nearest finer
+level already available, and cached so the main display, preview proxies and
+zoom windows only touch the level and region they need.
+
+Multi-frame files (DICOM, multi-page TIFF, NumPy stacks, cine videos) open as
+a FrameStack whose frames are only mapped or decoded when requested. DICOM
+data keeps its native bit depth with the modality rescale (slope/intercept)
+applied.
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from pyramid import fit_size, pyramid_level_for
+from tiled import ArraySource, TiffSource, optional_tifffile
+
+# Levels above this size are not kept in the cache (level 0 is never cached:
+# it is the memory-mapped source itself).
+DEFAULT_CACHE_BYTES = 512 << 20
+
+DICOM_EXTENSIONS = (".dcm", ".dicom")
+# Ultrasound / fluoroscopy cine exports, decoded with OpenCV's video backend.
+VIDEO_EXTENSIONS = (".avi", ".mp4", ".m4v", ".mov", ".mkv", ".wmv", ".mpg", ".mpeg")
+_PIXEL_DATA = 0x7FE00010
+
+
+@lru_cache(maxsize=None)
+def optional_pydicom():
+    """The pydicom module, or None when it is not installed; imported on first use."""
+    try:
+        import pydicom
+        import pydicom.pixels
+    except ImportError:
+        return None
+    return pydicom
+
+
+def _require_pydicom():
+    pydicom = optional_pydicom()
+    if pydicom is None:
+        raise ImportError("DICOM support requires the 'pydicom' package, version 3 or later "
+                          "(pip install pydicom)")
+    return pydicom
+
+
+def is_dicom(path) -> bool:
+    path = Path(path)
+    if path.suffix.lower() in DICOM_EXTENSIONS:
+        return True
+    if path.suffix:
+        return False
+    # Extensionless files, as written by most scanners: check the preamble.
+    try:
+        with open(path, "rb") as f:
+            f.seek(128)
+            return f.read(4) == b"DICM"
+    except OSError:
+        return False
+
+
+def stored_range(bits_stored: int, signed: bool) -> Tuple[int, int]:
+    """Smallest and largest value of ``bits_stored``-bit pixel data."""
+    if signed:
+        return -(1 << (bits_stored - 1)), (1 << (bits_stored - 1)) - 1
+    return 0, (1 << bits_stored) - 1
+
+
+def rescaled_dtype(dtype, bits_stored: int, signed: bool, slope: float, intercept: float) -> np.dtype:
+    """dtype holding every stored value after ``value * slope + intercept``."""
+    if slope == 1 and intercept == 0:
+        return np.dtype(dtype)
+    if float(slope).is_integer() and float(intercept).is_integer():
+        lo, hi = stored_range(bits_stored, signed)
+        ends = (lo * slope + intercept, hi * slope + intercept)
+        info = np.iinfo(np.int16)
+        if info.min <= min(ends) and max(ends) <= info.max:
+            return np.dtype(np.int16)
+    # float32 holds any 16-bit value exactly and, unlike int32, is supported
+    # by the OpenCV resize used for pyramid levels.
+    return np.dtype(np.float32)
+
+
+class RescaledSource:
+    """Region reader applying a modality rescale (slope/intercept) to another source."""
+
+    def __init__(self, source, slope: float, intercept: float, dtype):
+        self.source = source
+        self.slope = slope
+        self.intercept = intercept
+        self.shape = source.shape
+        self.dtype = np.dtype(dtype)
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        region = self.source.read(y0, y1, x0, x1)
+        if self.slope == 1 and self.intercept == 0:
+            return region
+        out = region.astype(self.dtype)
+        if self.dtype.kind == "f":
+            out *= np.float32(self.slope)
+            out += np.float32(self.intercept)
+        else:
+            if self.slope != 1:
+                out *= int(self.slope)
+            out += int(self.intercept)
+        return out
+
+    def close(self):
+        self.source.close()
+
+
+class InvertedSource:
+    """Region reader mirroring another source's values within [lo, hi].
+
+    MONOCHROME1 pixel data shows its minimum as white; mirroring it gives
+    the MONOCHROME2 convention every later stage assumes.
+    """
+
+    def __init__(self, source, lo: float, hi: float):
+        self.source = source
+        self.lo = lo
+        self.hi = hi
+        self.shape = source.shape
+        self.dtype = source.dtype
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        region = self.source.read(y0, y1, x0, x1)
+        if self.dtype.kind == "f":
+            return (np.float32(self.lo) + np.float32(self.hi)) - region
+        # Clipped first, so the result stays in range of the source dtype.
+        region = np.clip(region, self.lo, self.hi).astype(np.int64)
+        return (int(self.lo) + int(self.hi) - region).astype(self.dtype)
+
+    def close(self):
+        self.source.close()
+
+
+class DicomFrameSource:
+    """One frame of a compressed DICOM file, decoded on first access."""
+
+    def __init__(self, path, index: int, shape: Tuple[int, ...], dtype):
+        self.path = Path(path)
+        self.index = index
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self._frame = None
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        if self._frame is None:
+            # Only this frame's fragments are read and decoded.
+            self._frame = _require_pydicom().pixels.pixel_array(str(self.path), index=self.index)
+        return np.ascontiguousarray(self._frame[y0:y1, x0:x1])
+
+    def close(self):
+        self._frame = None
+
+
+class FrameStack:
+    """The frames of an image file, each opened as a LazyImage only when requested.
+
+    Recently opened frames are kept so scrubbing back and forth does not
+    reopen them; evicted frames are closed.
+    """
+
+    def __init__(self, path, count: int, open_frame: Callable[[int], "LazyImage"],
+                 max_open: int = 8,
+                 frame_rate: Optional[float] = None, release: Optional[Callable[[], None]] = None):
+        self.path = Path(path)
+        self.max_open = max_open
+        # Frames per second of cine loops, when the file records one.
+        self.frame_rate = frame_rate
+        self._count = count
+        self._open_frame = open_frame
+        self._release = release
+        self._frames: "OrderedDict[int, LazyImage]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def frame(self, index: int) -> "LazyImage":
+        if not 0 <= index < self._count:
+            raise IndexError(f"Frame {index} out of range (0-{self._count - 1})")
+        with self._lock:
+            image = self._frames.get(index)
+            if image is not None:
+                self._frames.move_to_end(index)
+                return image
+        image = self._open_frame(index)
+        with self._lock:
+            self._frames[index] = image
+            while len(self._frames) > self.max_open:
+                _, evicted = self._frames.popitem(last=False)
+                evicted.close()
+        return image
+
+    def read_frame(self, index: int) -> np.ndarray:
+        """Full-resolution pixels of one frame, opened privately for the caller.
+
+        Safe to call from worker threads: the frame is not shared with (or
+        evicted from) the cache used by ``frame``.
+        """
+        if not 0 <= index < self._count:
+            raise IndexError(f"Frame {index} out of range (0-{self._count - 1})")
+        image = self._open_frame(index)
+        try:
+            return image.to_array()
+        finally:
+            image.close()
+
+    def close(self):
+        with self._lock:
+            for image in self._frames.values():
+                image.close()
+            self._frames.clear()
+        if self._release is not None:
+            self._release()
+
+
+def _dicom_frame_rate(ds) -> Optional[float]:
+    for keyword in ("RecommendedDisplayFrameRate", "CineRate"):
+        value = ds.get(keyword)
+        if value:
+            return float(value)
+    frame_time = ds.get("FrameTime")  # milliseconds
+    if frame_time:
+        return 1000.0 / float(frame_time)
+    return None
+
+
+def _dicom_rescale(ds, index: int) -> Tuple[float, float]:
+    # Enhanced multi-frame objects keep the rescale in functional groups.
+    groups = []
+    per_frame = ds.get("PerFrameFunctionalGroupsSequence")
+    if per_frame is not None and index < len(per_frame):
+        groups.append(per_frame[index])
+    shared = ds.get("SharedFunctionalGroupsSequence")
+    if shared:
+        groups.append(shared[0])
+    for group in groups:
+        transform = group.get("PixelValueTransformationSequence")
+        if transform:
+            return float(transform[0].get("RescaleSlope", 1)), float(transform[0].get("RescaleIntercept", 0))
+    return float(ds.get("RescaleSlope", 1) or 1), float(ds.get("RescaleIntercept", 0) or 0)
+
+
+def open_dicom(path, cache_bytes: int = DEFAULT_CACHE_BYTES) -> FrameStack:
+    pydicom = _require_pydicom()
+    path = Path(path)
+    # Pixel data is left on disk: only the header is parsed here.
+    ds = pydicom.dcmread(str(path), defer_size=1024)
+    if _PIXEL_DATA not in ds:
+        raise ValueError(f"DICOM file has no pixel data: {path}")
+
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    count = int(ds.get("NumberOfFrames", 1) or 1)
+    samples = int(ds.get("SamplesPerPixel", 1))
+    bits = int(ds.BitsAllocated)
+    signed = int(ds.get("PixelRepresentation", 0)) == 1
+    bits_stored = int(ds.get("BitsStored", bits))
+    photometric = str(ds.get("PhotometricInterpretation", "MONOCHROME2"))
+    syntax = ds.file_meta.TransferSyntaxUID
+    frame_shape = (rows, cols) + ((samples,) if samples > 1 else ())
+    native = np.dtype(f"{'i' if signed else 'u'}{max(1, bits // 8)}")
+
+    frames = None
+    if (not syntax.is_compressed and not syntax.is_deflated and syntax.is_little_endian
+            and bits in (8, 16, 32) and not photometric.startswith("YBR")
+            and (samples == 1 or int(ds.get("PlanarConfiguration", 0)) == 0)):
+        # Native pixel data: map every frame straight from the file.
+        element = ds.get_item(_PIXEL_DATA, keep_deferred=True)
+        frames = np.memmap(str(path), dtype=native, mode="r", offset=element.value_tell,
+                           shape=(count,) + frame_shape)
+
+    def open_frame(index: int) -> LazyImage:
+        if frames is not None:
+            source = ArraySource(frames[index])
+        else:
+            source = DicomFrameSource(path, index, frame_shape, native)
+        rgb = samples == 3
+        if samples == 1:
+            slope, intercept = _dicom_rescale(ds, index)
+            dtype = rescaled_dtype(native, bits_stored, signed, slope, intercept)
+            if dtype != native:
+                source = RescaledSource(source, slope, intercept, dtype)
+            if photometric == "MONOCHROME1":
+                lo, hi = stored_range(bits_stored, signed)
+                lo, hi = sorted((lo * slope + intercept, hi * slope + intercept))
+                source = InvertedSource(source, lo, hi)
+        return LazyImage([source], path=path, rgb=rgb, cache_bytes=cache_bytes)
+
+    return FrameStack(path, count, open_frame,
+                      frame_rate=_dicom_frame_rate(ds) if count > 1 else None)
+
+
+class VideoReader:
+    """Frames of a video file by index; sequential reads do not seek.
+
+    The capture is opened on first use and reopened after ``close``.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._capture = None
+        self._position = 0
+        self._lock = threading.Lock()
+        capture = self._open()
+        self.count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.frame_rate = capture.get(cv2.CAP_PROP_FPS) or None
+        if self.count <= 0:
+            # Some containers do not record the length.
+            self.count = 0
+            while capture.grab():
+                self.count += 1
+            self._position = self.count
+        if self.count == 0:
+            raise ValueError(f"Video has no frames: {path}")
+
+    def _open(self):
+        if self._capture is None:
+            capture = cv2.VideoCapture(str(self.path))
+            if not capture.isOpened():
+                raise ValueError(f"Cannot open video: {self.path}")
+            self._capture = capture
+            self._position = 0
+        return self._capture
+
+    def read(self, index: int) -> np.ndarray:
+        with self._lock:
+            capture = self._open()
+            if index != self._position:
+                capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+            ok, frame = capture.read()
+            self._position = index + 1
+        if not ok:
+            raise ValueError(f"Cannot decode frame {index} of {self.path}")
+        return frame
+
+    def close(self):
+        with self._lock:
+            if self._capture is not None:
+                self._capture.release()
+                self._capture = None
+
+
+def open_video(path, cache_bytes: int = DEFAULT_CACHE_BYTES) -> FrameStack:
+    reader = VideoReader(path)
+
+    def open_frame(index: int) -> LazyImage:
+        return LazyImage([ArraySource(reader.read(index))], path=path, cache_bytes=cache_bytes)
+
+    return FrameStack(path, reader.count, open_frame, frame_rate=reader.frame_rate, release=reader.close)
+
+
+def open_stack(path, cache_bytes: int = DEFAULT_CACHE_BYTES) -> FrameStack:
+    """Open a file as a stack of frames; single images are one-frame stacks."""
+    path = Path(path)
+    suffix = path.suffix.lower()
+
+    if is_dicom(path):
+        return open_dicom(path, cache_bytes)
+    if suffix in VIDEO_EXTENSIONS:
+        return open_video(path, cache_bytes)
+
+    count = 1
+    if suffix == ".npy":
+        array = np.load(str(path), mmap_mode="r")
+        if array.ndim == 3 and array.shape[2] not in (3, 4):
+            count = array.shape[0]
+    elif suffix in (".tif", ".tiff") and optional_tifffile() is not None:
+        with optional_tifffile().TiffFile(str(path)) as tif:
+            series = tif.series[0]
+            if len(series.levels) <= 1:
+                count = len(series.pages)
+
+    return FrameStack(path, count, lambda index: open_image(path, index, cache_bytes))
+
+
+def open_raw(path, shape: Tuple[int, ...], dtype=np.uint16, offset: int = 0) -> "LazyImage":
+    array = np.memmap(str(path), dtype=dtype, mode="r", offset=offset, shape=shape)
+    return LazyImage([ArraySource(array)], path=path)
+
+
+def open_image(path, frame: int = 0, cache_bytes: int = DEFAULT_CACHE_BYTES) -> "LazyImage":
+    path = Path(path)
+    suffix = path.suffix.lower()
+
+    if is_dicom(path):
+        return open_dicom(path, cache_bytes).frame(frame)
+    if suffix in VIDEO_EXTENSIONS:
+        reader = VideoReader(path)
+        try:
+            return LazyImage([ArraySource(reader.read(frame))], path=path, cache_bytes=cache_bytes)
+        finally:
+            reader.close()
+
+    if suffix == ".npy":
+        array = np.load(str(path), mmap_mode="r")
+        if array.ndim == 3 and array.shape[2] not in (3, 4):
+            # (frames, height, width) stack: keep a view of one frame.
+            array = array[frame]
+        return LazyImage([ArraySource(array)], path=path, cache_bytes=cache_bytes)
+
+    tifffile = optional_tifffile() if suffix in (".tif", ".tiff") else None
+    if tifffile is not None:
+        with tifffile.TiffFile(str(path)) as tif:
+            series = tif.series[0]
+            pages = [level.keyframe for level in series.levels] if series.levels else [series.keyframe]
+            rgb = pages[0].photometric == tifffile.PHOTOMETRIC.RGB
+            memmappable = len(pages) == 1 and tif.pages[frame].is_memmappable
+        if memmappable:
+            sources = [ArraySource(tifffile.memmap(str(path), page=frame, mode="r"))]
+        elif len(pages) > 1:
+            # Pyramidal TIFF: reuse the stored resolution levels.
+            sources = [TiffSource(path, level=i) for i in range(len(pages))]
+        else:
+            sources = [TiffSource(path, page=frame)]
+        return LazyImage(sources, path=path, rgb=rgb, cache_bytes=cache_bytes)
+
+    # Formats without random access (PNG, JPEG, BMP) are decoded in full.
+    data = np.fromfile(str(path), dtype=np.uint8)
+    image = cv2.imdecode(data, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Could not decode image file: {path}")
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+    return LazyImage([ArraySource(image)], path=path, cache_bytes=cache_bytes)
+
+
+class LazyImage:
+    """An image whose pixels are only read when a level or region is requested.
+
+    All returned pixel data is in OpenCV channel order (BGR).
+    """
+
+    def __init__(self, sources: List, path=None, rgb: bool = False,
+                 cache_bytes: int = DEFAULT_CACHE_BYTES):
+        self.path = Path(path) if path is not None else None
+        self.shape = sources[0].shape
+        self.dtype = sources[0].dtype
+        self.rgb = rgb and len(self.shape) == 3 and self.shape[2] == 3
+        self.cache_bytes = cache_bytes
+
+        # Stored levels (e.g. from a pyramidal TIFF), keyed by level number.
+        self._stored: Dict[int, object] = {}
+        for source in sources:
+            level = int(round(np.log2(self.shape[0] / source.shape[0])))
+            self._stored[level] = source
+        self._levels: Dict[int, np.ndarray] = {}
+        self._preview: Optional[Tuple[Tuple[int, int], np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def height(self) -> int:
+        return self.shape[0]
+
+    @property
+    def width(self) -> int:
+        return self.shape[1]
+
+    def level_shape(self, level: int) -> Tuple[int, int]:
+        h, w = self.shape[:2]
+        for _ in range(level):
+            h, w = (h + 1) // 2, (w + 1) // 2
+        return h, w
+
+    def level_for(self, target_size: int) -> int:
+        return pyramid_level_for(self.shape, target_size)
+
+    def _to_bgr(self, region: np.ndarray) -> np.ndarray:
+        if self.rgb:
+            return cv2.cvtColor(region, cv2.COLOR_RGB2BGR)
+        return region
+
+    def read_region(self, level: int, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        stored = self._stored.get(level)
+        if stored is not None:
+            return self._to_bgr(stored.read(y0, y1, x0, x1))
+        return self.level(level)[y0:y1, x0:x1]
+
+    def to_array(self) -> np.ndarray:
+        """Full-resolution pixels; a memory-mapped view when the source allows it."""
+        source = self._stored[0]
+        if isinstance(source, ArraySource) and not self.rgb:
+            return source.array
+        return self.read_region(0, 0, self.height, 0, self.width)
+
+    def level(self, level: int) -> np.ndarray:
+        if level == 0:
+            return self.to_array()
+        with self._lock:
+            cached = self._levels.get(level)
+            if cached is not None:
+                return cached
+            stored = self._stored.get(level)
+            if stored is not None:
+                result = self._to_bgr(stored.read(0, stored.shape[0], 0, stored.shape[1]))
+            else:
+                result = self._build_level(level)
+            if result.nbytes <= self.cache_bytes:
+                self._levels[level] = result
+            return result
+
+    def _build_level(self, level: int) -> np.ndarray:
+        # Downsample from the nearest finer level that is cached or stored,
+        # a band at a time so the source is never fully materialised.
+        base = max(lvl for lvl in list(self._levels) + list(self._stored) if lvl < level)
+        factor = 1 << (level - base)
+        bh, bw = self.level_shape(base)
+        out_h, out_w = self.level_shape(level)
+        out = np.empty((out_h, out_w) + tuple(self.shape[2:]), dtype=self.dtype)
+
+        band = max(factor, (16 << 20) // max(1, bw * self.dtype.itemsize) // factor * factor)
+        for y0 in range(0, bh, band):
+            y1 = min(bh, y0 + band)
+            region = self._levels[base][y0:y1] if base in self._levels else self.read_region(base, y0, y1, 0, bw)
+            oy0 = y0 // factor
+            oy1 = min(out_h, -(-y1 // factor))
+            out[oy0:oy1] = cv2.resize(region, (out_w, oy1 - oy0), interpolation=cv2.INTER_AREA)
+        return out
+
+    def preview(self, max_width: int, max_height: int) -> np.ndarray:
+        """A quick thumbnail no larger than the given size.
+
+        The last preview is kept, so a prefetched image shows without
+        resampling. Uses a cached level when one is available, otherwise subsamples a
+        memory-mapped source with a stride instead of reading every pixel.
+        """
+        cached = self._preview
+        if cached is not None and cached[0] == (max_width, max_height):
+            return cached[1]
+
+        target_w, target_h = fit_size(self.width, self.height, max_width, max_height)
+        level = pyramid_level_for(self.shape, max(target_w, target_h))
+        candidates = [lvl for lvl in list(self._levels) + list(self._stored) if lvl <= level]
+        best = max(candidates)
+
+        source = self._stored.get(best)
+        if best not in self._levels and isinstance(source, ArraySource) \
+                and isinstance(source.array, np.memmap):
+            stride = max(1, min(source.shape[0] // target_h, source.shape[1] // target_w))
+            region = self._to_bgr(np.ascontiguousarray(source.array[::stride, ::stride]))
+        else:
+            region = self.level(best)
+
+        preview = cv2.resize(region, (target_w, target_h), interpolation=cv2.INTER_AREA)
+        self._preview = ((max_width, max_height), preview)
+        return preview
+
+    def close(self):
+        for source in self._stored.values():
+            source.close()
+        self._levels.clear()
+        self._preview = None
@@ -0,0 +1,214 @@
+"""
+Next/previous navigation over the images of a folder with background prefetch
+
+The neighbours of the current image are opened and decoded on a small thread
+pool into an LRU cache bounded by bytes, together with a display-size preview
+and, optionally, the result of the currently selected operation. Stepping
+through a study then only waits for images the prefetcher has not reached.
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from batch import IMAGE_EXTENSIONS
+from disk_cache import DiskCache
+from instrumentation import METRICS
+from loader import DICOM_EXTENSIONS, VIDEO_EXTENSIONS, FrameStack, is_dicom, open_stack
+from pipeline import run_cached
+from processing import ProcessingParams
+
+NAVIGABLE_EXTENSIONS = IMAGE_EXTENSIONS | {".npy"} | set(DICOM_EXTENSIONS) | set(VIDEO_EXTENSIONS)
+
+
+def list_images(folder) -> List[Path]:
+    paths = []
+    for path in sorted(Path(folder).iterdir()):
+        if not path.is_file():
+            continue
+        suffix = path.suffix.lower()
+        if suffix in NAVIGABLE_EXTENSIONS or (not suffix and is_dicom(path)):
+            paths.append(path)
+    return paths
+
+
+@dataclass
+class NavigatorEntry:
+    path: Path
+    stack: FrameStack
+    image: np.ndarray
+    data_range: Optional[Tuple[float, float]] = None
+    # Results of the operation selected when the entry was prefetched,
+    # keyed by (operation, params).
+    results: Dict[Tuple[str, ProcessingParams], np.ndarray] = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        # Memory-mapped pixels live in the OS page cache, not in ours.
+        size = 0 if isinstance(self.image, np.memmap) else self.image.nbytes
+        return size + sum(result.nbytes for result in self.results.values())
+
+
+class ImageNavigator:
+    """The images of one folder, with the neighbours of the current one prefetched."""
+
+    def __init__(self, paths: List[Path], index: int = 0, cache_bytes: int = 512 << 20,
+                 prefetch: int = 4, workers: int = 2, disk_cache: Optional[DiskCache] = None):
+        self.paths = list(paths)
+        self.index = index
+        self.cache_bytes = cache_bytes
+        self.prefetch_count = prefetch
+        self.disk_cache = disk_cache
+        self.hits = 0
+        self.misses = 0
+        self.preview_size: Optional[Tuple[int, int]] = None
+        self._operation: Optional[Tuple[str, ProcessingParams]] = None
+        self._cache: "OrderedDict[int, NavigatorEntry]" = OrderedDict()
+        self._cached_bytes = 0
+        self._pending: Dict[int, Future] = {}
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="navigator")
+
+    @classmethod
+    def for_file(cls, path, **kwargs) -> "ImageNavigator":
+        path = Path(path)
+        paths = list_images(path.parent)
+        if path not in paths:
+            paths.append(path)
+        return cls(paths, index=paths.index(path), **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    @property
+    def current_path(self) -> Path:
+        return self.paths[self.index]
+
+    def set_operation(self, operation: Optional[str], params: Optional[ProcessingParams] = None):
+        """Operation pre-run on prefetched images; ``None`` only decodes them."""
+        with self._lock:
+            self._operation = (operation, params) if operation is not None else None
+
+    def go(self, index: int) -> NavigatorEntry:
+        """Make ``index`` the current image and prefetch around it."""
+        direction = 1 if index >= self.index else -1
+        self.index = index
+        entry = self.get(index)
+        self.prefetch(direction)
+        return entry
+
+    def step(self, offset: int) -> Optional[NavigatorEntry]:
+        index = self.index + offset
+        if not 0 <= index < len(self.paths):
+            return None
+        return self.go(index)
+
+    def get(self, index: int) -> NavigatorEntry:
+        with self._lock:
+            entry = self._cache.get(index)
+            if entry is not None:
+                self._cache.move_to_end(index)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            future = self._pending.get(index)
+        if future is not None and not future.cancel():
+            # Already being decoded in the background.
+            future.result()
+            with self._lock:
+                entry = self._cache.get(index)
+            if entry is not None:
+                return entry
+        return self._load(index)
+
+    def result_for(self, entry: NavigatorEntry, operation: str,
+                   params: ProcessingParams) -> Optional[np.ndarray]:
+        return entry.results.get((operation, params))
+
+    def prefetch(self, direction: int = 1):
+        ahead = [self.index + direction * i for i in range(1, self.prefetch_count + 1)]
+        behind = [self.index - direction * i for i in range(1, self.prefetch_count // 2 + 1)]
+        wanted = [i for i in ahead + behind if 0 <= i < len(self.paths)]
+        with self._lock:
+            # Queued neighbours of an image we have moved away from.
+            for i, future in list(self._pending.items()):
+                if i not in wanted and future.cancel():
+                    del self._pending[i]
+            for i in wanted:
+                if i in self._cache or i in self._pending:
+                    continue
+                future = self._executor.submit(self._load, i)
+                future.add_done_callback(lambda _, i=i: self._forget(i))
+                self._pending[i] = future
+
+    def _forget(self, index: int):
+        with self._lock:
+            future = self._pending.get(index)
+            if future is not None and future.done():
+                del self._pending[index]
+
+    def _load(self, index: int) -> NavigatorEntry:
+        with self._lock:
+            operation = self._operation
+            preview_size = self.preview_size
+
+        path = self.paths[index]
+        with METRICS.measure("open", "load", detail=path.name) as measurement:
+            stack = open_stack(path)
+            frame = stack.frame(0)
+            image = frame.to_array()
+            measurement.set_result(image)
+        data_range = None
+        if image.dtype != np.uint8:
+            data_range = (float(image.min()), float(image.max()))
+        entry = NavigatorEntry(path, stack, image, data_range)
+
+        if preview_size is not None:
+            # Cached on the frame, so showing the image does not resample it.
+            frame.preview(*preview_size)
+        if operation is not None:
+            name, params = operation
+            params = replace(params, data_range=data_range)
+            entry.results[(name, params)] = run_cached(image, name, params, self.disk_cache,
+                                                      category="prefetch")
+
+        self._store(index, entry)
+        return entry
+
+    def _store(self, index: int, entry: NavigatorEntry):
+        with self._lock:
+            previous = self._cache.pop(index, None)
+            if previous is not None:
+                self._cached_bytes -= previous.nbytes
+            self._cache[index] = entry
+            self._cached_bytes += entry.nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                oldest = next(iter(self._cache))
+                if oldest == self.index:
+                    # Never evict the image being viewed.
+                    self._cache.move_to_end(oldest)
+                    oldest = next(iter(self._cache))
+                    if oldest == self.index:
+                        break
+                evicted = self._cache.pop(oldest)
+                self._cached_bytes -= evicted.nbytes
+                evicted.stack.close()
+
+    def close(self):
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            for entry in self._cache.values():
+                entry.stack.close()
+            self._cache.clear()
+            self._cached_bytes = 0
@@ -0,0 +1,92 @@
+"""
+On-screen performance panel drawn over the main image view
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import Callable, Dict, Tuple
+
+from PySide6.QtCore import Qt, QTimer
+from PySide6.QtGui import QFont
+from PySide6.QtWidgets import QLabel, QWidget
+
+from instrumentation import METRICS, Instrumentation
+
+CATEGORY_TITLES = (("stage", "Stages (full resolution)"), ("preview", "Stages (preview proxy)"),
+                   ("prefetch", "Stages (prefetched images)"), ("volume", "Stages (volume slices)"),
+                   ("load", "Load"), ("display", "Display"), ("save", "Save"))
+
+
+def _megabytes(nbytes: int) -> str:
+    return f"{nbytes / 1e6:.1f} MB"
+
+
+class PerfOverlay(QLabel):
+    """Per-stage timings and cache hit counts, refreshed while visible.
+
+    ``cache_stats`` returns {name: (hits, misses)} for the caches outside the
+    pipeline stages (navigator, zoom regions, CLAHE histograms, ...).
+    """
+
+    def __init__(self, parent: QWidget, cache_stats: Callable[[], Dict[str, Tuple[int, int]]],
+                 metrics: Instrumentation = METRICS, interval: int = 500):
+        super().__init__(parent)
+        self.metrics = metrics
+        self.cache_stats = cache_stats
+        self.setFont(QFont("Consolas", 8))
+        self.setAlignment(Qt.AlignLeft | Qt.AlignTop)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.setStyleSheet("""
+            QLabel {
+                background-color: rgba(20, 30, 40, 200);
+                color: #ecf0f1;
+                border-radius: 6px;
+                padding: 6px;
+                font-weight: normal;
+            }
+        """)
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.refresh)
+        self.hide()
+
+    def toggle(self):
+        if self.isVisible():
+            self.timer.stop()
+            self.hide()
+        else:
+            self.refresh()
+            self.show()
+            self.raise_()
+            self.timer.start()
+
+    def refresh(self):
+        lines = []
+        for category, title in CATEGORY_TITLES:
+            stats = self.metrics.stats(category)
+            if not stats:
+                continue
+            tracking = self.metrics.tracking_allocations
+            lines.append(f"{title:<26} last ms  avg ms  calls  hit/miss" + ("  alloc MB" if tracking else ""))
+            for name, stat in stats[:8]:
+                hit_miss = f"{stat.hits}/{stat.misses}" if stat.hits or stat.misses else "-"
+                line = f"  {name:<22} {stat.last_ms:8.1f} {stat.avg_ms:7.1f} {stat.calls:6d}  {hit_miss:<8}"
+                if tracking:
+                    line += f" {stat.last_allocated / 1e6:9.1f}" if stat.last_allocated is not None else f" {'-':>9}"
+                lines.append(line.rstrip())
+            last = self.metrics.latest(category) if category in ("load", "save") else None
+            if last is not None and last.shape is not None:
+                allocated = (f", allocated {_megabytes(last.allocated_bytes)}"
+                             if last.allocated_bytes is not None else "")
+                lines.append(f"  last: {last.detail} {'x'.join(map(str, last.shape))} "
+                             f"output {_megabytes(last.output_bytes)}{allocated}")
+
+        caches = self.cache_stats()
+        if caches:
+            lines.append("Caches (hits/misses)")
+            lines.append("  " + "  ".join(f"{name} {hits}/{misses}" for name, (hits, misses) in caches.items()))
+        if self.metrics.log_path is not None:
+            lines.append(f"Log: {self.metrics.log_path.name}")
+
+        self.setText("\n".join(lines) if lines else "No measurements yet")
+        self.adjustSize()
@@ -0,0 +1,239 @@
+"""
+Staged processing pipeline with memoized intermediate results
+
+Every operation is a chain of stages (grayscale -> CLAHE -> brightness/contrast
+or 8-bit conversion -> blur -> Canny -> focus). Each stage output is cached under a key built from
+the key of its input and its own parameters, so changing a late parameter such
+as the Canny high threshold only re-runs the stages after it. With a
+DiskCache attached, final results are also looked up on / written to disk
+under the hash of the source pixels, so they survive restarts. With a
+``remote`` processor (a daemon.DaemonClient) final results are computed by
+the processing daemon instead of in this process.
+"""
+
+# -*- coding: utf-8 -*-
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from disk_cache import DiskCache, image_digest, result_key
+from instrumentation import METRICS, Measurement
+from processing import (OPERATIONS, FocusCache, ProcessingParams, adjust_brightness_contrast,
+                        apply_clahe, apply_focus_effect, to_8bit, to_grayscale)
+
+Stage = Tuple[str, Callable[..., np.ndarray], tuple]
+
+
+def gaussian_blur_5x5(img: np.ndarray) -> np.ndarray:
+    return cv2.GaussianBlur(img, (5, 5), 0)
+
+
+def canny(img: np.ndarray, low_threshold: int, high_threshold: int) -> np.ndarray:
+    return cv2.Canny(img, low_threshold, high_threshold)
+
+
+def stage_plan(operation: str, params: ProcessingParams, full_depth: bool = False,
+               until: Optional[str] = None) -> List[Stage]:
+    """Stages of an operation; ``full_depth`` leaves out the brightness/contrast
+    window so deeper-than-8-bit results stay 16-bit (edges are always 8-bit).
+    With ``until`` the plan ends after the stage of that name."""
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation '{operation}', expected one of {', '.join(OPERATIONS)}")
+
+    # Deeper-than-8-bit images stay 16-bit until brightness/contrast (or,
+    # for Canny, the 8-bit conversion) quantizes them.
+    stages: List[Stage] = [("grayscale", to_grayscale, (params.data_range,))]
+
+    grid = (params.tile_grid, params.tile_grid)
+    if operation == "enhance":
+        clip = 3.0 if params.clip_limit is None else params.clip_limit
+        stages.append(("clahe", apply_clahe, (clip, grid)))
+    elif params.use_clahe:
+        clip = 2.0 if params.clip_limit is None else params.clip_limit
+        stages.append(("clahe", apply_clahe, (clip, grid)))
+
+    if operation == "edges":
+        stages.append(("8bit", to_8bit, ()))
+        stages.append(("blur", gaussian_blur_5x5, ()))
+        stages.append(("canny", canny, (params.low_threshold, params.high_threshold)))
+    elif not full_depth:
+        stages.append(("brightness_contrast", adjust_brightness_contrast,
+                       (params.brightness, params.contrast)))
+
+    if params.focus_level != 0:
+        stages.append(("focus", apply_focus_effect, (params.focus_level,)))
+
+    if until is not None:
+        names = [name for name, _, _ in stages]
+        if until not in names:
+            raise ValueError(f"Operation '{operation}' has no '{until}' stage")
+        stages = stages[:names.index(until) + 1]
+    return stages
+
+
+def run_operation(image: np.ndarray, operation: str, params: ProcessingParams,
+                  full_depth: bool = False, category: str = "stage", until: Optional[str] = None) -> np.ndarray:
+    result = image
+    for name, func, args in stage_plan(operation, params, full_depth, until):
+        with METRICS.measure(name, category) as measurement:
+            result = func(result, *args)
+            measurement.set_result(result)
+    return result
+
+
+def run_cached(image: np.ndarray, operation: str, params: ProcessingParams, cache: Optional[DiskCache],
+               full_depth: bool = False, category: str = "stage") -> np.ndarray:
+    """run_operation, served from / stored in ``cache`` when one is given."""
+    if cache is None:
+        return run_operation(image, operation, params, full_depth, category)
+    key = result_key(image_digest(image), operation, params, full_depth)
+    result = cache.get(key)
+    if result is None:
+        result = run_operation(image, operation, params, full_depth, category)
+        cache.put(key, result)
+    return result
+
+
+class ProcessingPipeline:
+    """Runs operations on one source image, reusing cached stage outputs.
+
+    Cached arrays are shared between calls and marked read-only; copy a result
+    before modifying it in place. The pipeline is safe to use from several
+    threads. Stage timings are reported to METRICS under ``category``.
+    """
+
+    def __init__(self, max_entries: int = 24, category: str = "stage",
+                 disk_cache: Optional[DiskCache] = None, remote=None):
+        self.max_entries = max_entries
+        self.category = category
+        self.disk_cache = disk_cache
+        # Anything with process(image, operation, params), e.g. daemon.DaemonClient.
+        self.remote = remote
+        self.hits = 0
+        self.misses = 0
+        self._image: Optional[np.ndarray] = None
+        self._version = 0
+        self._digest: Optional[str] = None
+        self._cache: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+        self._focus = FocusCache()
+        self._lock = threading.RLock()
+
+    @property
+    def image(self) -> Optional[np.ndarray]:
+        return self._image
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def set_image(self, image: Optional[np.ndarray]):
+        with self._lock:
+            self._image = image
+            self._version += 1
+            self._digest = None
+            self._cache.clear()
+        self._focus.invalidate()
+
+    def digest(self) -> str:
+        """Content hash of the current image, computed once per image."""
+        with self._lock:
+            if self._digest is None:
+                if self._image is None:
+                    raise ValueError("No image loaded in the processing pipeline")
+                self._digest = image_digest(self._image)
+            return self._digest
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        self._focus.invalidate()
+
+    def run(self, operation: str, params: ProcessingParams, full_depth: bool = False,
+            until: Optional[str] = None) -> np.ndarray:
+        with self._lock:
+            image = self._image
+            key: Hashable = ("image", self._version)
+        if image is None:
+            raise ValueError("No image loaded in the processing pipeline")
+
+        plan = stage_plan(operation, params, full_depth, until)
+        disk_key = None
+        final_key = key
+        for name, _, args in plan:
+            final_key = (final_key, name, args)
+        # Intermediate results (``until``) stay in memory only.
+        if self.disk_cache is not None and until is None:
+            with self._lock:
+                in_memory = final_key in self._cache
+            if not in_memory:
+                disk_key = result_key(self.digest(), operation, params, full_depth)
+                cached = self.disk_cache.get(disk_key)
+                if cached is not None:
+                    self._store(final_key, cached)
+                    return cached
+
+        # The daemon returns 8-bit results only.
+        if self.remote is not None and until is None and not full_depth:
+            cached = self._lookup(final_key)
+            if cached is not None:
+                return cached
+            try:
+                with METRICS.measure("remote", self.category, detail=operation) as measurement:
+                    result = self.remote.process(image, operation, params)
+                    measurement.set_result(result)
+            except (EOFError, OSError) as e:
+                print(f"[Daemon] Connection lost ({e}); processing locally from now on")
+                self.remote = None
+            except RuntimeError as e:
+                print(f"[Daemon] {e}; processing locally")
+            else:
+                self._store(final_key, result)
+                if disk_key is not None:
+                    self.disk_cache.put(disk_key, result)
+                return result
+
+        result = image
+        for name, func, args in plan:
+            input_key, key = key, (key, name, args)
+            cached = self._lookup(key)
+            if cached is not None:
+                result = cached
+                METRICS.add(Measurement(name, self.category, output_bytes=result.nbytes,
+                                        shape=tuple(result.shape), cache_hit=True))
+                continue
+            with METRICS.measure(name, self.category) as measurement:
+                if name == "focus":
+                    # Reuses the unsharp mask / blur levels of the same input.
+                    result = self._focus.apply(result, args[0], input_key)
+                else:
+                    result = func(result, *args)
+                measurement.set_result(result)
+                measurement.cache_hit = False
+            self._store(key, result)
+        if disk_key is not None:
+            self.disk_cache.put(disk_key, result)
+        return result
+
+    def _lookup(self, key: Hashable) -> Optional[np.ndarray]:
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+
+    def _store(self, key: Hashable, result: np.ndarray):
+        if self.max_entries <= 0:
+            return
+        result.flags.writeable = False
+        with self._lock:
+            self._cache[key] = result
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
@@ -0,0 +1,104 @@
+"""
+Live preview scheduling for the processing pipeline
+
+Slider moves request a preview; requests are debounced and coalesced so that
+at most one job runs on the worker thread and only the most recent parameter
+set is ever rendered. Results of superseded jobs are dropped.
+"""
+
+# -*- coding: utf-8 -*-
+
+import time
+from typing import Optional, Tuple
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
+
+from pipeline import ProcessingPipeline
+from processing import ProcessingParams
+
+
+class _PreviewSignals(QObject):
+    finished = Signal(int, object, float)
+    failed = Signal(int, str)
+
+
+class _PreviewJob(QRunnable):
+
+    def __init__(self, scheduler: "PreviewScheduler", generation: int,
+                 pipeline: ProcessingPipeline, operation: str, params: ProcessingParams):
+        super().__init__()
+        self.scheduler = scheduler
+        self.generation = generation
+        self.pipeline = pipeline
+        self.operation = operation
+        self.params = params
+        self.signals = scheduler.signals
+
+    def run(self):
+        # A newer request arrived while this job was queued: skip the work.
+        if self.generation != self.scheduler.generation:
+            self.signals.finished.emit(self.generation, None, 0.0)
+            return
+        try:
+            start = time.perf_counter()
+            result = self.pipeline.run(self.operation, self.params)
+            self.signals.finished.emit(self.generation, result, time.perf_counter() - start)
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+
+
+class PreviewScheduler(QObject):
+    """Debounces preview requests and renders them off the GUI thread."""
+
+    ready = Signal(object, float)
+    error = Signal(str)
+
+    def __init__(self, parent: Optional[QObject] = None, debounce_ms: int = 10):
+        super().__init__(parent)
+        self.generation = 0
+        self.signals = _PreviewSignals(self)
+        self.signals.finished.connect(self._on_finished)
+        self.signals.failed.connect(self._on_failed)
+
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._pending: Optional[Tuple[ProcessingPipeline, str, ProcessingParams]] = None
+        self._in_flight = False
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(debounce_ms)
+        self._timer.timeout.connect(self._dispatch)
+
+    def request(self, pipeline: ProcessingPipeline, operation: str, params: ProcessingParams):
+        self.generation += 1
+        self._pending = (pipeline, operation, params)
+        self._timer.start()
+
+    def cancel(self):
+        self.generation += 1
+        self._pending = None
+        self._timer.stop()
+
+    def wait(self, msecs: int = -1) -> bool:
+        return self._pool.waitForDone(msecs)
+
+    def _dispatch(self):
+        if self._in_flight or self._pending is None:
+            return
+        pipeline, operation, params = self._pending
+        self._pending = None
+        self._in_flight = True
+        self._pool.start(_PreviewJob(self, self.generation, pipeline, operation, params))
+
+    def _on_finished(self, generation: int, result, elapsed: float):
+        self._in_flight = False
+        if result is not None and generation == self.generation:
+            self.ready.emit(result, elapsed)
+        self._dispatch()
+
+    def _on_failed(self, generation: int, message: str):
+        self._in_flight = False
+        if generation == self.generation:
+            self.error.emit(message)
+        self._dispatch()
@@ -0,0 +1,216 @@
+"""
+Image processing operations shared by the GUI and the headless tools
+
+The functions here contain no Qt code so they can run in worker processes,
+batch jobs and anywhere else a display is not available.
+"""
+
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Hashable, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+from clahe import ClaheEngine
+
+OPERATIONS = ("grayscale", "enhance", "edges")
+
+# Images deeper than 8 bits are processed as uint16 spanning this range.
+WORKING_MAX = 65535
+
+
+@dataclass(frozen=True)
+class ProcessingParams:
+    brightness: int = 50
+    contrast: int = 50
+    low_threshold: int = 50
+    high_threshold: int = 150
+    use_clahe: bool = False
+    focus_level: int = 0
+    # (low, high) of images deeper than 8 bits; None uses each image's min/max.
+    data_range: Optional[Tuple[float, float]] = None
+    # CLAHE clip limit (None: 3.0 for "enhance", 2.0 otherwise) and tiles per side.
+    clip_limit: Optional[float] = None
+    tile_grid: int = 8
+
+
+def to_grayscale(img: np.ndarray, data_range: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    if len(img.shape) == 3:
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = img.copy()
+    if gray.dtype == np.uint8:
+        return gray
+    return to_working_depth(gray, data_range)
+
+
+@lru_cache(maxsize=8)
+def working_depth_lut(dtype: str, low: float, high: float) -> np.ndarray:
+    scale = WORKING_MAX / (high - low) if high > low else 0.0
+    levels = np.arange(65536, dtype=np.uint16).view(dtype).astype(np.float64)
+    lut = np.clip(np.rint((levels - low) * scale), 0, WORKING_MAX).astype(np.uint16)
+    lut.flags.writeable = False
+    return lut
+
+
+def to_working_depth(img: np.ndarray, data_range: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    """Map ``data_range`` of 16-bit, 32-bit or float data linearly onto uint16."""
+    if data_range is None:
+        low, high = float(img.min()), float(img.max())
+    else:
+        low, high = data_range
+
+    if img.dtype in (np.uint16, np.int16):
+        # One table lookup per pixel, indexed by the 16-bit pattern.
+        return np.take(working_depth_lut(img.dtype.str, low, high), img.view(np.uint16))
+
+    scale = WORKING_MAX / (high - low) if high > low else 0.0
+    out = (img.astype(np.float32) - np.float32(low)) * np.float32(scale)
+    np.clip(np.rint(out, out=out), 0, WORKING_MAX, out=out)
+    return out.astype(np.uint16)
+
+
+CLAHE_ENGINE = ClaheEngine()
+
+
+def apply_clahe(gray: np.ndarray, clip_limit: float = 2.0, tile_grid_size=(8, 8)) -> np.ndarray:
+    return CLAHE_ENGINE.apply(gray, clip_limit, tile_grid_size)
+
+
+@lru_cache(maxsize=32)
+def window_lut(depth_max: int, brightness: int, contrast: int) -> np.ndarray:
+    """8-bit output for every input level of a ``depth_max``-deep image.
+
+    Input levels are scaled to 0-255 before the brightness/contrast transform,
+    so at 8 bits the table reproduces ``cv2.convertScaleAbs`` exactly.
+    """
+    alpha = contrast / 50.0
+    beta = (brightness - 50) * 2
+    levels = np.arange(depth_max + 1, dtype=np.uint8 if depth_max == 255 else np.uint16)
+    lut = cv2.convertScaleAbs(levels, alpha=alpha * 255.0 / depth_max, beta=beta).ravel()
+    lut.flags.writeable = False
+    return lut
+
+
+def adjust_brightness_contrast(img: np.ndarray, brightness: int, contrast: int) -> np.ndarray:
+    """Window/level as brightness and contrast; always returns 8-bit data."""
+    if img.dtype == np.uint8:
+        return cv2.LUT(img, window_lut(255, brightness, contrast))
+    if img.dtype == np.uint16:
+        return np.take(window_lut(WORKING_MAX, brightness, contrast), img)
+    alpha = contrast / 50.0
+    beta = (brightness - 50) * 2
+    return cv2.convertScaleAbs(img, alpha=alpha, beta=beta)
+
+
+def to_8bit(img: np.ndarray) -> np.ndarray:
+    """8-bit version of a working-depth image, for 8-bit-only stages such as Canny."""
+    if img.dtype == np.uint8:
+        return img
+    return adjust_brightness_contrast(img, 50, 50)
+
+
+def to_display_depth(img: np.ndarray, data_range: Optional[Tuple[float, float]] = None) -> np.ndarray:
+    """8-bit version of a source image of any depth, for display."""
+    if img.dtype == np.uint8:
+        return img
+    return adjust_brightness_contrast(to_working_depth(img, data_range), 50, 50)
+
+
+def apply_focus_effect(img: np.ndarray, focus_level: int) -> np.ndarray:
+    if focus_level == 0:
+        return img
+
+    if focus_level < 0:
+        blur_strength = abs(focus_level)
+        kernel_size = min(blur_strength * 2 + 1, 15)
+        if kernel_size % 2 == 0:
+            kernel_size += 1
+        return cv2.GaussianBlur(img, (kernel_size, kernel_size), blur_strength)
+
+    return cv2.addWeighted(img, 1.0, unsharp_mask(img), focus_level / 10.0, 0)
+
+
+def unsharp_mask(img: np.ndarray) -> np.ndarray:
+    blurred = cv2.GaussianBlur(img, (9, 9), 10.0)
+    return cv2.subtract(img, blurred)
+
+
+class FocusCache:
+    """Serves focus levels of one base image from cached intermediates.
+
+    The unsharp mask does not depend on the sharpen level, so it is computed
+    once per base image and every sharpen level becomes a single
+    ``addWeighted``. Blur levels are kept in a small LRU. The cache resets
+    whenever it is called with a different base key.
+    """
+
+    def __init__(self, max_blur_levels: int = 4):
+        self.max_blur_levels = max_blur_levels
+        self._key: Hashable = None
+        self._mask: Optional[np.ndarray] = None
+        self._blurred: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._key = None
+            self._mask = None
+            self._blurred.clear()
+
+    def apply(self, img: np.ndarray, focus_level: int, key: Hashable = None) -> np.ndarray:
+        if focus_level == 0:
+            return img
+        if key is None:
+            key = id(img)
+
+        with self._lock:
+            if key != self._key:
+                self._key = key
+                self._mask = None
+                self._blurred.clear()
+
+            if focus_level > 0:
+                if self._mask is None:
+                    self._mask = unsharp_mask(img)
+                mask = self._mask
+            else:
+                blurred = self._blurred.get(focus_level)
+                if blurred is not None:
+                    self._blurred.move_to_end(focus_level)
+                    return blurred
+
+        if focus_level > 0:
+            return cv2.addWeighted(img, 1.0, mask, focus_level / 10.0, 0)
+
+        blurred = apply_focus_effect(img, focus_level)
+        with self._lock:
+            if key == self._key:
+                self._blurred[focus_level] = blurred
+                while len(self._blurred) > self.max_blur_levels:
+                    self._blurred.popitem(last=False)
+        return blurred
+
+
+def read_image(path, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    # np.fromfile + imdecode keeps Unicode paths working on Windows
+    image = cv2.imdecode(np.fromfile(str(path), dtype=np.uint8), flags)
+    if image is None:
+        raise ValueError(f"Could not decode image file: {path}")
+    return image
+
+
+def write_image(path, img: np.ndarray, params: Sequence[int] = ()) -> int:
+    """Encode in the format given by the file extension; ``params`` are cv2.IMWRITE_* pairs."""
+    extension = os.path.splitext(str(path))[1] or '.png'
+    is_success, buffer = cv2.imencode(extension, img, list(params))
+    if not is_success:
+        raise ValueError(f"Could not encode image: {path}")
+    buffer.tofile(str(path))
+    return buffer.nbytes
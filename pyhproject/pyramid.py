@@ -0,0 +1,54 @@
+"""
+Image pyramid helpers used for proxy-resolution previews
+
+Parameter exploration runs on a downsampled pyramid level matched to the
+display size; the full-resolution image is only processed on commit.
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+# Smallest proxy size; larger or HiDPI viewers get a proxy matching their
+# size in device pixels.
+PREVIEW_SIZE = 1024
+
+
+def pyramid_level_for(shape, target_size: int = PREVIEW_SIZE) -> int:
+    # Smallest level whose longest side still covers the target size, so the
+    # proxy is never upscaled on screen.
+    longest = max(shape[:2])
+    level = 0
+    while longest // 2 >= target_size:
+        longest //= 2
+        level += 1
+    return level
+
+
+def build_pyramid(image: np.ndarray, levels: int) -> List[np.ndarray]:
+    pyramid = [image]
+    for _ in range(levels):
+        pyramid.append(cv2.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def proxy_for(image: np.ndarray, target_size: int = PREVIEW_SIZE) -> Tuple[np.ndarray, int]:
+    level = pyramid_level_for(image.shape, target_size)
+    return build_pyramid(image, level)[-1], level
+
+
+def fit_size(width: int, height: int, max_width: int, max_height: int) -> Tuple[int, int]:
+    scale = min(max_width / width, max_height / height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+
+def resize_to_fit(image: np.ndarray, max_width: int, max_height: int) -> np.ndarray:
+    h, w = image.shape[:2]
+    new_w, new_h = fit_size(w, h, max_width, max_height)
+    if (new_w, new_h) == (w, h):
+        return image
+    interpolation = cv2.INTER_AREA if new_w < w else cv2.INTER_CUBIC
+    return cv2.resize(image, (new_w, new_h), interpolation=interpolation)
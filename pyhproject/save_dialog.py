@@ -0,0 +1,85 @@
+"""
+Encoding options asked for when saving or exporting processed images
+"""
+
+# -*- coding: utf-8 -*-
+
+from typing import Optional
+
+from PySide6.QtWidgets import (QCheckBox, QComboBox, QDialog, QDialogButtonBox, QFormLayout,
+                               QSpinBox)
+
+from writer import FULL_DEPTH_FORMATS, SAVE_FORMATS, TIFF_COMPRESSION, SaveOptions
+
+EXPORT_FORMATS = {"PNG": ".png", "JPEG": ".jpg", "TIFF": ".tiff", "WebP": ".webp", "BMP": ".bmp"}
+
+
+class SaveOptionsDialog(QDialog):
+    """Quality / compression of one format; with ``extension=None`` the
+    format is chosen in the dialog as well (used by Export All)."""
+
+    def __init__(self, parent=None, extension: Optional[str] = None,
+                 options: SaveOptions = SaveOptions(), allow_full_depth: bool = False):
+        super().__init__(parent)
+        self.setWindowTitle("Save Options")
+        self._extension = extension
+        layout = QFormLayout(self)
+
+        self.comboFormat = QComboBox(self)
+        self.comboFormat.addItems(list(EXPORT_FORMATS))
+        if extension is None:
+            layout.addRow("Format:", self.comboFormat)
+        else:
+            self.comboFormat.setCurrentText(SAVE_FORMATS[extension.lower()])
+            self.comboFormat.hide()
+
+        self.spinQuality = QSpinBox(self)
+        self.spinQuality.setRange(1, 100)
+        self.spinQuality.setValue(options.quality)
+        layout.addRow("JPEG / WebP quality:", self.spinQuality)
+
+        self.spinCompression = QSpinBox(self)
+        self.spinCompression.setRange(0, 9)
+        self.spinCompression.setValue(options.png_compression)
+        self.spinCompression.setToolTip("0 = fastest, 9 = smallest file")
+        layout.addRow("PNG compression:", self.spinCompression)
+
+        self.comboTiff = QComboBox(self)
+        self.comboTiff.addItems(list(TIFF_COMPRESSION))
+        self.comboTiff.setCurrentText(options.tiff_compression)
+        layout.addRow("TIFF compression:", self.comboTiff)
+
+        self.checkboxFullDepth = QCheckBox("Keep 16-bit data (PNG / TIFF)", self)
+        self.checkboxFullDepth.setChecked(options.full_depth and allow_full_depth)
+        self.checkboxFullDepth.setToolTip("Save grayscale / enhanced results before the\n"
+                                          "brightness/contrast window quantizes them to 8 bits")
+        self.allow_full_depth = allow_full_depth
+        layout.addRow(self.checkboxFullDepth)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+        self.comboFormat.currentTextChanged.connect(self.update_enabled)
+        self.update_enabled()
+
+    def extension(self) -> str:
+        if self._extension is not None:
+            return self._extension
+        return EXPORT_FORMATS[self.comboFormat.currentText()]
+
+    def update_enabled(self):
+        name = SAVE_FORMATS[self.extension().lower()]
+        self.spinQuality.setEnabled(name in ("JPEG", "WebP"))
+        self.spinCompression.setEnabled(name == "PNG")
+        self.comboTiff.setEnabled(name == "TIFF")
+        self.checkboxFullDepth.setEnabled(self.allow_full_depth
+                                          and self.extension().lower() in FULL_DEPTH_FORMATS)
+
+    def options(self) -> SaveOptions:
+        return SaveOptions(quality=self.spinQuality.value(),
+                           png_compression=self.spinCompression.value(),
+                           tiff_compression=self.comboTiff.currentText(),
+                           full_depth=self.checkboxFullDepth.isChecked()
+                           and self.checkboxFullDepth.isEnabled())
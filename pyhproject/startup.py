@@ -0,0 +1,48 @@
+"""
+Cold-start timing for the GUI (``widget.py --profile-startup``)
+
+Kept free of Qt, OpenCV and numpy imports so it can be the first thing the
+application imports. Times are measured from the moment this module is
+imported, i.e. after the Python interpreter itself has started.
+"""
+
+# -*- coding: utf-8 -*-
+
+import time
+from typing import List, Optional, Tuple
+
+# Time to first paint the reading stations should stay under.
+DEFAULT_BUDGET_MS = 750.0
+
+
+class StartupProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.marks: List[Tuple[str, float]] = []
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter()))
+
+    def elapsed_ms(self, name: str) -> Optional[float]:
+        for mark, at in self.marks:
+            if mark == name:
+                return (at - self.start) * 1e3
+        return None
+
+    def report(self, budget_ms: float = DEFAULT_BUDGET_MS, milestone: str = "first paint") -> bool:
+        """Print every phase and whether ``milestone`` was reached within the budget."""
+        previous = self.start
+        for name, at in self.marks:
+            print(f"[Startup] {name:<24} +{(at - previous) * 1e3:7.1f} ms   at {(at - self.start) * 1e3:7.1f} ms")
+            previous = at
+        reached = self.elapsed_ms(milestone)
+        if reached is None:
+            print(f"[Startup] '{milestone}' was not reached")
+            return False
+        within = reached <= budget_ms
+        print(f"[Startup] {milestone}: {reached:.1f} ms (budget {budget_ms:.0f} ms) - "
+              f"{'OK' if within else 'OVER BUDGET'}")
+        return within
+
+
+STARTUP = StartupProfile()
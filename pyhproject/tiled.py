@@ -0,0 +1,398 @@
+"""
+Tiled, memory-bounded processing for images larger than RAM
+
+The pipeline stages run tile by tile. Each tile is read with a halo of
+neighbouring pixels so blur, Canny and focus borders are seamless. CLAHE uses
+lookup tables built in a streaming pre-pass, and Canny hysteresis (which links
+edges across the whole image) is resolved over a disk-backed edge map. The
+output is identical to processing the whole image in memory.
+
+Usage:
+    python tiled.py in.tiff out.tiff --op edges --clahe --max-memory 512
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from clahe import ClaheGrid, apply_luts, streamed_luts
+from pipeline import Stage, stage_plan
+from processing import ProcessingParams, read_image
+
+# Pixels of context each stage needs around a tile for an exact result.
+STAGE_HALO = {
+    "grayscale": 0,
+    "clahe": 0,
+    "brightness_contrast": 0,
+    "8bit": 0,
+    "blur": 2,
+    "canny": 2,
+    "focus": 7,
+}
+
+# Rough working set per tile pixel (input, grayscale, CLAHE float blocks,
+# blur/Canny intermediates); used to derive the tile size from the memory cap.
+BYTES_PER_TILE_PIXEL = 48
+BYTES_PER_BAND_PIXEL = 12
+
+_CANDIDATE = 1
+_EDGE = 2
+
+
+@lru_cache(maxsize=None)
+def optional_tifffile():
+    """The tifffile module, or None when it is not installed.
+
+    Imported on first use: it takes longer to import than OpenCV and most
+    sessions never open a TIFF.
+    """
+    try:
+        import tifffile
+    except ImportError:
+        return None
+    return tifffile
+
+
+def _require_tifffile():
+    tifffile = optional_tifffile()
+    if tifffile is None:
+        raise ImportError("Tiled TIFF support requires the 'tifffile' package (pip install tifffile)")
+    return tifffile
+
+
+class ArraySource:
+    """Region reader over an in-memory or memory-mapped array."""
+
+    def __init__(self, array: np.ndarray):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        return np.ascontiguousarray(self.array[y0:y1, x0:x1])
+
+    def close(self):
+        pass
+
+
+class TiffSource:
+    """Region reader over a tiled or stripped TIFF page.
+
+    Only the segments (tiles or strips) overlapping a requested region are
+    decoded; recently used segments are kept in a cache bounded by bytes.
+    """
+
+    def __init__(self, path, page: int = 0, cache_bytes: int = 64 << 20, level: int = 0):
+        tifffile = _require_tifffile()
+        self._tiff = tifffile.TiffFile(str(path))
+        if level:
+            # Reduced-resolution level of a pyramidal TIFF (often a SubIFD).
+            self._page = self._tiff.series[0].levels[level].keyframe
+        else:
+            self._page = self._tiff.pages[page]
+        p = self._page
+        if p.samplesperpixel > 1 and p.planarconfig != 1:
+            self._tiff.close()
+            raise ValueError("Planar-separate TIFF files are not supported")
+
+        self.shape = p.shape
+        self.dtype = p.dtype
+        height, width = self.shape[:2]
+        if p.is_tiled:
+            self.segment_height, self.segment_width = p.tilelength, p.tilewidth
+        else:
+            self.segment_height, self.segment_width = (p.rowsperstrip or height), width
+        self._segments_across = math.ceil(width / self.segment_width)
+
+        self._cache: "OrderedDict[int, np.ndarray]" = OrderedDict()
+        self._cache_bytes = cache_bytes
+        self._cached_bytes = 0
+
+    def _segment(self, index: int) -> np.ndarray:
+        segment = self._cache.get(index)
+        if segment is not None:
+            self._cache.move_to_end(index)
+            return segment
+
+        p = self._page
+        fh = self._tiff.filehandle
+        fh.seek(p.dataoffsets[index])
+        data = fh.read(p.databytecounts[index])
+        decoded, _, _ = p.decode(data, index, jpegtables=p.jpegtables)
+        segment = decoded[0]
+        if segment.shape[-1] == 1:
+            segment = segment[..., 0]
+
+        self._cache[index] = segment
+        self._cached_bytes += segment.nbytes
+        while self._cached_bytes > self._cache_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached_bytes -= evicted.nbytes
+        return segment
+
+    def read(self, y0: int, y1: int, x0: int, x1: int) -> np.ndarray:
+        out = np.empty((y1 - y0, x1 - x0) + tuple(self.shape[2:]), dtype=self.dtype)
+        sh, sw = self.segment_height, self.segment_width
+        for sy in range(y0 // sh, (y1 - 1) // sh + 1):
+            for sx in range(x0 // sw, (x1 - 1) // sw + 1):
+                segment = self._segment(sy * self._segments_across + sx)
+                ya, yb = max(y0, sy * sh), min(y1, (sy + 1) * sh)
+                xa, xb = max(x0, sx * sw), min(x1, (sx + 1) * sw)
+                out[ya - y0:yb - y0, xa - x0:xb - x0] = \
+                    segment[ya - sy * sh:yb - sy * sh, xa - sx * sw:xb - sx * sw]
+        return out
+
+    def close(self):
+        self._cache.clear()
+        self._tiff.close()
+
+
+def open_source(path, cache_bytes: int = 64 << 20):
+    path = Path(path)
+    suffix = path.suffix.lower()
+    if suffix == ".npy":
+        return ArraySource(np.load(str(path), mmap_mode="r"))
+    if suffix in (".tif", ".tiff"):
+        tifffile = _require_tifffile()
+        with tifffile.TiffFile(str(path)) as tif:
+            memmappable = tif.pages[0].is_memmappable
+        if memmappable:
+            return ArraySource(tifffile.memmap(str(path), mode="r"))
+        return TiffSource(path, cache_bytes=cache_bytes)
+    # Formats without random access are decoded in full.
+    return ArraySource(read_image(path))
+
+
+def _split_plan(plan: List[Stage]) -> Tuple[List[Stage], Optional[Stage], List[Stage]]:
+    for i, stage in enumerate(plan):
+        if stage[0] == "canny":
+            return plan[:i], stage, plan[i + 1:]
+    return plan, None, []
+
+
+def _halo(stages: List[Stage]) -> int:
+    return sum(STAGE_HALO[name] for name, _, _ in stages)
+
+
+class TiledEngine:
+    """Runs pipeline operations over a region source within a memory cap."""
+
+    def __init__(self, max_memory: int = 256 << 20, tile_size: Optional[int] = None,
+                 temp_dir: Optional[str] = None):
+        self.max_memory = max_memory
+        self.tile_size = tile_size
+        self.temp_dir = temp_dir
+
+    def tile_size_for(self, halo: int) -> int:
+        if self.tile_size:
+            return self.tile_size
+        side = int(math.sqrt(self.max_memory / BYTES_PER_TILE_PIXEL)) - 2 * halo
+        # TIFF tiles must be multiples of 16.
+        return max(64, side // 16 * 16)
+
+    def band_rows_for(self, width: int) -> int:
+        return max(16, self.max_memory // max(1, width * BYTES_PER_BAND_PIXEL))
+
+    def process_tiles(self, source, operation: str,
+                      params: ProcessingParams) -> Iterator[Tuple[int, int, np.ndarray]]:
+        """Yield ``(y, x, tile)`` in row-major tile order."""
+        height, width = source.shape[:2]
+        params = self._resolve_data_range(source, params)
+        before, canny, after = _split_plan(stage_plan(operation, params))
+        luts = self._clahe_luts(source, before)
+
+        if canny is None:
+            yield from self._run_tiles(height, width, lambda y0, y1, x0, x1: source.read(y0, y1, x0, x1),
+                                       before, luts)
+            return
+
+        fd, map_path = tempfile.mkstemp(suffix=".edges", dir=self.temp_dir)
+        os.close(fd)
+        edge_map = None
+        try:
+            edge_map = np.memmap(map_path, dtype=np.uint8, mode="w+", shape=(height, width))
+            self._edge_candidates(source, before, canny, luts, edge_map)
+            self._hysteresis(edge_map)
+            yield from self._run_tiles(height, width, lambda y0, y1, x0, x1: edge_map[y0:y1, x0:x1],
+                                       after, None, edges=True)
+        finally:
+            # The mapping must be released before the file can be removed on Windows.
+            edge_map = None
+            os.remove(map_path)
+
+    def process_to_array(self, source, operation: str, params: ProcessingParams,
+                         out: Optional[np.ndarray] = None) -> np.ndarray:
+        if out is None:
+            out = np.empty(source.shape[:2], dtype=np.uint8)
+        for y0, x0, tile in self.process_tiles(source, operation, params):
+            out[y0:y0 + tile.shape[0], x0:x0 + tile.shape[1]] = tile
+        return out
+
+    def process_to_tiff(self, source, path, operation: str, params: ProcessingParams,
+                        compression: Optional[str] = "zlib"):
+        tifffile = _require_tifffile()
+        height, width = source.shape[:2]
+        before, canny, after = _split_plan(stage_plan(operation, params))
+        tile = self.tile_size_for(_halo(before) + (_halo(after) if canny else 0))
+        engine = TiledEngine(self.max_memory, tile, self.temp_dir)
+        tiles = (t for _, _, t in engine.process_tiles(source, operation, params))
+        tifffile.imwrite(str(path), tiles, shape=(height, width), dtype=np.uint8,
+                         tile=(tile, tile), compression=compression,
+                         bigtiff=height * width > 2 ** 32 - 2 ** 25)
+
+    def _resolve_data_range(self, source, params: ProcessingParams) -> ProcessingParams:
+        # Images deeper than 8 bits are mapped to the working depth over the
+        # range of the whole image, not of each tile.
+        if source.dtype == np.uint8 or params.data_range is not None:
+            return params
+        height, width = source.shape[:2]
+        band = self.band_rows_for(width)
+        low, high = math.inf, -math.inf
+        for y0 in range(0, height, band):
+            region = source.read(y0, min(height, y0 + band), 0, width)
+            low, high = min(low, float(region.min())), max(high, float(region.max()))
+        return replace(params, data_range=(low, high))
+
+    def _clahe_luts(self, source, before: List[Stage]):
+        for i, (name, _, args) in enumerate(before):
+            if name != "clahe":
+                continue
+            if source.dtype != np.uint8:
+                raise ValueError("Tiled CLAHE supports 8-bit images only")
+            height, width = source.shape[:2]
+            grid = ClaheGrid(height, width, args[1])
+            prefix = before[:i]
+
+            def read_input(y0, y1, x0, x1):
+                region = source.read(y0, y1, x0, x1)
+                for _, func, stage_args in prefix:
+                    region = func(region, *stage_args)
+                return region
+
+            return grid, streamed_luts(read_input, grid, args[0], self.band_rows_for(width))
+        return None
+
+    def _run_stages(self, region: np.ndarray, stages: List[Stage], luts, y0: int, x0: int) -> np.ndarray:
+        for name, func, args in stages:
+            if name == "clahe":
+                grid, tables = luts
+                region = apply_luts(region, tables, grid, y0, x0)
+            else:
+                region = func(region, *args)
+        return region
+
+    def _run_tiles(self, height: int, width: int, read, stages: List[Stage], luts,
+                   edges: bool = False) -> Iterator[Tuple[int, int, np.ndarray]]:
+        halo = _halo(stages)
+        tile = self.tile_size_for(halo)
+        for ty in range(0, height, tile):
+            for tx in range(0, width, tile):
+                y0, x0 = max(0, ty - halo), max(0, tx - halo)
+                y1, x1 = min(height, ty + tile + halo), min(width, tx + tile + halo)
+                region = read(y0, y1, x0, x1)
+                if edges:
+                    region = np.where(region == _EDGE, np.uint8(255), np.uint8(0))
+                region = self._run_stages(region, stages, luts, y0, x0)
+                yield ty, tx, region[ty - y0:ty - y0 + min(tile, height - ty),
+                                     tx - x0:tx - x0 + min(tile, width - tx)]
+
+    def _edge_candidates(self, source, before: List[Stage], canny: Stage, luts, edge_map: np.memmap):
+        # Canny(t, t) marks exactly the non-maximum-suppressed pixels above t,
+        # so the two calls give the hysteresis candidates and the strong seeds.
+        # Both are local and can be computed tile by tile.
+        low, high = sorted(canny[2])
+        height, width = source.shape[:2]
+        halo = _halo(before) + STAGE_HALO["canny"]
+        tile = self.tile_size_for(halo)
+        for ty in range(0, height, tile):
+            for tx in range(0, width, tile):
+                y0, x0 = max(0, ty - halo), max(0, tx - halo)
+                y1, x1 = min(height, ty + tile + halo), min(width, tx + tile + halo)
+                region = self._run_stages(source.read(y0, y1, x0, x1), before, luts, y0, x0)
+                candidates = cv2.Canny(region, low, low)
+                seeds = cv2.Canny(region, high, high)
+                labels = np.where(seeds > 0, np.uint8(_EDGE),
+                                  np.where(candidates > 0, np.uint8(_CANDIDATE), np.uint8(0)))
+                th, tw = min(tile, height - ty), min(tile, width - tx)
+                edge_map[ty:ty + th, tx:tx + tw] = labels[ty - y0:ty - y0 + th, tx - x0:tx - x0 + tw]
+
+    def _hysteresis(self, edge_map: np.memmap):
+        # Keep every 8-connected candidate component that touches a seed.
+        # Bands overlap their neighbours by one row so components spanning
+        # bands propagate. Sweeps alternate down and up, revisiting only bands
+        # whose shared rows were changed by a neighbour.
+        height = edge_map.shape[0]
+        band = self.band_rows_for(edge_map.shape[1])
+        starts = list(range(0, height, band))
+        dirty = [True] * len(starts)
+        order = list(range(len(starts)))
+        while any(dirty):
+            for i in order:
+                if not dirty[i]:
+                    continue
+                dirty[i] = False
+                y0, y1 = max(0, starts[i] - 1), min(height, starts[i] + band + 1)
+                block = np.asarray(edge_map[y0:y1])
+                count, labels = cv2.connectedComponents((block > 0).astype(np.uint8), connectivity=8)
+                if count <= 1:
+                    continue
+                accepted = np.zeros(count, dtype=bool)
+                accepted[labels[block == _EDGE]] = True
+                accepted[0] = False
+                grow = accepted[labels] & (block == _CANDIDATE)
+                if not grow.any():
+                    continue
+                block = block.copy()
+                block[grow] = _EDGE
+                edge_map[y0:y1] = block
+                if i > 0 and grow[:2].any():
+                    dirty[i - 1] = True
+                if i + 1 < len(starts) and grow[-2:].any():
+                    dirty[i + 1] = True
+            order.reverse()
+
+
+def main(argv=None) -> int:
+    from batch import add_processing_arguments, params_from_args
+
+    parser = argparse.ArgumentParser(description="Process an image larger than RAM tile by tile")
+    parser.add_argument("input", type=Path, help="source image (TIFF, .npy or any OpenCV format)")
+    parser.add_argument("output", type=Path, help="destination tiled TIFF")
+    add_processing_arguments(parser)
+    parser.add_argument("--max-memory", type=int, default=256, help="peak working memory in MB")
+    parser.add_argument("--tile-size", type=int, default=None, help="tile edge in pixels (multiple of 16)")
+    parser.add_argument("--compression", default="zlib", help="TIFF compression (zlib, lzw, none)")
+    args = parser.parse_args(argv)
+
+    max_memory = args.max_memory << 20
+    source = open_source(args.input, cache_bytes=max_memory // 4)
+    try:
+        start = time.perf_counter()
+        engine = TiledEngine(max_memory=max_memory, tile_size=args.tile_size)
+        compression = None if args.compression == "none" else args.compression
+        engine.process_to_tiff(source, args.output, args.op, params_from_args(args), compression)
+        elapsed = time.perf_counter() - start
+    finally:
+        source.close()
+
+    height, width = source.shape[:2]
+    print(f"[OK] Processed {width}x{height} image in {elapsed:.2f}s "
+          f"({width * height / elapsed / 1e6:.1f} MP/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
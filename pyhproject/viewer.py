@@ -0,0 +1,249 @@
+"""
+Result viewer with pan and zoom that only resamples the visible region
+
+Replaces the per-operation OpenCV HighGUI windows with one Qt window. Each
+repaint crops the visible part of the pyramid level closest to the current
+zoom and resizes just that crop into a reusable buffer at the screen's
+device resolution, so panning and zooming cost the same on a 1 MP and a
+100 MP result. Pyramid levels are built the first time a zoom needs them.
+
+Controls: Ctrl+wheel zooms around the cursor, dragging pans, a click (press
+and release without moving) and the plain wheel are reported to the owner
+(magnifier and focus control), F or 0 fits the image, 1 shows it at 100%.
+"""
+
+# -*- coding: utf-8 -*-
+
+import math
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtCore import QPointF, Qt, Signal
+from PySide6.QtGui import QColor, QPainter
+from PySide6.QtWidgets import QWidget
+
+from display import DisplayBuffer
+from instrumentation import METRICS
+
+MAX_ZOOM = 32.0
+# Drags shorter than this (in logical pixels) still count as a click.
+CLICK_SLOP = 4
+
+
+class ResultViewer(QWidget):
+
+    clicked = Signal(int, int)       # image coordinates of a click
+    focus_scrolled = Signal(int)     # +1 / -1 per plain wheel step
+
+    def __init__(self, parent: Optional[QWidget] = None):
+        super().__init__(parent, Qt.Window)
+        self.setWindowTitle("Processed Result")
+        self.resize(800, 800)
+        self.setMouseTracking(False)
+        self.setFocusPolicy(Qt.StrongFocus)
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+        self.scale = 1.0
+        self.center = (0.0, 0.0)
+        self._image: Optional[np.ndarray] = None
+        self._levels: List[np.ndarray] = []
+        self._fit_pending = True
+        self._display = DisplayBuffer()
+        self._qimage = None
+        self._render_key = None
+        self._target = (0.0, 0.0)
+        self._press: Optional[QPointF] = None
+        self._dragging = False
+
+    @property
+    def image(self) -> Optional[np.ndarray]:
+        return self._image
+
+    def set_image(self, image: np.ndarray, title: Optional[str] = None, keep_view: bool = True):
+        """Show ``image``; with ``keep_view`` the visible area is kept when the new
+        image has the same aspect ratio (e.g. a preview proxy replaced by the
+        full-resolution result)."""
+        old = self._image
+        self._image = image
+        self._levels = [image]
+        self._render_key = None
+        if title is not None:
+            self.setWindowTitle(title)
+        same_aspect = (old is not None and
+                       abs(old.shape[1] * image.shape[0] - old.shape[0] * image.shape[1]) <= max(old.shape[:2]))
+        if keep_view and same_aspect and not self._fit_pending:
+            ratio = image.shape[1] / old.shape[1]
+            self.center = (self.center[0] * ratio, self.center[1] * ratio)
+            self.scale /= ratio
+        else:
+            self._fit_pending = True
+        self.update()
+
+    def release(self):
+        self._image = None
+        self._levels = []
+        self._display.release()
+        self._qimage = None
+        self._render_key = None
+        self._fit_pending = True
+
+    # -- view geometry -------------------------------------------------
+
+    def fit(self):
+        if self._image is None:
+            return
+        h, w = self._image.shape[:2]
+        self.scale = min(self.width() / w, self.height() / h)
+        self.center = (w / 2.0, h / 2.0)
+        self._fit_pending = False
+        self.update()
+
+    def zoom_to(self, scale: float, anchor: Optional[QPointF] = None):
+        """Set the zoom, keeping the image point under ``anchor`` in place."""
+        if self._image is None:
+            return
+        h, w = self._image.shape[:2]
+        min_scale = min(self.width() / w, self.height() / h, 1.0) / 2
+        scale = min(max(scale, min_scale), MAX_ZOOM)
+        if anchor is None:
+            anchor = QPointF(self.width() / 2, self.height() / 2)
+        ix, iy = self.image_point(anchor)
+        self.scale = scale
+        self.center = (ix - (anchor.x() - self.width() / 2) / scale,
+                       iy - (anchor.y() - self.height() / 2) / scale)
+        self.update()
+
+    def image_point(self, pos: QPointF) -> Tuple[float, float]:
+        return (self.center[0] + (pos.x() - self.width() / 2) / self.scale,
+                self.center[1] + (pos.y() - self.height() / 2) / self.scale)
+
+    def _level(self, index: int) -> np.ndarray:
+        while len(self._levels) <= index:
+            self._levels.append(cv2.pyrDown(self._levels[-1]))
+        return self._levels[index]
+
+    def _level_for(self, device_scale: float) -> int:
+        # Coarsest level that still has at least one pixel per device pixel.
+        if device_scale >= 1.0:
+            return 0
+        level = int(math.floor(-math.log2(device_scale)))
+        h, w = self._image.shape[:2]
+        while level > 0 and min(h, w) >> level < 16:
+            level -= 1
+        return level
+
+    # -- rendering -----------------------------------------------------
+
+    def _render(self):
+        dpr = self.devicePixelRatioF()
+        h, w = self._image.shape[:2]
+        half_w, half_h = self.width() / (2 * self.scale), self.height() / (2 * self.scale)
+        x0, y0 = self.center[0] - half_w, self.center[1] - half_h
+        vx0, vy0 = max(0.0, x0), max(0.0, y0)
+        vx1, vy1 = min(float(w), self.center[0] + half_w), min(float(h), self.center[1] + half_h)
+        if vx1 <= vx0 or vy1 <= vy0:
+            self._qimage = None
+            return
+
+        level = self._level_for(self.scale * dpr)
+        factor = 1 << level
+        source = self._level(level)
+        sh, sw = source.shape[:2]
+        lx0, ly0 = int(vx0 // factor), int(vy0 // factor)
+        lx1, ly1 = min(sw, int(math.ceil(vx1 / factor))), min(sh, int(math.ceil(vy1 / factor)))
+        if lx1 <= lx0 or ly1 <= ly0:
+            self._qimage = None
+            return
+
+        device_scale = self.scale * dpr * factor
+        out_w = max(1, int(round((lx1 - lx0) * device_scale)))
+        out_h = max(1, int(round((ly1 - ly0) * device_scale)))
+        self._target = ((lx0 * factor - x0) * self.scale, (ly0 * factor - y0) * self.scale)
+        key = (id(source), lx0, ly0, lx1, ly1, out_w, out_h)
+        if key == self._render_key:
+            return
+
+        if device_scale >= 2.0:
+            interpolation = cv2.INTER_NEAREST  # individual pixels stay visible
+        elif device_scale > 1.0:
+            interpolation = cv2.INTER_LINEAR
+        else:
+            interpolation = cv2.INTER_AREA
+        with METRICS.measure("result_view", "display") as measurement:
+            self._qimage = self._display.resize_from(source[ly0:ly1, lx0:lx1], out_w, out_h,
+                                                     interpolation, dpr)
+            measurement.set_result(self._display.array)
+        self._render_key = key
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor("#2c3e50"))
+        if self._image is not None:
+            if self._fit_pending:
+                self.fit()
+            self._render()
+            if self._qimage is not None:
+                painter.drawImage(QPointF(*self._target), self._qimage)
+            painter.setPen(QColor("#ecf0f1"))
+            painter.drawText(self.rect().adjusted(8, 8, -8, -8), Qt.AlignRight | Qt.AlignTop,
+                             f"{self.scale * 100:.0f}%")
+        painter.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._render_key = None
+
+    # -- interaction ---------------------------------------------------
+
+    def wheelEvent(self, event):
+        steps = event.angleDelta().y() / 120
+        if steps == 0:
+            return
+        if event.modifiers() & Qt.ControlModifier:
+            self.zoom_to(self.scale * 1.25 ** steps, event.position())
+        else:
+            self.focus_scrolled.emit(1 if steps > 0 else -1)
+        event.accept()
+
+    def mousePressEvent(self, event):
+        if event.button() in (Qt.LeftButton, Qt.MiddleButton):
+            self._press = event.position()
+            self._dragging = event.button() == Qt.MiddleButton
+
+    def mouseMoveEvent(self, event):
+        if self._press is None:
+            return
+        delta = event.position() - self._press
+        if not self._dragging and abs(delta.x()) + abs(delta.y()) < CLICK_SLOP:
+            return
+        self._dragging = True
+        self._press = event.position()
+        self.center = (self.center[0] - delta.x() / self.scale, self.center[1] - delta.y() / self.scale)
+        self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self._press is not None and not self._dragging and self._image is not None:
+            x, y = self.image_point(event.position())
+            h, w = self._image.shape[:2]
+            if 0 <= x < w and 0 <= y < h:
+                self.clicked.emit(int(x), int(y))
+        self._press = None
+        self._dragging = False
+
+    def keyPressEvent(self, event):
+        key = event.key()
+        if key in (Qt.Key_F, Qt.Key_0):
+            self.fit()
+        elif key == Qt.Key_1:
+            self.zoom_to(1.0)
+        elif key in (Qt.Key_Plus, Qt.Key_Equal):
+            self.zoom_to(self.scale * 1.25)
+        elif key == Qt.Key_Minus:
+            self.zoom_to(self.scale / 1.25)
+        else:
+            super().keyPressEvent(event)
+
+    def closeEvent(self, event):
+        # Drop the result and its pyramid; the owner re-opens the viewer on demand.
+        self.release()
+        super().closeEvent(event)
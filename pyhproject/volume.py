@@ -0,0 +1,246 @@
+"""
+Volume processing: one operation applied to every slice of a frame stack
+
+Slices are processed on a thread pool (OpenCV releases the GIL) into a single
+preallocated (slices, height, width) array. Slices can be computed all at once
+or lazily around the slice being viewed, with a lookahead in the scrolling
+direction so scrubbing through a series rarely waits.
+
+Usage:
+    python volume.py series.dcm edges.npy --op edges --clahe --workers 8
+"""
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from batch import add_processing_arguments, params_from_args
+from disk_cache import DiskCache, add_cache_arguments, cache_from_args
+from instrumentation import METRICS
+from loader import FrameStack, open_stack
+from pipeline import run_cached
+from processing import OPERATIONS, ProcessingParams
+from tiled import optional_tifffile
+
+
+@dataclass
+class VolumeReport:
+    slices: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def slices_per_second(self) -> float:
+        return self.slices / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class VolumeProcessor:
+    """Processed slices of a FrameStack for the current operation and parameters.
+
+    ``configure`` selects the operation; results already computed for other
+    settings are discarded, but the output array is reused. Returned slices
+    are views into the shared output array.
+    """
+
+    def __init__(self, stack: FrameStack, workers: Optional[int] = None, lookahead: int = 8,
+                 disk_cache: Optional[DiskCache] = None):
+        self.stack = stack
+        self.lookahead = lookahead
+        self.disk_cache = disk_cache
+        self.shape = (len(stack),) + tuple(stack.frame(0).shape[:2])
+        self.result = np.empty(self.shape, dtype=np.uint8)
+        self._done = np.zeros(len(stack), dtype=bool)
+        self._pending: Dict[int, Future] = {}
+        self._key: Optional[Tuple[str, ProcessingParams]] = None
+        self._generation = 0
+        # Re-entrant: done callbacks may run inline while the lock is held.
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                            thread_name_prefix="volume")
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def completed(self) -> int:
+        return int(self._done.sum())
+
+    def configure(self, operation: str, params: ProcessingParams):
+        if operation not in OPERATIONS:
+            raise ValueError(f"Unknown operation '{operation}', expected one of {', '.join(OPERATIONS)}")
+        with self._lock:
+            if self._key == (operation, params):
+                return
+            self._key = (operation, params)
+            self._generation += 1
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+            self._done[:] = False
+
+    @property
+    def busy(self) -> bool:
+        return bool(self._pending)
+
+    def is_ready(self, index: int) -> bool:
+        return bool(self._done[index])
+
+    def slice(self, index: int) -> np.ndarray:
+        """The processed slice, computed now if it is not ready yet."""
+        with self._lock:
+            if self._done[index]:
+                return self.result[index]
+            future = self._pending.get(index)
+            generation = self._generation
+            key = self._key
+        if future is not None and not future.cancel():
+            # Already running on a worker: waiting is quicker than redoing it.
+            future.result()
+        else:
+            self._process(index, generation, key)
+        return self.result[index]
+
+    def prefetch(self, index: int, direction: int = 1):
+        """Queue the slices ahead of ``index`` and drop queued slices far behind it."""
+        step = 1 if direction >= 0 else -1
+        wanted = [index + step * i for i in range(1, self.lookahead + 1)]
+        wanted = [i for i in wanted if 0 <= i < len(self)]
+        with self._lock:
+            for i, future in list(self._pending.items()):
+                if abs(i - index) > self.lookahead and future.cancel():
+                    del self._pending[i]
+            self._submit(wanted)
+
+    def process_all(self, progress: Optional[Callable[[int], None]] = None) -> VolumeReport:
+        """Process every slice not computed yet and wait for them."""
+        start = time.perf_counter()
+        with self._lock:
+            todo = [i for i in range(len(self)) if not self._done[i]]
+            self._submit(todo)
+            futures = [self._pending[i] for i in todo if i in self._pending]
+        for done, future in enumerate(futures, 1):
+            future.result()
+            if progress is not None:
+                progress(done)
+        return VolumeReport(slices=len(todo), elapsed=time.perf_counter() - start)
+
+    def start_all(self):
+        """Queue every slice not computed yet without waiting."""
+        with self._lock:
+            self._submit([i for i in range(len(self)) if not self._done[i]])
+
+    def _submit(self, indices):
+        # Must be called with the lock held.
+        for i in indices:
+            if self._done[i] or i in self._pending:
+                continue
+            future = self._executor.submit(self._process, i, self._generation, self._key)
+            future.add_done_callback(lambda _, i=i: self._forget(i))
+            self._pending[i] = future
+
+    def _forget(self, index: int):
+        with self._lock:
+            future = self._pending.get(index)
+            if future is not None and future.done():
+                del self._pending[index]
+
+    def _process(self, index: int, generation: int, key: Tuple[str, ProcessingParams]):
+        operation, params = key
+        with METRICS.measure("read_frame", "load", detail=str(index)) as measurement:
+            frame = self.stack.read_frame(index)
+            measurement.set_result(frame)
+        processed = run_cached(frame, operation, params, self.disk_cache, category="volume")
+        with self._lock:
+            # Settings changed while this slice was running: drop it.
+            if generation != self._generation:
+                return
+            self.result[index] = processed
+            self._done[index] = True
+
+    def close(self):
+        with self._lock:
+            self._generation += 1
+            # Cancelling runs the done callback, which removes the entry: iterate a copy.
+            for future in list(self._pending.values()):
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+
+def save_volume(path, volume: np.ndarray):
+    path = Path(path)
+    if path.suffix.lower() in (".tif", ".tiff"):
+        tifffile = optional_tifffile()
+        if tifffile is None:
+            raise ImportError("TIFF volume output requires the 'tifffile' package (pip install tifffile)")
+        tifffile.imwrite(str(path), volume)
+    else:
+        np.save(str(path), volume)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Process every slice of a DICOM, TIFF or NumPy stack")
+    parser.add_argument("input", type=Path)
+    parser.add_argument("output", type=Path, help="output volume (.npy, or .tif with tifffile)")
+    add_processing_arguments(parser)
+    add_cache_arguments(parser)
+    parser.add_argument("--workers", type=int, default=None, help="worker threads (default: all cores)")
+    parser.add_argument("--metrics-log", type=Path, default=None,
+                        help="append per-stage timings to this file as JSON lines")
+    parser.add_argument("--track-allocations", action="store_true",
+                        help="record the memory each stage allocates (tracemalloc; slows processing down)")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+
+    if not args.input.is_file():
+        print(f"[ERROR] Input file not found: {args.input}")
+        return 2
+
+    if args.metrics_log is not None:
+        METRICS.open_log(args.metrics_log)
+    if args.track_allocations:
+        METRICS.track_allocations()
+    stack = open_stack(args.input)
+    params = params_from_args(args)
+    first = stack.frame(0).to_array()
+    if first.dtype != np.uint8:
+        # One window for the whole series, taken from the first slice.
+        params = replace(params, data_range=(float(first.min()), float(first.max())))
+
+    disk_cache = cache_from_args(args)
+    processor = VolumeProcessor(stack, workers=args.workers, disk_cache=disk_cache)
+    try:
+        processor.configure(args.op, params)
+
+        def progress(done: int):
+            if done % 100 == 0:
+                print(f"[Volume] {done}/{len(processor)} slices")
+
+        report = processor.process_all(progress)
+        save_volume(args.output, processor.result)
+    finally:
+        processor.close()
+        if disk_cache is not None:
+            disk_cache.close()
+        stack.close()
+        METRICS.close_log()
+
+    print(f"[OK] Processed {report.slices} slices in {report.elapsed:.2f}s")
+    print(f"   Throughput: {report.slices_per_second:.1f} slices/sec")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
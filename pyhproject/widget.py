@@ -7,94 +7,201 @@ Department: Biomedical Engineering, Ankara University
 
 # -*- coding: utf-8 -*-
 
+from __future__ import annotations
+
+from startup import DEFAULT_BUDGET_MS, STARTUP
+
+import argparse
+import math
 import sys
-import cv2
-import numpy as np
+import threading
+import time
 from pathlib import Path
 from typing import Optional
-import os
 
 if sys.platform == "win32":
-    try:
-        os.system("chcp 65001")
-    except:
-        pass
-
-from PySide6.QtWidgets import QApplication, QWidget, QPushButton, QLabel, QSlider, QFileDialog, QCheckBox, QMessageBox
-from PySide6.QtGui import QPixmap, QImage, QFont
-from PySide6.QtCore import Qt
-
-class ZoomWindow(QWidget):
-
-    def __init__(self, image: np.ndarray, title: str = "Magnified Region"):
-        super().__init__()
-        self.setWindowTitle(title)
-        self.setGeometry(200, 200, 500, 500)
-        self.setup_zoom_ui()
-        self.display_zoomed_image(image)
-
-    def setup_zoom_ui(self):
-        self.setStyleSheet("""
-            QWidget {
-                background-color: #2c3e50;
-                color: white;
-            }
-            QLabel {
-                border: 2px solid #34495e;
-                border-radius: 8px;
-                background-color: #ecf0f1;
-                padding: 5px;
-            }
-        """)
-
-        self.zoom_label = QLabel(self)
-        self.zoom_label.setGeometry(25, 25, 450, 450)
-        self.zoom_label.setAlignment(Qt.AlignCenter)
-
-    def display_zoomed_image(self, cv_image: np.ndarray):
-        if cv_image is None or cv_image.size == 0:
-            self.zoom_label.setText("No image data available")
-            return
-
+    # UTF-8 console output without spawning a "chcp" shell at startup.
+    for stream in (sys.stdout, sys.stderr):
         try:
-            if len(cv_image.shape) == 3:
-                height, width, channels = cv_image.shape
-                bytes_per_line = width * channels
-                qt_image = QImage(cv_image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-            else:
-                height, width = cv_image.shape
-                bytes_per_line = width
-                qt_image = QImage(cv_image.data, width, height, bytes_per_line, QImage.Format_Grayscale8)
+            stream.reconfigure(encoding="utf-8")
+        except (AttributeError, ValueError):
+            pass
+
+from PySide6.QtWidgets import QApplication, QWidget, QPushButton, QLabel, QSlider, QFileDialog, QCheckBox, QMessageBox, QComboBox, QDialog, QMenu, QDoubleSpinBox, QSpinBox
+from PySide6.QtGui import QPixmap, QFont, QShortcut, QKeySequence
+from PySide6.QtCore import QEvent, Qt, QTimer, Signal
+
+STARTUP.mark("import Qt")
+
+
+def load_engine():
+    """Import OpenCV, numpy and the processing modules.
+
+    They take longer to import than Qt itself, so the window is shown first
+    and this runs once it has been painted (or when a window is created
+    without ``defer_engine``). The names are bound at module level.
+    """
+    global cv2, np, ProcessingPipeline, run_cached, DiskCache, pyramid_key, PreviewScheduler
+    global FrameStack, LazyImage, PREVIEW_SIZE, OPERATIONS, ProcessingParams, apply_focus_effect
+    global to_display_depth, VolumeProcessor, ImageNavigator, NavigatorEntry, ZOOM_INTERPOLATIONS
+    global Loupe, RegionCache, ZoomWindowPool, crop_region, magnify, SAVE_FORMATS, ImageWriter
+    global SaveOptions, WriteResult, SaveOptionsDialog, METRICS, PerfOverlay, ResultViewer
+    global CannySweep, SweepSheet, threshold_grid, DisplayBuffer, CLAHE_ENGINE, CinePlayer, open_cine
+    if "ProcessingPipeline" in globals():
+        return
+    import cv2
+    import numpy as np
+    from pipeline import ProcessingPipeline, run_cached
+    from disk_cache import DiskCache, pyramid_key
+    from preview import PreviewScheduler
+    from loader import FrameStack, LazyImage
+    from pyramid import PREVIEW_SIZE
+    from processing import OPERATIONS, ProcessingParams, apply_focus_effect, to_display_depth
+    from volume import VolumeProcessor
+    from navigator import ImageNavigator, NavigatorEntry
+    from zoom import ZOOM_INTERPOLATIONS, Loupe, RegionCache, ZoomWindowPool, crop_region, magnify
+    from writer import SAVE_FORMATS, ImageWriter, SaveOptions, WriteResult
+    from save_dialog import SaveOptionsDialog
+    from instrumentation import METRICS
+    from perf_overlay import PerfOverlay
+    from viewer import ResultViewer
+    from canny_sweep import CannySweep, SweepSheet, threshold_grid
+    from display import DisplayBuffer
+    from processing import CLAHE_ENGINE
+    from cine import CinePlayer, open_cine
+    STARTUP.mark("import engine")
+
+
+def warm_up():
+    """Pays one-off costs (optional readers, OpenCV's first calls) off the GUI thread."""
+    from loader import optional_pydicom
+    from tiled import optional_tifffile
+    optional_pydicom()
+    optional_tifffile()
+    sample = np.zeros((64, 64), dtype=np.uint8)
+    CLAHE_ENGINE.apply(sample, 2.0, (8, 8))
+    cv2.Canny(cv2.GaussianBlur(sample, (5, 5), 0), 50, 150)
+    STARTUP.mark("warm-up done")
 
-            pixmap = QPixmap.fromImage(qt_image)
-            scaled_pixmap = pixmap.scaled(440, 440, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            self.zoom_label.setPixmap(scaled_pixmap)
-
-        except Exception as e:
-            self.zoom_label.setText(f"Display error: {str(e)}")
 
 class ImageProcessor(QWidget):
+    # Emitted from the writer thread; delivered on the GUI thread.
+    saved = Signal(object)
+    first_painted = Signal()
 
-    def __init__(self):
+    def __init__(self, disk_cache: Optional[DiskCache] = None, defer_engine: bool = False):
+        """With ``defer_engine`` only the Qt controls are built; call
+        attach_engine() (e.g. on ``first_painted``) before using the window."""
         super().__init__()
+        # Persistent results shared with headless runs; None disables it.
+        self.disk_cache = disk_cache
+        # Processing daemon client (daemon.DaemonClient) when running as a thin client.
+        self.remote = None
+        self.engine_ready = False
+        self.painted = False
+        self.navigator: Optional[ImageNavigator] = None
+        self.stack: Optional[FrameStack] = None
+        self.source: Optional[LazyImage] = None
         self.image: Optional[np.ndarray] = None
         self.processed_image: Optional[np.ndarray] = None
+        # (min, max) of images deeper than 8 bits; brightness and contrast
+        # window this range and only the display is quantized to 8 bits.
+        self.data_range: Optional[tuple] = None
 
         self.brightness = 50
         self.contrast = 50
         self.low_threshold = 50
         self.high_threshold = 150
         self.zoom_area_size = 100
+        self.zoom_interpolation = "Cubic"
         self.zoom_scale = 1.0
         self.focus_level = 0
         self.window_name = ""
         self.use_clahe = False
-
-        self.zoom_windows = []
+        self.clip_limit: Optional[float] = None
+        self.tile_grid = 8
+        self.loupe_enabled = False
+        # Size of the image currently drawn on the main label, for mapping
+        # mouse positions back to image coordinates.
+        self.display_size: Optional[tuple] = None
+        self.active_operation: Optional[str] = None
+        # Slider exploration runs on a downsampled proxy; the full-resolution
+        # pipeline only runs on commit (release, zoom, save).
+        self.proxy_pipeline: Optional[ProcessingPipeline] = None
+        self.proxy_level = 0
+        self.commit_timer = QTimer(self)
+        self.commit_timer.setSingleShot(True)
+        self.commit_timer.setInterval(300)
+        self.sweep_sheet: Optional[SweepSheet] = None
+        # Multi-frame files: every slice is processed into one volume array,
+        # lazily ahead of the slice being viewed or all at once on request.
+        self.volume: Optional[VolumeProcessor] = None
+        self.slice_index = 0
+        self.volume_started = 0.0
+        self.volume_todo = 0
+        self.volume_timer = QTimer(self)
+        self.volume_timer.setInterval(100)
+        # Cine playback of the loaded stack; the timer is the display stage.
+        self.cine: Optional[CinePlayer] = None
+        self.cine_timer = QTimer(self)
+        self.cine_timer.setTimerType(Qt.PreciseTimer)
+        self.cine_frame_index = 0
+        self.cine_stats_time = 0.0
+
+        self.export_extension = ".png"
+        self.saves_pending = 0
+        self.save_results = []
 
         self.setup_ui()
-        self.connect_signals()
         self.apply_modern_styling()
+        if defer_engine:
+            self.setEnabled(False)
+            self.labelImage.setText("Starting...")
+        else:
+            self.attach_engine()
+
+    def attach_engine(self, disk_cache: Optional[DiskCache] = None, remote=None):
+        """Create the processing, display and saving machinery behind the controls.
+
+        With ``remote`` full-resolution results are computed by the processing
+        daemon; previews are still computed locally.
+        """
+        load_engine()
+        if disk_cache is not None:
+            self.disk_cache = disk_cache
+        self.remote = remote
+        self.pipeline = ProcessingPipeline(disk_cache=self.disk_cache, remote=remote)
+        self.preview = PreviewScheduler(self)
+        # One Qt window shows the result of the active operation.
+        self.viewer = ResultViewer()
+        # Contact sheet of Canny threshold pairs; a click picks a pair.
+        self.sweep_viewer = ResultViewer()
+        self.main_display = DisplayBuffer()
+        self.zoom_pool = ZoomWindowPool(max_windows=4)
+        self.region_cache = RegionCache(max_entries=16)
+
+        # Saving encodes and writes on a background thread.
+        self.writer = ImageWriter()
+        self.save_options = SaveOptions()
+
+        self.loupe = Loupe(self.labelImage)
+        self.perfOverlay = PerfOverlay(self.labelImage, self.cache_stats)
+        self.perfOverlay.move(8, 8)
+        QShortcut(QKeySequence("F12"), self, self.perfOverlay.toggle)
+        self.comboZoomInterpolation.addItems(list(ZOOM_INTERPOLATIONS))
+
+        self.connect_signals()
+        self.engine_ready = True
+        self.setEnabled(True)
+        self.labelImage.setText("Load medical image to begin processing")
+        STARTUP.mark("engine ready")
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            STARTUP.mark("first paint")
+            self.first_painted.emit()
 
     def setup_ui(self):
         self.setWindowTitle("Medical Image Processor")
@@ -106,15 +213,24 @@ class ImageProcessor(QWidget):
             ("Apply Grayscale", 170, 20, 140, 40, self.apply_grayscale),
             ("Edge Detection", 320, 20, 140, 40, self.apply_edge_detection),
             ("Enhance Contrast", 470, 20, 140, 40, self.apply_contrast_enhancement),
-            ("Save Processed", 620, 20, 140, 40, self.save_image)
+            ("Save Processed", 620, 20, 140, 40, None),
+            ("Process Volume", 770, 20, 140, 40, self.process_volume),
+            ("Previous", 920, 20, 80, 40, self.show_previous),
+            ("Next", 1005, 20, 80, 40, self.show_next)
         ]
 
         for text, x, y, w, h, callback in button_configs:
             btn = QPushButton(text, self)
             btn.setGeometry(x, y, w, h)
-            btn.clicked.connect(callback)
+            if callback is not None:
+                btn.clicked.connect(callback)
             setattr(self, f'btn{text.split()[-1]}', btn)
 
+        save_menu = QMenu(self.btnProcessed)
+        save_menu.addAction("Save Processed...", self.save_image)
+        save_menu.addAction("Export All Variants...", self.export_all)
+        self.btnProcessed.setMenu(save_menu)
+
         self.labelImage = QLabel(self)
         self.labelImage.setGeometry(20, 80, 650, 580)
         self.labelImage.setStyleSheet("""
@@ -130,6 +246,28 @@ class ImageProcessor(QWidget):
         self.labelImage.setScaledContents(False)
         self.labelImage.setAlignment(Qt.AlignCenter)
         self.labelImage.setText("Load medical image to begin processing")
+        self.labelImage.setMouseTracking(True)
+        self.labelImage.installEventFilter(self)
+
+        self.labelSlice = QLabel("Slice: 1/1", self)
+        self.labelSlice.setGeometry(20, 668, 130, 25)
+        self.sliderSlice = QSlider(Qt.Horizontal, self)
+        self.sliderSlice.setGeometry(160, 668, 430, 25)
+        self.sliderSlice.setMinimum(0)
+        self.btnPlay = QPushButton("Play", self)
+        self.btnPlay.setGeometry(600, 664, 70, 32)
+        self.btnPlay.setToolTip("Play the frames as a cine loop through the active operation")
+        self.labelCineStats = QLabel(self)
+        self.labelCineStats.setGeometry(20, 700, 650, 22)
+        self.labelSlice.hide()
+        self.sliderSlice.hide()
+        self.btnPlay.hide()
+        self.labelCineStats.hide()
+        self.btnVolume.setEnabled(False)
+        self.btnPrevious.setShortcut("Ctrl+Left")
+        self.btnPrevious.setToolTip("Previous image in the folder (Ctrl+Left)")
+        self.btnNext.setShortcut("Ctrl+Right")
+        self.btnNext.setToolTip("Next image in the folder (Ctrl+Right)")
 
         self.create_control_panel()
         self.create_status_panel()
@@ -141,6 +279,36 @@ class ImageProcessor(QWidget):
         self.checkboxCLAHE.setGeometry(x_start, y_start, 280, 30)
         self.checkboxCLAHE.setToolTip("Contrast Limited Adaptive Histogram Equalization\nfor medical lesion detection")
 
+        self.checkboxLoupe = QCheckBox("Hover Loupe", self)
+        self.checkboxLoupe.setGeometry(x_start + 290, y_start, 110, 30)
+        self.checkboxLoupe.setToolTip("Magnify the processed image under the mouse on the main view")
+
+        self.labelClipLimit = QLabel("CLAHE Clip", self)
+        self.labelClipLimit.setGeometry(x_start + 290, y_start + 50, 100, 25)
+        self.spinClipLimit = QDoubleSpinBox(self)
+        self.spinClipLimit.setGeometry(x_start + 290, y_start + 75, 100, 28)
+        self.spinClipLimit.setRange(0.0, 40.0)
+        self.spinClipLimit.setSingleStep(0.5)
+        # 0 stands for the operation's default (3.0 enhance, 2.0 otherwise).
+        self.spinClipLimit.setSpecialValueText("Auto")
+        self.spinClipLimit.setToolTip("CLAHE clip limit (Auto: 3.0 for Enhance Contrast, 2.0 otherwise)")
+
+        self.labelTileGrid = QLabel("CLAHE Grid", self)
+        self.labelTileGrid.setGeometry(x_start + 290, y_start + 120, 100, 25)
+        self.spinTileGrid = QSpinBox(self)
+        self.spinTileGrid.setGeometry(x_start + 290, y_start + 145, 100, 28)
+        self.spinTileGrid.setRange(1, 32)
+        self.spinTileGrid.setValue(8)
+        self.spinTileGrid.setSuffix(" tiles")
+        self.spinTileGrid.setToolTip("CLAHE tiles per side")
+
+        self.btnSweep = QPushButton("Threshold Sweep", self)
+        self.btnSweep.setGeometry(x_start + 290, y_start + 200, 100, 36)
+        self.btnSweep.setToolTip("Contact sheet of edge maps over a grid of Canny thresholds\n(click a tile to use its thresholds)")
+        self.btnAutoThresholds = QPushButton("Auto Canny", self)
+        self.btnAutoThresholds.setGeometry(x_start + 290, y_start + 244, 100, 36)
+        self.btnAutoThresholds.setToolTip("Set the Canny thresholds from the gradient histogram")
+
         controls = [
             ("Brightness Control", "labelBrightnessValue", "sliderBrightness", 0, 100, 50, y_start + 50),
             ("Contrast Control", "labelContrastValue", "sliderContrast", 0, 100, 50, y_start + 120),
@@ -163,6 +331,10 @@ class ImageProcessor(QWidget):
             slider.setValue(default)
             setattr(self, slider_attr, slider)
 
+        self.comboZoomInterpolation = QComboBox(self)
+        self.comboZoomInterpolation.setGeometry(x_start + 290, y_start + 353, 100, 28)
+        self.comboZoomInterpolation.setToolTip("Magnifier interpolation")
+
     def create_status_panel(self):
         instructions = QLabel(""" Medical Image Processing Features:
 
@@ -174,8 +346,9 @@ class ImageProcessor(QWidget):
 • Image export capabilities
 
 [Info] Usage: Load image → Adjust parameters → Apply processing
-[Zoom] Analysis: Click processed image for magnification
-[Focus] Control: Use mouse wheel on processed image for control""", self)
+[Zoom] Click: magnify - Ctrl+wheel: zoom - drag: pan
+[Focus] Control: Use mouse wheel on processed image for control
+[Perf] F12: per-stage timing overlay""", self)
 
         instructions.setGeometry(680, 480, 400, 210)
         instructions.setStyleSheet("""
@@ -197,8 +370,30 @@ class ImageProcessor(QWidget):
         self.sliderLowThreshold.valueChanged.connect(self.update_low_threshold)
         self.sliderHighThreshold.valueChanged.connect(self.update_high_threshold)
         self.sliderZoomSize.valueChanged.connect(self.update_zoom_size)
+        self.sliderSlice.valueChanged.connect(self.show_slice)
+        self.volume_timer.timeout.connect(self.update_volume_progress)
+        self.btnPlay.clicked.connect(self.toggle_cine)
+        self.cine_timer.timeout.connect(self.show_cine_frame)
+        self.saved.connect(self.on_saved)
+        self.comboZoomInterpolation.currentTextChanged.connect(self.update_zoom_interpolation)
 
         self.checkboxCLAHE.stateChanged.connect(self.toggle_clahe)
+        self.spinClipLimit.valueChanged.connect(self.update_clip_limit)
+        self.spinTileGrid.valueChanged.connect(self.update_tile_grid)
+        self.checkboxLoupe.stateChanged.connect(self.toggle_loupe)
+
+        for slider in (self.sliderBrightness, self.sliderContrast,
+                       self.sliderLowThreshold, self.sliderHighThreshold):
+            slider.sliderReleased.connect(self.commit_preview)
+        self.commit_timer.timeout.connect(self.commit_preview)
+
+        self.preview.ready.connect(self.show_preview)
+        self.preview.error.connect(lambda message: print(f"[ERROR] Preview failed: {message}"))
+        self.viewer.clicked.connect(self.magnify_at)
+        self.viewer.focus_scrolled.connect(self.scroll_focus)
+        self.btnSweep.clicked.connect(self.show_threshold_sweep)
+        self.btnAutoThresholds.clicked.connect(self.auto_thresholds)
+        self.sweep_viewer.clicked.connect(self.pick_sweep_pair)
 
     def apply_modern_styling(self):
         self.setStyleSheet("""
@@ -278,73 +473,249 @@ class ImageProcessor(QWidget):
             self,
             "Select Medical Image",
             "",
-            "Medical Images (*.png *.jpg *.jpeg *.bmp *.tiff *.dcm);;All Files (*)"
+            "Medical Images (*.png *.jpg *.jpeg *.bmp *.tif *.tiff *.npy *.dcm *.dicom);;"
+            "Cine Loops (*.avi *.mp4 *.m4v *.mov *.mkv *.wmv *.mpg *.mpeg *.dcm *.tif *.tiff);;All Files (*)"
         )
 
         if file_path:
             try:
-                image_path = Path(file_path)
-
-                with open(image_path, 'rb') as f:
-                    file_bytes = f.read()
-
-                nparr = np.frombuffer(file_bytes, np.uint8)
-                self.image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-                if self.image is not None:
-                    self.processed_image = self.image.copy()
-                    self.show_on_main_label(self.image)
-
-                    height, width = self.image.shape[:2]
-                    print(f"[OK] Medical image loaded: {image_path.name}")
-                    print(f"   Dimensions: {width}x{height} pixels")
-                    print(f"   Channels: {self.image.shape[2] if len(self.image.shape) == 3 else 1}")
-                else:
-                    raise ValueError("Could not decode medical image file")
+                # The rest of the folder is reachable with Previous/Next;
+                # its neighbours are decoded in the background.
+                if self.navigator is not None:
+                    self.navigator.close()
+                self.navigator = ImageNavigator.for_file(file_path, disk_cache=self.disk_cache)
+                self.navigator.preview_size = (self.labelImage.width() - 20, self.labelImage.height() - 20)
+                self.active_operation = None
+                self.viewer.hide()
+                self.show_entry(self.navigator.go(self.navigator.index))
 
             except Exception as e:
                 print(f"[ERROR] Error loading medical image: {e}")
                 QMessageBox.critical(self, "Image Loading Error",
                                    f"Could not load medical image:\n{str(e)}\n\nPlease check file format and try again.")
 
-    def apply_focus_effect(self, img: np.ndarray) -> np.ndarray:
-        if self.focus_level == 0:
-            return img
-
-        if self.focus_level < 0:
-            blur_strength = abs(self.focus_level)
-            kernel_size = min(blur_strength * 2 + 1, 15)
-            if kernel_size % 2 == 0:
-                kernel_size += 1
-            blurred = cv2.GaussianBlur(img, (kernel_size, kernel_size), blur_strength)
-            return blurred
+    def show_previous(self):
+        self.step_image(-1)
+
+    def show_next(self):
+        self.step_image(1)
+
+    def step_image(self, offset: int):
+        if self.navigator is None:
+            return
+        try:
+            entry = self.navigator.step(offset)
+        except Exception as e:
+            print(f"[ERROR] Error loading medical image: {e}")
+            QMessageBox.warning(self, "Image Loading Error", f"Could not load medical image:\n{str(e)}")
+            return
+        if entry is not None:
+            self.show_entry(entry)
+
+    def show_entry(self, entry: NavigatorEntry):
+        # Memory-mapped where the format allows it; pixels are only read when
+        # a level or region is requested. Multi-frame files only map or decode
+        # the frame being viewed.
+        self.stop_cine()
+        self.volume_timer.stop()
+        if self.volume is not None:
+            self.volume.close()
+            self.volume = None
+        self.stack = entry.stack
+        # One window for the whole series, taken from the first slice.
+        self.data_range = entry.data_range
+        self.set_current_frame(0)
+
+        multi_frame = len(self.stack) > 1
+        if multi_frame:
+            self.volume = VolumeProcessor(self.stack, disk_cache=self.disk_cache)
+        self.sliderSlice.blockSignals(True)
+        self.sliderSlice.setMaximum(len(self.stack) - 1)
+        self.sliderSlice.setValue(0)
+        self.sliderSlice.blockSignals(False)
+        self.labelSlice.setText(f"Slice: 1/{len(self.stack)}")
+        self.labelSlice.setVisible(multi_frame)
+        self.sliderSlice.setVisible(multi_frame)
+        self.btnPlay.setVisible(multi_frame)
+        self.btnVolume.setEnabled(multi_frame)
+
+        height, width = self.image.shape[:2]
+        print(f"[OK] Medical image loaded: {entry.path.name} ({self.navigator.index + 1}/{len(self.navigator)})")
+        print(f"   Dimensions: {width}x{height} pixels")
+        print(f"   Channels: {self.image.shape[2] if len(self.image.shape) == 3 else 1}")
+        if multi_frame:
+            rate = f", {self.stack.frame_rate:.1f} fps" if self.stack.frame_rate else ""
+            print(f"   Frames: {len(self.stack)} ({self.source.dtype}{rate})")
+
+        if self.active_operation is None:
+            return
+        # Pre-run by the prefetcher when the settings have not changed since.
+        params = self.current_params()
+        result = self.navigator.result_for(entry, self.active_operation, params)
+        if result is None:
+            result = self.pipeline.run(self.active_operation, params)
+        self.processed_image = result
+        if self.viewer.isVisible():
+            self.viewer.set_image(result)
+
+    def update_navigator(self):
+        if self.navigator is not None:
+            self.navigator.set_operation(self.active_operation, self.current_params())
+
+    def set_current_frame(self, index: int):
+        self.slice_index = index
+        self.source = self.stack.frame(index)
+        self.image = self.source.to_array()
+        self.preview.cancel()
+        self.loupe.stop()
+        self.pipeline.set_image(self.image)
+        self.proxy_pipeline = None
+        self.region_cache.clear()
+        self.processed_image = to_display_depth(self.image, self.data_range)
+        preview = self.source.preview(self.labelImage.width() - 20, self.labelImage.height() - 20)
+        self.show_on_main_label(to_display_depth(preview, self.data_range))
+
+    def show_slice(self, index):
+        if self.stack is None or index == self.slice_index:
+            return
+        direction = 1 if index > self.slice_index else -1
+        self.labelSlice.setText(f"Slice: {index + 1}/{len(self.stack)}")
+        self.set_current_frame(index)
+        if self.active_operation is None or self.volume is None:
+            return
+
+        # Served from the volume when it was computed ahead; the slices
+        # beyond it are queued in the scrolling direction.
+        self.volume.configure(self.active_operation, self.current_params())
+        result = self.volume.slice(index).copy()
+        self.volume.prefetch(index, direction)
+        self.processed_image = result
+        if self.viewer.isVisible():
+            self.viewer.set_image(result)
+
+    def toggle_cine(self):
+        if self.cine is None:
+            self.start_cine()
         else:
-            sharpen_strength = self.focus_level / 10.0
+            self.stop_cine()
 
-            blurred = cv2.GaussianBlur(img, (9, 9), 10.0)
-            unsharp_mask = cv2.subtract(img, blurred)
-            sharpened = cv2.addWeighted(img, 1.0, unsharp_mask, sharpen_strength, 0)
+    def start_cine(self):
+        if self.stack is None or len(self.stack) < 2:
+            return
+        try:
+            source = open_cine(self.stack)
+        except Exception as e:
+            QMessageBox.warning(self, "Cine Playback", f"Could not play this file:\n{e}")
+            return
+        start = self.slice_index + 1 if self.slice_index + 1 < len(self.stack) else 0
+        self.cine = CinePlayer(source, self.active_operation, self.current_params(), start=start)
+        self.cine_frame_index = self.slice_index
+        self.loupe.stop()
+        # Polled at twice the frame rate so frames are shown close to when they are due.
+        self.cine_timer.setInterval(max(4, int(500 / self.cine.frame_rate)))
+        self.cine_timer.start()
+        self.btnPlay.setText("Pause")
+        self.labelCineStats.setText(f"Playing at {self.cine.frame_rate:.1f} fps")
+        self.labelCineStats.show()
+        print(f"[Cine] Playing {len(self.stack)} frames at {self.cine.frame_rate:.1f} fps "
+              f"({self.active_operation or 'no operation'})")
+
+    def show_cine_frame(self):
+        # Slider and checkbox changes apply from the next processed frame.
+        self.cine.configure(self.active_operation, self.current_params())
+        try:
+            frame = self.cine.next_frame()
+        except Exception as e:
+            print(f"[ERROR] Cine playback failed: {e}")
+            self.stop_cine()
+            return
+        if frame is not None:
+            self.cine_frame_index = frame.index
+            self.show_on_main_label(frame.image)
+            if self.active_operation is not None and self.viewer.isVisible():
+                self.viewer.set_image(frame.image)
+            self.sliderSlice.blockSignals(True)
+            self.sliderSlice.setValue(frame.index)
+            self.sliderSlice.blockSignals(False)
+            self.labelSlice.setText(f"Slice: {frame.index + 1}/{len(self.stack)}")
+        now = time.perf_counter()
+        if now - self.cine_stats_time >= 0.5:
+            self.cine_stats_time = now
+            self.labelCineStats.setText(self.cine.stats.summary())
+        if self.cine.finished:
+            self.stop_cine()
+
+    def stop_cine(self):
+        if self.cine is None:
+            return
+        self.cine_timer.stop()
+        player, self.cine = self.cine, None
+        player.close()
+        print(f"[Cine] {player.stats.summary()}")
+        self.btnPlay.setText("Play")
+        self.labelCineStats.hide()
+        # The frame playback stopped on becomes the current slice.
+        self.show_slice(self.cine_frame_index)
+        if self.cine_frame_index == self.slice_index:
+            preview = self.source.preview(self.labelImage.width() - 20, self.labelImage.height() - 20)
+            self.show_on_main_label(to_display_depth(preview, self.data_range))
+
+    def process_volume(self):
+        if self.volume is None:
+            QMessageBox.information(self, "Volume Mode", "Load a multi-frame image (DICOM, TIFF stack) first.")
+            return
+        if self.active_operation is None:
+            QMessageBox.information(self, "Volume Mode",
+                                    "Apply an operation first; it is then run on every slice.")
+            return
+
+        self.volume.configure(self.active_operation, self.current_params())
+        self.volume_todo = len(self.volume) - self.volume.completed
+        self.volume_started = time.perf_counter()
+        self.volume.start_all()
+        self.volume_timer.start()
+        print(f"[Volume] Processing {self.volume_todo} slices ({self.active_operation})")
 
-            return sharpened
+    def update_volume_progress(self):
+        if self.volume is None:
+            self.volume_timer.stop()
+            return
+        if self.volume.completed < len(self.volume):
+            if not self.volume.busy:
+                # Settings changed while processing: the queued slices were dropped.
+                self.volume_timer.stop()
+                print("[Volume] Processing cancelled (parameters changed)")
+            return
+
+        self.volume_timer.stop()
+        elapsed = time.perf_counter() - self.volume_started
+        rate = self.volume_todo / elapsed if elapsed > 0 else 0.0
+        print(f"[Volume] {self.volume_todo} slices in {elapsed:.2f}s - {rate:.1f} slices/sec")
+
+    def current_params(self) -> ProcessingParams:
+        return ProcessingParams(
+            brightness=self.brightness,
+            contrast=self.contrast,
+            low_threshold=self.low_threshold,
+            high_threshold=self.high_threshold,
+            use_clahe=self.use_clahe,
+            focus_level=self.focus_level,
+            data_range=self.data_range,
+            clip_limit=self.clip_limit,
+            tile_grid=self.tile_grid,
+        )
+
+    def apply_focus_effect(self, img: np.ndarray) -> np.ndarray:
+        return apply_focus_effect(img, self.focus_level)
 
     def apply_contrast_enhancement(self):
         if self.image is not None:
             try:
-                if len(self.image.shape) == 3:
-                    gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-                else:
-                    gray = self.image.copy()
-
-                clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-                enhanced = clahe.apply(gray)
+                enhanced = self.pipeline.run("enhance", self.current_params())
                 print("CLAHE enhancement applied for medical analysis")
 
-                alpha = self.contrast / 50.0
-                beta = (self.brightness - 50) * 2
-                enhanced = cv2.convertScaleAbs(enhanced, alpha=alpha, beta=beta)
-
-                enhanced = self.apply_focus_effect(enhanced)
-
+                self.active_operation = "enhance"
+                self.update_navigator()
                 self.processed_image = enhanced
                 self.window_name = "Enhanced Medical Image"
                 self.show_interactive_window(self.window_name, enhanced)
@@ -355,24 +726,14 @@ class ImageProcessor(QWidget):
     def apply_grayscale(self):
         if self.image is not None:
             try:
-                if len(self.image.shape) == 3:
-                    gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-                else:
-                    gray = self.image.copy()
-
+                adjusted = self.pipeline.run("grayscale", self.current_params())
                 if self.use_clahe:
-                    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-                    gray = clahe.apply(gray)
                     print(" CLAHE enhancement applied to grayscale conversion")
                 else:
                     print(" Standard grayscale conversion applied")
 
-                alpha = self.contrast / 50.0
-                beta = (self.brightness - 50) * 2
-                adjusted = cv2.convertScaleAbs(gray, alpha=alpha, beta=beta)
-
-                adjusted = self.apply_focus_effect(adjusted)
-
+                self.active_operation = "grayscale"
+                self.update_navigator()
                 self.processed_image = adjusted
                 self.window_name = "Grayscale Medical Analysis"
                 self.show_interactive_window(self.window_name, adjusted)
@@ -383,22 +744,12 @@ class ImageProcessor(QWidget):
     def apply_edge_detection(self):
         if self.image is not None:
             try:
-                if len(self.image.shape) == 3:
-                    gray = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
-                else:
-                    gray = self.image.copy()
-
+                edges = self.pipeline.run("edges", self.current_params())
                 if self.use_clahe:
-                    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-                    gray = clahe.apply(gray)
                     print(" CLAHE preprocessing applied for edge detection")
 
-                blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-
-                edges = cv2.Canny(blurred, self.low_threshold, self.high_threshold)
-
-                edges = self.apply_focus_effect(edges)
-
+                self.active_operation = "edges"
+                self.update_navigator()
                 self.processed_image = edges
                 self.window_name = "Medical Edge Detection"
                 self.show_interactive_window(self.window_name, edges)
@@ -409,151 +760,407 @@ class ImageProcessor(QWidget):
                 QMessageBox.warning(self, "Processing Error", f"Edge detection failed: {str(e)}")
 
     def save_image(self):
-        if self.processed_image is not None:
-            file_path, _ = QFileDialog.getSaveFileName(
-                self,
-                "Save Processed Medical Image",
-                "processed_medical_image.png",
-                "PNG Files (*.png);;JPEG Files (*.jpg);;TIFF Files (*.tiff)"
-            )
-
-            if file_path:
-                try:
-                    save_path = Path(file_path)
-                    is_success, buffer = cv2.imencode('.png', self.processed_image)
-
-                    if is_success:
-                        with open(save_path, 'wb') as f:
-                            f.write(buffer)
-                        print(f"[Save] Processed medical image saved: {save_path.name}")
-                        QMessageBox.information(self, "Export Successful",
-                                              f"Medical image saved:\n{save_path.name}")
-                    else:
-                        raise ValueError("Could not encode processed image")
-
-                except Exception as e:
-                    print(f" Error saving processed image: {e}")
-                    QMessageBox.critical(self, "Save Error", f"Could not save image:\n{str(e)}")
-        else:
+        if self.processed_image is None:
             QMessageBox.warning(self, "No Image", "No processed image available to save.\nPlease process an image first.")
+            return
+
+        file_path, _ = QFileDialog.getSaveFileName(
+            self,
+            "Save Processed Medical Image",
+            "processed_medical_image.png",
+            "PNG Files (*.png);;JPEG Files (*.jpg);;TIFF Files (*.tiff);;WebP Files (*.webp);;BMP Files (*.bmp)"
+        )
+        if not file_path:
+            return
+
+        save_path = Path(file_path)
+        extension = save_path.suffix.lower()
+        if extension not in SAVE_FORMATS:
+            QMessageBox.warning(self, "Save Error", f"Unsupported image format: {save_path.suffix or '(none)'}")
+            return
+
+        full_depth = self.data_range is not None and self.active_operation in ("grayscale", "enhance")
+        dialog = SaveOptionsDialog(self, extension, self.save_options, allow_full_depth=full_depth)
+        if dialog.exec() != QDialog.Accepted:
+            return
+        self.save_options = dialog.options()
+
+        if self.active_operation is None:
+            self.queue_save(save_path, self.processed_image)
+        else:
+            self.queue_save(save_path, self.render_job(self.active_operation, self.save_options.full_depth))
+
+    def export_all(self):
+        if self.image is None:
+            QMessageBox.warning(self, "No Image", "Please load a medical image first.")
+            return
+
+        folder = QFileDialog.getExistingDirectory(self, "Export All Variants")
+        if not folder:
+            return
+
+        dialog = SaveOptionsDialog(self, None, self.save_options, allow_full_depth=self.data_range is not None)
+        dialog.comboFormat.setCurrentText(SAVE_FORMATS[self.export_extension])
+        if dialog.exec() != QDialog.Accepted:
+            return
+        self.save_options = dialog.options()
+        self.export_extension = extension = dialog.extension()
+
+        folder = Path(folder)
+        stem = self.navigator.current_path.stem if self.navigator is not None else "medical_image"
+        if self.stack is not None and len(self.stack) > 1:
+            stem += f"_slice{self.slice_index + 1}"
+
+        for operation in OPERATIONS:
+            self.queue_save(folder / f"{stem}_{operation}{extension}",
+                            self.render_job(operation, self.save_options.full_depth))
+        # Magnified regions of the current image that are still cached.
+        for (version, x, y, size), region in self.region_cache.items():
+            if version[0] == self.pipeline.version:
+                self.queue_save(folder / f"{stem}_zoom_{version[1]}_{x}_{y}_{size}{extension}", region)
+
+    def render_job(self, operation: str, full_depth: bool = False):
+        """Callable computing ``operation`` on the writer thread.
+
+        Uses the pipeline cache while the same image is loaded, otherwise the
+        image that was current when the save was requested.
+        """
+        pipeline, version, image = self.pipeline, self.pipeline.version, self.pipeline.image
+        params = self.current_params()
+        full_depth = full_depth and operation != "edges"
+
+        def render() -> np.ndarray:
+            if pipeline.version == version:
+                result = pipeline.run(operation, params, full_depth)
+                if pipeline.version == version:
+                    return result
+            return run_cached(image, operation, params, self.disk_cache, full_depth)
+
+        return render
+
+    def queue_save(self, path: Path, image):
+        self.saves_pending += 1
+        self.writer.submit(path, image, self.save_options, self.saved.emit)
+        print(f"[Save] Queued {path.name}")
+
+    def on_saved(self, result: WriteResult):
+        self.saves_pending -= 1
+        self.save_results.append(result)
+        if result.error is not None:
+            print(f"[ERROR] Could not save {result.path.name}: {result.error}")
+        else:
+            print(f"[Save] {result.path.name}: {result.nbytes / 1e6:.1f} MB in {result.elapsed:.2f}s "
+                  f"({result.bytes_per_second / 1e6:.1f} MB/s)")
+        if self.saves_pending > 0:
+            return
+
+        results, self.save_results = self.save_results, []
+        failed = [r for r in results if r.error is not None]
+        if failed:
+            QMessageBox.critical(self, "Save Error", "Could not save image:\n" +
+                                 "\n".join(f"{r.path.name}: {r.error}" for r in failed))
+        elif len(results) == 1:
+            QMessageBox.information(self, "Export Successful", f"Medical image saved:\n{results[0].path.name}")
+        else:
+            total = sum(r.nbytes for r in results)
+            QMessageBox.information(self, "Export Successful",
+                                    f"{len(results)} images saved to {results[0].path.parent.name}\n"
+                                    f"{total / 1e6:.1f} MB at {self.writer.bytes_per_second / 1e6:.1f} MB/s")
 
     def update_brightness(self, value):
         self.brightness = value
         self.labelBrightnessValue.setText(f"Brightness Control: {value}")
+        self.request_preview()
 
     def update_contrast(self, value):
         self.contrast = value
         self.labelContrastValue.setText(f"Contrast Control: {value}")
+        self.request_preview()
 
     def update_low_threshold(self, value):
         self.low_threshold = value
         self.labelLowThreshold.setText(f"Low Threshold (Canny): {value}")
+        self.request_preview()
 
     def update_high_threshold(self, value):
         self.high_threshold = value
         self.labelHighThreshold.setText(f"High Threshold (Canny): {value}")
+        self.request_preview()
+
+    def set_thresholds(self, low: int, high: int):
+        self.sliderLowThreshold.setValue(low)
+        self.sliderHighThreshold.setValue(high)
+
+    def canny_sweep(self) -> CannySweep:
+        # Grayscale, CLAHE and blur come from the pipeline cache; the
+        # gradients are computed once for every threshold pair.
+        return CannySweep(self.pipeline.run("edges", self.current_params(), until="blur"))
+
+    def show_threshold_sweep(self):
+        if self.image is None:
+            QMessageBox.warning(self, "No Image", "Please load an image first.")
+            return
+        try:
+            start = time.perf_counter()
+            sweep = self.canny_sweep()
+            low, high = sweep.suggest_thresholds()
+            lows, highs = threshold_grid()
+            self.sweep_sheet = sweep.contact_sheet(lows, highs, mark=(self.low_threshold, self.high_threshold))
+            elapsed = time.perf_counter() - start
+            self.sweep_viewer.set_image(self.sweep_sheet.image,
+                                        f"Canny Threshold Sweep - suggested {low}/{high}", keep_view=False)
+            self.sweep_viewer.show()
+            self.sweep_viewer.raise_()
+            pairs = sum(1 for l in lows for h in highs if l < h)
+            print(f"[Sweep] {pairs} threshold pairs in {elapsed * 1e3:.1f} ms - suggested thresholds {low}/{high}")
+        except Exception as e:
+            QMessageBox.warning(self, "Processing Error", f"Threshold sweep failed: {str(e)}")
+
+    def pick_sweep_pair(self, x, y):
+        pair = self.sweep_sheet.pair_at(x, y) if self.sweep_sheet is not None else None
+        if pair is None or self.image is None:
+            return
+        self.set_thresholds(*pair)
+        self.apply_edge_detection()
+
+    def auto_thresholds(self):
+        if self.image is None:
+            QMessageBox.warning(self, "No Image", "Please load an image first.")
+            return
+        low, high = self.canny_sweep().suggest_thresholds()
+        self.set_thresholds(low, high)
+        print(f"[Sweep] Suggested thresholds {low}/{high}")
+        if self.active_operation == "edges":
+            self.apply_edge_detection()
 
     def update_zoom_size(self, value):
         self.zoom_area_size = value
         self.labelZoomSize.setText(f"Zoom Region Size: {value}")
 
+    def update_zoom_interpolation(self, name):
+        self.zoom_interpolation = name
+        print(f"[Zoom] Magnifier interpolation: {name}")
+
     def toggle_clahe(self, state):
         self.use_clahe = (state == 2)
         status = "ENABLED" if self.use_clahe else "DISABLED"
         print(f" CLAHE Enhancement {status} - Medical imaging optimization")
+        self.request_preview()
+
+    def update_clip_limit(self, value):
+        self.clip_limit = value if value > 0 else None
+        print(f" CLAHE clip limit: {value if value > 0 else 'Auto'}")
+        self.request_preview()
+
+    def update_tile_grid(self, value):
+        self.tile_grid = value
+        print(f" CLAHE grid: {value}x{value} tiles")
+        self.request_preview()
+
+    def toggle_loupe(self, state):
+        self.loupe_enabled = (state == 2)
+        if not self.loupe_enabled:
+            self.loupe.stop()
+        print(f"[Zoom] Hover loupe {'ENABLED' if self.loupe_enabled else 'DISABLED'}")
+
+    def eventFilter(self, obj, event):
+        if obj is self.labelImage and self.loupe_enabled:
+            if event.type() == QEvent.MouseMove:
+                self.update_loupe(event.position().toPoint())
+            elif event.type() == QEvent.Leave:
+                self.loupe.stop()
+        return super().eventFilter(obj, event)
+
+    def update_loupe(self, pos):
+        img = self.processed_image
+        if img is None or self.display_size is None:
+            return
+        # The pixmap is centred in the label's contents rectangle.
+        rect = self.labelImage.contentsRect()
+        shown_w, shown_h = self.display_size
+        dx = pos.x() - rect.x() - (rect.width() - shown_w) // 2
+        dy = pos.y() - rect.y() - (rect.height() - shown_h) // 2
+        if not (0 <= dx < shown_w and 0 <= dy < shown_h):
+            self.loupe.stop()
+            return
+        x = dx * img.shape[1] // shown_w
+        y = dy * img.shape[0] // shown_h
+        self.loupe.track(pos, img, x, y, self.zoom_area_size, ZOOM_INTERPOLATIONS[self.zoom_interpolation])
+
+    def cache_stats(self) -> dict:
+        stats = {"pipeline": (self.pipeline.hits, self.pipeline.misses),
+                 "zoom": (self.region_cache.hits, self.region_cache.misses),
+                 "clahe-hist": (CLAHE_ENGINE.histogram_hits, CLAHE_ENGINE.histogram_misses)}
+        if self.proxy_pipeline is not None and self.proxy_pipeline is not self.pipeline:
+            stats["proxy"] = (self.proxy_pipeline.hits, self.proxy_pipeline.misses)
+        if self.navigator is not None:
+            stats["navigator"] = (self.navigator.hits, self.navigator.misses)
+        if self.disk_cache is not None:
+            stats["disk"] = (self.disk_cache.hits, self.disk_cache.misses)
+        return stats
+
+    def preview_size(self) -> int:
+        """Proxy resolution: the result viewer's longest side in device pixels, at least PREVIEW_SIZE."""
+        longest = max(self.viewer.width(), self.viewer.height()) * self.viewer.devicePixelRatioF()
+        return max(PREVIEW_SIZE, math.ceil(longest))
+
+    def proxy(self) -> ProcessingPipeline:
+        # Built on first use from the loader's cached pyramid, and rebuilt
+        # when the viewer is resized (or moved to another screen) far enough
+        # to need another pyramid level.
+        level = self.source.level_for(self.preview_size())
+        if self.proxy_pipeline is None or level != self.proxy_level:
+            self.proxy_level = level
+            if self.proxy_level == 0:
+                self.proxy_pipeline = self.pipeline
+            else:
+                self.proxy_pipeline = ProcessingPipeline(category="preview")
+                self.proxy_pipeline.set_image(self.pyramid_level(self.proxy_level))
+        return self.proxy_pipeline
+
+    def pyramid_level(self, level: int) -> np.ndarray:
+        # The downsampled source is kept in the disk cache so reopening a very
+        # large image does not rebuild its pyramid.
+        if self.disk_cache is None:
+            return self.source.level(level)
+        key = pyramid_key(self.pipeline.digest(), level)
+        image = self.disk_cache.get(key)
+        if image is None:
+            image = self.source.level(level)
+            self.disk_cache.put(key, image)
+        return image
+
+    def request_preview(self):
+        if self.active_operation is None or self.pipeline.image is None:
+            return
+        self.preview.request(self.proxy(), self.active_operation, self.current_params())
+        self.commit_timer.start()
+        self.update_navigator()
+
+    def commit_preview(self):
+        if self.active_operation is None or self.pipeline.image is None:
+            return
+        self.commit_timer.stop()
+        if any(slider.isSliderDown() for slider in (self.sliderBrightness, self.sliderContrast,
+                                                    self.sliderLowThreshold, self.sliderHighThreshold)):
+            return
+        self.preview.request(self.pipeline, self.active_operation, self.current_params())
+
+    def show_preview(self, img, elapsed):
+        if not self.viewer.isVisible():
+            return
+        if img.shape[:2] == self.image.shape[:2]:
+            self.processed_image = img
+        # Proxy and full-resolution results share the viewer's pan and zoom.
+        self.viewer.set_image(img)
 
     def show_on_main_label(self, img):
-        if len(img.shape) == 3:
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            h, w, ch = img_rgb.shape
-            qimg = QImage(img_rgb.data, w, h, ch * w, QImage.Format_RGB888)
-        else:
-            h, w = img.shape
-            qimg = QImage(img.data, w, h, w, QImage.Format_Grayscale8)
-
-        pixmap = QPixmap.fromImage(qimg).scaled(
-            self.labelImage.width() - 20,
-            self.labelImage.height() - 20,
-            Qt.KeepAspectRatio,
-            Qt.SmoothTransformation
-        )
-        self.labelImage.setPixmap(pixmap)
+        with METRICS.measure("main_label", "display") as measurement:
+            # Scaled straight into the reused display buffer, which the QImage
+            # wraps as BGR888: no colour swap and no per-refresh allocation.
+            qimg = self.main_display.fit(img, self.labelImage.width() - 20, self.labelImage.height() - 20)
+            self.display_size = (qimg.width(), qimg.height())
+            self.labelImage.setPixmap(QPixmap.fromImage(qimg))
+            measurement.output_bytes = qimg.sizeInBytes()
+            measurement.shape = (qimg.height(), qimg.width())
 
     def show_interactive_window(self, title, img):
         self.zoom_scale = 1.0
-        clone = img.copy()
-        cv2.namedWindow(title, cv2.WINDOW_NORMAL)
-        cv2.resizeWindow(title, 800, 800)
-
-        def on_mouse(event, x, y, flags, param):
-            if event == cv2.EVENT_LBUTTONDOWN:
-                zoomed = self.get_zoomed_region(clone, x, y, self.zoom_area_size)
-                if zoomed is not None and zoomed.size > 0:
-                    zoom_window = ZoomWindow(zoomed, f"Medical Analysis - {title}")
-                    self.zoom_windows.append(zoom_window)
-                    zoom_window.show()
-                    print(f" Magnified region at ({x}, {y}) - Size: {self.zoom_area_size}px")
-
-            elif event == cv2.EVENT_MOUSEWHEEL:
-                if flags > 0:
-                    self.focus_level = min(10, self.focus_level + 1)
-                    focus_action = "Sharpened"
-                else:
-                    self.focus_level = max(-10, self.focus_level - 1)
-                    focus_action = "Blurred"
-
-                focused_img = self.apply_focus_effect(clone)
-                cv2.imshow(title, focused_img)
-
-                focus_text = ("Optimal Focus" if self.focus_level == 0 else
-                            f"Blur Level {abs(self.focus_level)}" if self.focus_level < 0 else
-                            f"Sharpen Level {self.focus_level}")
-                print(f"[Focus] Focus {focus_action}: {focus_text}")
-
-        cv2.setMouseCallback(title, on_mouse)
-        cv2.imshow(title, clone)
-        cv2.waitKey(1)
-
-    def get_zoomed_region(self, img, x, y, size):
+        # Pipeline results are cached and read-only, so the viewer can share
+        # them instead of keeping its own copy.
+        self.viewer.set_image(img, title)
+        self.viewer.show()
+        self.viewer.raise_()
+        self.viewer.activateWindow()
+
+    def magnify_at(self, x, y):
+        current = self.viewer.image
+        if self.active_operation is None or current is None:
+            return
+        # The viewer may be showing the proxy; magnify from the
+        # full-resolution result at the matching position.
+        full = self.pipeline.run(self.active_operation, self.current_params())
+        x = x * full.shape[1] // current.shape[1]
+        y = y * full.shape[0] // current.shape[0]
+        # Resampled once, directly to the viewer's device-pixel size.
+        out_size = self.zoom_pool.target_size()
+        version = (self.pipeline.version, self.active_operation, self.current_params(),
+                   out_size, self.zoom_interpolation)
+        zoomed = self.region_cache.get(
+            version, x, y, self.zoom_area_size,
+            lambda cx, cy, size: self.get_zoomed_region(full, cx, cy, size, out_size))
+        if zoomed is not None and zoomed.size > 0:
+            self.zoom_pool.show(zoomed, f"Medical Analysis - {self.window_name}")
+            print(f" Magnified region at ({x}, {y}) - Size: {self.zoom_area_size}px")
+
+    def scroll_focus(self, direction):
+        if self.active_operation is None:
+            return
+        if direction > 0:
+            self.focus_level = min(10, self.focus_level + 1)
+            focus_action = "Sharpened"
+        else:
+            self.focus_level = max(-10, self.focus_level - 1)
+            focus_action = "Blurred"
+
+        # Only the focus stage is re-run on the proxy; the earlier stages
+        # come from the pipeline cache. The full-resolution result is
+        # committed once scrolling stops.
+        focused_img = self.proxy().run(self.active_operation, self.current_params())
+        self.viewer.set_image(focused_img)
+        self.commit_timer.start()
+
+        focus_text = ("Optimal Focus" if self.focus_level == 0 else
+                    f"Blur Level {abs(self.focus_level)}" if self.focus_level < 0 else
+                    f"Sharpen Level {self.focus_level}")
+        print(f"[Focus] Focus {focus_action}: {focus_text}")
+
+    def get_zoomed_region(self, img, x, y, size, out_size=(400, 400), interpolation=None):
         if img is None or img.size == 0:
             print("[ERROR] Error: Invalid image for magnification")
             return None
 
-        h, w = img.shape[:2]
-        half = size // 2
-
-        x1 = max(0, x - half)
-        y1 = max(0, y - half)
-        x2 = min(w, x + half)
-        y2 = min(h, y + half)
+        zoomed = crop_region(img, x, y, size)
 
-        if x2 <= x1 or y2 <= y1:
+        if zoomed is None or zoomed.size == 0:
             print(" Error: Invalid magnification region")
             return None
 
-        zoomed = img[y1:y2, x1:x2]
-
-        if zoomed.size == 0:
-            print(" Error: Empty magnification region")
-            return None
-
         try:
-            if zoomed.shape[0] < 10 or zoomed.shape[1] < 10:
-                zoomed = cv2.resize(zoomed, (50, 50), interpolation=cv2.INTER_NEAREST)
-
-            zoomed = cv2.resize(zoomed, (400, 400), interpolation=cv2.INTER_CUBIC)
-            return zoomed
+            if interpolation is None:
+                interpolation = ZOOM_INTERPOLATIONS[self.zoom_interpolation]
+            return magnify(zoomed, out_size[0], out_size[1], interpolation)
 
         except cv2.error as e:
             print(f" Error creating magnified region: {e}")
             return None
 
     def closeEvent(self, event):
+        if not self.engine_ready:
+            event.accept()
+            return
         try:
-            cv2.destroyAllWindows()
-            for window in self.zoom_windows:
-                if window.isVisible():
-                    window.close()
+            self.stop_cine()
+            self.preview.cancel()
+            self.preview.wait(2000)
+            self.viewer.close()
+            self.sweep_viewer.close()
+            self.zoom_pool.clear()
+            self.loupe.release()
+            self.region_cache.clear()
+            self.volume_timer.stop()
+            if self.saves_pending:
+                print(f"[Save] Finishing {self.saves_pending} queued saves")
+            self.writer.close(wait=True)
+            if self.volume is not None:
+                self.volume.close()
+            if self.navigator is not None:
+                self.navigator.close()
+            if self.disk_cache is not None:
+                self.disk_cache.close()
+            if self.remote is not None:
+                self.remote.close()
+            METRICS.close_log()
             print(" Medical Image Processor closed successfully")
             event.accept()
         except Exception as e:
@@ -562,11 +1169,60 @@ class ImageProcessor(QWidget):
 
 if __name__ == "__main__":
     try:
-        app = QApplication(sys.argv)
+        parser = argparse.ArgumentParser(description="Medical Image Processor")
+        parser.add_argument("--metrics-log", type=Path, default=None,
+                            help="append per-stage timings to this file as JSON lines")
+        parser.add_argument("--track-allocations", action="store_true",
+                            help="record the memory each stage allocates (tracemalloc; slows processing down)")
+        parser.add_argument("--cache-dir", type=Path, default=None,
+                            help="persistent result cache shared with headless runs "
+                                 "(default: ~/.cache/medical-image-processor)")
+        parser.add_argument("--cache-size", type=int, default=None, help="cache size cap in MB (default: 2048)")
+        parser.add_argument("--no-cache", action="store_true", help="do not use the persistent cache")
+        parser.add_argument("--daemon", nargs="?", const="", default=None, metavar="ADDRESS",
+                            help="compute results in a running processing daemon (daemon.py serve)")
+        parser.add_argument("--profile-startup", action="store_true",
+                            help="print the startup phases, then quit (exit code 1 over the budget)")
+        parser.add_argument("--startup-budget", type=float, default=DEFAULT_BUDGET_MS,
+                            help="time-to-first-paint budget in ms for --profile-startup")
+        args, qt_args = parser.parse_known_args()
+
+        app = QApplication(sys.argv[:1] + qt_args)
         app.setApplicationName("Medical Image Processor")
         app.setApplicationVersion("2.0")
+        STARTUP.mark("QApplication")
+
+        # Only Qt is imported so far: the window is painted first and the
+        # engine (OpenCV, numpy, cache) is attached right after.
+        window = ImageProcessor(defer_engine=True)
+        STARTUP.mark("window built")
+
+        def start_engine():
+            load_engine()
+            from disk_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_MB
+            if args.metrics_log is not None:
+                METRICS.open_log(args.metrics_log)
+            if args.track_allocations:
+                METRICS.track_allocations()
+            disk_cache = None
+            if not args.no_cache:
+                disk_cache = DiskCache(args.cache_dir or DEFAULT_CACHE_DIR,
+                                       (args.cache_size or DEFAULT_CACHE_MB) << 20)
+            remote = None
+            if args.daemon is not None:
+                from daemon import DEFAULT_ADDRESS, DaemonClient
+                try:
+                    remote = DaemonClient(args.daemon or DEFAULT_ADDRESS)
+                    print(f"[Daemon] Connected to {remote.address}")
+                except ConnectionError as e:
+                    print(f"[Daemon] {e}; processing locally")
+            window.attach_engine(disk_cache, remote)
+            if args.profile_startup:
+                app.exit(0 if STARTUP.report(args.startup_budget) else 1)
+            else:
+                threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
-        window = ImageProcessor()
+        window.first_painted.connect(start_engine, Qt.QueuedConnection)
         window.show()
 
         print(" Medical Image Processor Started")
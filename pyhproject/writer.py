@@ -0,0 +1,127 @@
+"""
+Background image writer with format-aware encoding
+
+Images are encoded in the format given by the file extension, with the JPEG /
+WebP quality, PNG compression level or TIFF compression chosen by the user,
+on a single background thread so saving a very large image never blocks the
+caller. Jobs may pass a callable instead of an array; it is then rendered on
+the writer thread as well. Files are written in submission order.
+"""
+
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, List, Optional, Union
+
+import cv2
+import numpy as np
+
+from instrumentation import METRICS
+from processing import write_image
+
+SAVE_FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG", ".tif": "TIFF",
+                ".tiff": "TIFF", ".webp": "WebP", ".bmp": "BMP"}
+# Formats that can hold the 16-bit (full depth) results.
+FULL_DEPTH_FORMATS = (".png", ".tif", ".tiff")
+TIFF_COMPRESSION = {"none": 1, "lzw": 5, "deflate": 8}
+
+
+@dataclass(frozen=True)
+class SaveOptions:
+    quality: int = 95              # JPEG / WebP, 1-100
+    png_compression: int = 3       # 0 (fastest) - 9 (smallest)
+    tiff_compression: str = "lzw"  # none, lzw or deflate
+    full_depth: bool = False       # keep deeper-than-8-bit results at 16 bits
+
+
+def encode_params(extension: str, options: SaveOptions) -> List[int]:
+    extension = extension.lower()
+    if extension in (".jpg", ".jpeg"):
+        return [cv2.IMWRITE_JPEG_QUALITY, options.quality]
+    if extension == ".webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, options.quality]
+    if extension == ".png":
+        return [cv2.IMWRITE_PNG_COMPRESSION, options.png_compression]
+    if extension in (".tif", ".tiff"):
+        return [cv2.IMWRITE_TIFF_COMPRESSION, TIFF_COMPRESSION[options.tiff_compression]]
+    return []
+
+
+@dataclass
+class WriteResult:
+    path: Path
+    nbytes: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.nbytes / self.elapsed if self.elapsed > 0 else 0.0
+
+
+class ImageWriter:
+    """Queue of images to encode and write on a background thread.
+
+    ``done`` callbacks run on the writer thread; GUI code should forward them
+    to the GUI thread (e.g. through a Qt signal).
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.busy_seconds = 0.0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes_written / self.busy_seconds if self.busy_seconds > 0 else 0.0
+
+    def submit(self, path, image: Union[np.ndarray, Callable[[], np.ndarray]],
+               options: SaveOptions = SaveOptions(),
+               done: Optional[Callable[[WriteResult], None]] = None) -> Future:
+        with self._lock:
+            self._pending += 1
+        return self._executor.submit(self._write, Path(path), image, options, done)
+
+    def _write(self, path: Path, image, options: SaveOptions,
+               done: Optional[Callable[[WriteResult], None]]) -> WriteResult:
+        start = time.perf_counter()
+        result = WriteResult(path)
+        try:
+            if callable(image):
+                image = image()
+            os.makedirs(path.parent, exist_ok=True)
+            with METRICS.measure("encode_write", "save", detail=path.name) as measurement:
+                result.nbytes = write_image(path, image, encode_params(path.suffix, options))
+                measurement.shape = tuple(image.shape)
+                measurement.output_bytes = result.nbytes
+        except Exception as e:
+            result.error = str(e)
+        result.elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._pending -= 1
+            if result.error is None:
+                self.files += 1
+                self.bytes_written += result.nbytes
+                self.busy_seconds += result.elapsed
+            else:
+                self.failed += 1
+        if done is not None:
+            done(result)
+        return result
+
+    def close(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
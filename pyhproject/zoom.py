@@ -0,0 +1,313 @@
+"""
+Magnifier windows, the hover loupe and the cache of recently extracted regions
+
+Zoom viewers are recycled from a bounded pool instead of creating a new
+top-level window per click, and closed viewers drop their pixmaps. The loupe
+magnifies whatever is under the mouse on the main view, rendering at most once
+per screen refresh into a single preallocated buffer.
+"""
+
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PySide6.QtCore import QPoint, Qt, QTimer, Signal
+from PySide6.QtGui import QColor, QGuiApplication, QPainter, QPen, QPixmap
+from PySide6.QtWidgets import QLabel, QWidget
+
+from display import DisplayBuffer
+from instrumentation import METRICS
+from pyramid import fit_size
+
+# Logical size of the magnified image: the 450 px zoom label minus its
+# border and padding.
+ZOOM_VIEW_SIZE = 436
+
+# Logical size of the hover loupe on the main view.
+LOUPE_SIZE = 200
+
+ZOOM_INTERPOLATIONS = OrderedDict([
+    ("Cubic", cv2.INTER_CUBIC),
+    ("Linear", cv2.INTER_LINEAR),
+    ("Lanczos", cv2.INTER_LANCZOS4),
+    ("Nearest", cv2.INTER_NEAREST),
+])
+
+
+def crop_region(img: np.ndarray, x: int, y: int, size: int) -> Optional[np.ndarray]:
+    """View (no copy) of the ``size`` square centred on (x, y), clipped to the image."""
+    h, w = img.shape[:2]
+    half = size // 2
+    x1, y1 = max(0, x - half), max(0, y - half)
+    x2, y2 = min(w, x + half), min(h, y + half)
+    if x2 <= x1 or y2 <= y1:
+        return None
+    return img[y1:y2, x1:x2]
+
+
+def square_region(img: np.ndarray, x: int, y: int, size: int) -> np.ndarray:
+    """View of a ``size`` square around (x, y), shifted to stay inside the image."""
+    h, w = img.shape[:2]
+    size = max(1, min(size, h, w))
+    x0 = min(max(0, x - size // 2), w - size)
+    y0 = min(max(0, y - size // 2), h - size)
+    return img[y0:y0 + size, x0:x0 + size]
+
+
+def magnify(region: np.ndarray, max_width: int, max_height: int,
+            interpolation: int = cv2.INTER_CUBIC) -> np.ndarray:
+    """Resample ``region`` once so it fits the target size, keeping its aspect ratio."""
+    h, w = region.shape[:2]
+    new_w, new_h = fit_size(w, h, max_width, max_height)
+    if h < 10 or w < 10:
+        # A handful of source pixels: show them as crisp blocks.
+        interpolation = cv2.INTER_NEAREST
+    return cv2.resize(region, (new_w, new_h), interpolation=interpolation)
+
+
+def screen_device_pixel_ratio() -> float:
+    screen = QGuiApplication.primaryScreen()
+    return screen.devicePixelRatio() if screen is not None else 1.0
+
+
+class ZoomWindow(QWidget):
+
+    closed = Signal(object)
+
+    def __init__(self, image: Optional[np.ndarray] = None, title: str = "Magnified Region"):
+        super().__init__()
+        self._display = DisplayBuffer()
+        self.setWindowTitle(title)
+        self.setGeometry(200, 200, 500, 500)
+        self.setup_zoom_ui()
+        if image is not None:
+            self.display_zoomed_image(image)
+
+    def setup_zoom_ui(self):
+        self.setStyleSheet("""
+            QWidget {
+                background-color: #2c3e50;
+                color: white;
+            }
+            QLabel {
+                border: 2px solid #34495e;
+                border-radius: 8px;
+                background-color: #ecf0f1;
+                padding: 5px;
+            }
+        """)
+
+        self.zoom_label = QLabel(self)
+        self.zoom_label.setGeometry(25, 25, 450, 450)
+        self.zoom_label.setAlignment(Qt.AlignCenter)
+
+    def display_zoomed_image(self, cv_image: np.ndarray):
+        if cv_image is None or cv_image.size == 0:
+            self.zoom_label.setText("No image data available")
+            return
+
+        try:
+            target_w, target_h = self.target_size()
+            with METRICS.measure("zoom_window", "display") as measurement:
+                # Already resampled to this viewer's size: wrapped as-is,
+                # otherwise resampled once into the window's buffer.
+                qimage = self._display.fit(cv_image, target_w, target_h,
+                                           device_pixel_ratio=self.devicePixelRatioF())
+                self.zoom_label.setPixmap(QPixmap.fromImage(qimage))
+                measurement.output_bytes = qimage.sizeInBytes()
+                measurement.shape = (qimage.height(), qimage.width())
+
+        except Exception as e:
+            self.zoom_label.setText(f"Display error: {str(e)}")
+
+    def target_size(self) -> Tuple[int, int]:
+        """Magnified image size in device pixels."""
+        dpr = self.devicePixelRatioF()
+        size = min(ZOOM_VIEW_SIZE, self.zoom_label.contentsRect().width(),
+                   self.zoom_label.contentsRect().height())
+        return int(size * dpr), int(size * dpr)
+
+    def release(self):
+        self.zoom_label.clear()
+        self._display.release()
+
+    def closeEvent(self, event):
+        self.release()
+        self.closed.emit(self)
+        event.accept()
+
+
+
+class ZoomWindowPool:
+    """At most ``max_windows`` zoom viewers, recycled least-recently-used first."""
+
+    def __init__(self, max_windows: int = 4):
+        self.max_windows = max_windows
+        self._windows: List[ZoomWindow] = []
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def target_size(self) -> Tuple[int, int]:
+        if self._windows:
+            return self._windows[-1].target_size()
+        size = int(ZOOM_VIEW_SIZE * screen_device_pixel_ratio())
+        return size, size
+
+    def show(self, image: np.ndarray, title: str) -> ZoomWindow:
+        window = self._take_window()
+        window.setWindowTitle(title)
+        window.display_zoomed_image(image)
+        window.show()
+        window.raise_()
+
+        # Most recently used windows live at the end of the list.
+        self._windows.remove(window)
+        self._windows.append(window)
+        return window
+
+    def _take_window(self) -> ZoomWindow:
+        for window in self._windows:
+            if not window.isVisible():
+                return window
+        if len(self._windows) < self.max_windows:
+            # Painted once, by show().
+            window = ZoomWindow()
+            window.closed.connect(self._on_closed)
+            self._windows.append(window)
+            return window
+        return self._windows[0]
+
+    def _on_closed(self, window: ZoomWindow):
+        # Closed viewers go to the front so they are reused first.
+        if window in self._windows:
+            self._windows.remove(window)
+            self._windows.insert(0, window)
+
+    def close_all(self):
+        for window in self._windows:
+            if window.isVisible():
+                window.close()
+            window.release()
+
+    def clear(self):
+        self.close_all()
+        for window in self._windows:
+            window.deleteLater()
+        self._windows.clear()
+
+
+class Loupe(QWidget):
+    """Magnifier that follows the mouse over the main image view.
+
+    Mouse moves only record the latest position; rendering is throttled to the
+    screen refresh rate and resizes straight into a preallocated buffer that a
+    QImage wraps, so sweeping the mouse does not allocate per move.
+    """
+
+    def __init__(self, parent: QWidget, size: int = LOUPE_SIZE):
+        super().__init__(parent)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents)
+        self.resize(size, size)
+        self.hide()
+        self.frames = 0
+        self._display = DisplayBuffer()
+        self._pending = None
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._render)
+
+    def frame_interval(self) -> int:
+        screen = self.screen()
+        rate = screen.refreshRate() if screen is not None else 60.0
+        return max(1, int(1000 / (rate or 60.0)))
+
+    def track(self, pos: QPoint, image: np.ndarray, x: int, y: int, region_size: int,
+              interpolation: int = cv2.INTER_CUBIC):
+        """Magnify the ``region_size`` square of ``image`` at (x, y), centred on ``pos``."""
+        self._pending = (pos, image, x, y, region_size, interpolation)
+        if not self._timer.isActive():
+            self._timer.start(self.frame_interval())
+
+    def stop(self):
+        self._timer.stop()
+        self._pending = None
+        self.hide()
+
+    def release(self):
+        self.stop()
+        self._display.release()
+
+    def _ensure_buffer(self, image: np.ndarray) -> np.ndarray:
+        dpr = self.devicePixelRatioF()
+        side = int(self.width() * dpr)
+        # Only reallocated when the channel count or screen changes.
+        return self._display.ensure((side, side) + image.shape[2:], dpr)
+
+    def _render(self):
+        if self._pending is None:
+            return
+        pos, image, x, y, region_size, interpolation = self._pending
+        self._pending = None
+
+        buffer = self._ensure_buffer(image)
+        region = square_region(image, x, y, region_size)
+        if region.shape[0] < 10:
+            interpolation = cv2.INTER_NEAREST
+        cv2.resize(region, (buffer.shape[1], buffer.shape[0]), dst=buffer, interpolation=interpolation)
+        self.frames += 1
+
+        self.move(pos.x() - self.width() // 2, pos.y() - self.height() // 2)
+        if not self.isVisible():
+            self.show()
+        self.update()
+
+    def paintEvent(self, event):
+        if self._display.qimage is None:
+            return
+        painter = QPainter(self)
+        painter.drawImage(0, 0, self._display.qimage)
+        painter.setPen(QPen(QColor("#34495e"), 2))
+        painter.drawRect(self.rect().adjusted(1, 1, -1, -1))
+        painter.end()
+
+
+class RegionCache:
+    """Recently extracted zoom regions keyed by (image version, x, y, size).
+
+    Keyed on the exact position: re-clicking the same spot (or exporting the
+    cached regions) does not resample again.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[Hashable, np.ndarray]" = OrderedDict()
+
+    def get(self, version: Hashable, x: int, y: int, size: int,
+            extract: Callable[[int, int, int], Optional[np.ndarray]]) -> Optional[np.ndarray]:
+        key = (version, x, y, size)
+        region = self._cache.get(key)
+        if region is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return region
+
+        self.misses += 1
+        region = extract(x, y, size)
+        if region is not None:
+            self._cache[key] = region
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return region
+
+    def items(self):
+        """(key, region) pairs, least recently used first."""
+        return list(self._cache.items())
+
+    def clear(self):
+        self._cache.clear()